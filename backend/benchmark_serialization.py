@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Benchmark: кодирование списка товаров
+Сравнивает процессорное время на запрос для большого каталога:
+- stdlib: jsonable_encoder + json.dumps (как JSONResponse до оптимизации)
+- orjson: jsonable_encoder + orjson (ORJSONResponse по умолчанию)
+- fragments: склейка закэшированных фрагментов товаров
+
+Запуск: python benchmark_serialization.py [--products 5000] [--repeat 50]
+"""
+
+import argparse
+import json
+import time
+import uuid
+from datetime import datetime
+
+from fastapi.encoders import jsonable_encoder
+
+from services.serialization import ProductFragmentCache, dumps, orjson
+
+def make_products(count):
+    now = datetime.now().isoformat()
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "name": f"Фильтр гидравлический JCB 32/{925000 + i}",
+            "description": "Оригинальный гидравлический фильтр для экскаваторов JCB. "
+                           "Высокое качество, длительный срок службы.",
+            "part_number": f"32/{925000 + i}",
+            "brand": "JCB",
+            "category": ["Гидравлика", "Двигатель", "Тормозная система"][i % 3],
+            "price": 8500 + i,
+            "image_url": "/images/hydraulic-filter.jpg",
+            "slug": f"filtr-gidravlicheskij-jcb-32-{925000 + i}",
+            "in_stock": True,
+            "stock_quantity": i % 40,
+            "created_at": now,
+            "updated_at": now
+        }
+        for i in range(count)
+    ]
+
+def cpu_time_per_call(func, repeat):
+    func()
+    started = time.process_time()
+    for _ in range(repeat):
+        func()
+    return (time.process_time() - started) / repeat * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    products = make_products(args.products)
+    fragments = ProductFragmentCache()
+    # Кэш фрагментов без подписки на базу: версия фиксирована
+    fragments._ensure_fresh = lambda fields=None: fragments.version
+
+    def stdlib():
+        return json.dumps(jsonable_encoder(products), ensure_ascii=False, allow_nan=False,
+                          indent=None, separators=(",", ":")).encode("utf-8")
+
+    cases = [("stdlib json + jsonable_encoder", stdlib)]
+    if orjson is not None:
+        cases.append(("orjson + jsonable_encoder", lambda: orjson.dumps(jsonable_encoder(products))))
+    cases.append(("serialization.dumps", lambda: dumps(products)))
+    cases.append(("pre-encoded fragments", lambda: fragments.encode_list(products)))
+
+    reference = json.loads(stdlib())
+    print(f"{args.products} products, {args.repeat} requests per case (CPU ms per request)")
+    baseline = None
+    for name, func in cases:
+        assert json.loads(func()) == reference, f"{name}: output differs"
+        elapsed = cpu_time_per_call(func, args.repeat)
+        baseline = baseline or elapsed
+        print(f"  {name:<34} {elapsed:8.2f} ms  x{baseline / elapsed:5.1f}")
+
+if __name__ == "__main__":
+    main()
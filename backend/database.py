@@ -1,15 +1,22 @@
+import bisect
+import hashlib
 import json
 import os
 import uuid
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 import bcrypt
 
 # Database file paths
-DATA_DIR = "/app/backend/data"
+DATA_DIR = os.environ.get("DATA_DIR", "/app/backend/data")
 PRODUCTS_FILE = f"{DATA_DIR}/products.json"
 USERS_FILE = f"{DATA_DIR}/users.json"
 ORDERS_FILE = f"{DATA_DIR}/orders.json"
 CART_FILE = f"{DATA_DIR}/cart.json"
+CARTS_DIR = f"{DATA_DIR}/carts"
+CARTS_ARCHIVE_DIR = f"{DATA_DIR}/carts_archive"
 SETTINGS_FILE = f"{DATA_DIR}/settings.json"
 PAYMENTS_FILE = f"{DATA_DIR}/payments.json"
 SUPPLIERS_FILE = f"{DATA_DIR}/suppliers.json"
@@ -21,10 +28,80 @@ MEDIA_FILE = f"{DATA_DIR}/media.json"
 ONEC_SETTINGS_FILE = f"{DATA_DIR}/1c_settings.json"
 ONEC_SYNC_FILE = f"{DATA_DIR}/1c_sync.json"
 SEO_SETTINGS_FILE = f"{DATA_DIR}/seo_settings.json"
+SEQUENCES_FILE = f"{DATA_DIR}/sequences.json"
+IDEMPOTENCY_FILE = f"{DATA_DIR}/idempotency.json"
+WEBHOOKS_DIR = f"{DATA_DIR}/webhooks"
+WEBHOOK_PROCESSED_FILE = f"{DATA_DIR}/webhook_processed.json"
 
 # Ensure data directory exists
 os.makedirs(DATA_DIR, exist_ok=True)
 
+# Кэш разобранных коллекций: путь -> ((mtime_ns, size), данные).
+# Файл перечитывается только если изменился на диске, поэтому
+# возвращаемые объекты общие: изменять их можно только перед save_json.
+_cache_lock = threading.RLock()
+_collection_cache = {}
+_collection_versions = {}
+_index_cache = {}
+
+def _file_stamp(file_path):
+    stat = os.stat(file_path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def _bump_version(file_path):
+    with _cache_lock:
+        _collection_versions[file_path] = _collection_versions.get(file_path, 0) + 1
+
+def collection_version(file_path):
+    """Версия коллекции, увеличивается при каждом изменении файла"""
+    return _collection_versions.get(file_path, 0)
+
+def collection_etag(file_path):
+    """Метка состояния коллекции для HTTP-валидаторов без чтения данных.
+    Строится только из состояния файла, общего для всех воркеров: mtime,
+    размер и inode. save_json заменяет файл новым (os.replace), поэтому inode
+    различает записи в пределах разрешения mtime; локальная версия коллекции
+    в метку не входит - в разных воркерах она разная"""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return "0"
+    return f"{stat.st_mtime_ns:x}.{stat.st_size:x}.{stat.st_ino:x}"
+
+def collection_snapshot(file_path, load):
+    """Данные коллекции и версия, прочитанные согласованно: save_json
+    записывает файл и увеличивает версию под той же блокировкой"""
+    with _cache_lock:
+        data = load()
+        return data, collection_version(file_path)
+
+class ChangeTracker:
+    """Согласование инкрементальных обновлений агрегата со снимками
+    коллекции. Событие, чья версия не новее снимка, уже учтено в нем и
+    пропускается (записи могут чередоваться с оповещениями); более новые
+    применяются; пропуск версий (запись другого воркера) - пересчет"""
+    
+    SKIP, APPLY, REBUILD = "skip", "apply", "rebuild"
+    
+    def __init__(self):
+        self.snapshot_version = None
+        self.version = None
+    
+    def rebuilt(self, version):
+        self.snapshot_version = self.version = version
+    
+    def classify(self, version):
+        if self.version is None:
+            return self.REBUILD
+        if version <= self.snapshot_version:
+            return self.SKIP
+        if version <= self.version + 1:
+            return self.APPLY
+        return self.REBUILD
+    
+    def applied(self, version):
+        self.version = max(self.version, version)
+
 def load_json(file_path, default=None):
     """Load JSON data from file"""
     if default is None:
@@ -32,8 +109,19 @@ def load_json(file_path, default=None):
     
     try:
         if os.path.exists(file_path):
+            stamp = _file_stamp(file_path)
+            cached = _collection_cache.get(file_path)
+            if cached and cached[0] == stamp:
+                return cached[1]
+            
             with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+                data = json.load(f)
+            with _cache_lock:
+                _collection_cache[file_path] = (stamp, data)
+            if cached:
+                # Файл изменен извне (другой воркер или ручная правка)
+                _bump_version(file_path)
+            return data
         return default
     except Exception as e:
         print(f"Error loading {file_path}: {e}")
@@ -42,13 +130,419 @@ def load_json(file_path, default=None):
 def save_json(file_path, data):
     """Save JSON data to file"""
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        with _cache_lock:
+            # Запись через временный файл: читатели видят либо старую,
+            # либо новую версию, но не наполовину записанный файл
+            temp_path = f"{file_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, file_path)
+            _collection_cache[file_path] = (_file_stamp(file_path), data)
+            _bump_version(file_path)
         return True
     except Exception as e:
+        with _cache_lock:
+            _collection_cache.pop(file_path, None)
         print(f"Error saving {file_path}: {e}")
         return False
 
+# Подписчики на изменения коллекций: listener(file_path, action, item, previous)
+_change_listeners = []
+
+def on_change(listener):
+    """Подписка на изменения коллекций (add/update/delete); повторная
+    подписка того же обработчика игнорируется"""
+    if listener not in _change_listeners:
+        _change_listeners.append(listener)
+    return listener
+
+def notify_change(file_path, action, item, previous=None):
+    """Оповещение подписчиков об изменении; ошибки подписчика не ломают запись"""
+    for listener in list(_change_listeners):
+        try:
+            listener(file_path, action, item, previous)
+        except Exception as e:
+            print(f"Change listener error for {file_path}: {e}")
+
+def forget_cached(file_path):
+    """Убрать файл из кэша (после удаления с диска); версия сохраняется"""
+    with _cache_lock:
+        _collection_cache.pop(file_path, None)
+        _index_cache.pop(file_path, None)
+
+def get_index(file_path, factory):
+    """Индекс коллекции, перестраивается только при смене ее версии"""
+    data = load_json(file_path, [])
+    version = collection_version(file_path)
+    cached = _index_cache.get(file_path)
+    if cached and cached[0] == version and cached[1] is data:
+        return cached[2]
+    
+    index = factory(data)
+    with _cache_lock:
+        _index_cache[file_path] = (version, data, index)
+    return index
+
+# Поля, которые никогда не попадают в ответы API
+SECRET_FIELDS = frozenset({"password_hash"})
+
+# Именованные представления: кортеж полей или None - все публичные поля
+PRODUCT_VIEWS = {
+    "card": ("id", "name", "slug", "price", "image_url", "brand", "part_number", "in_stock", "stock_quantity"),
+    "full": None,
+    "admin": None
+}
+USER_VIEWS = {
+    "card": ("id", "username", "name", "role", "user_type"),
+    "full": None,
+    "admin": None
+}
+
+# Поля, доступные в ?fields=. Проекции кэшируются по набору полей, поэтому
+# произвольные имена от клиента не принимаются
+PRODUCT_FIELDS = frozenset({
+    "id", "name", "slug", "description", "part_number", "brand", "category", "price",
+    "image_url", "stock_quantity", "in_stock", "created_at", "updated_at"
+})
+USER_FIELDS = frozenset({
+    "id", "username", "email", "phone", "name", "user_type", "role", "active", "auth_method",
+    "company_name", "inn", "kpp", "ogrn", "legal_address", "postal_address",
+    "first_name", "last_name", "middle_name", "passport_series", "passport_number", "birth_date",
+    "created_at", "updated_at"
+})
+ORDER_FIELDS = frozenset({
+    "id", "order_number", "user_id", "status", "items", "subtotal", "tax_amount", "shipping_cost",
+    "total_amount", "currency", "user_name", "user_email", "user_phone", "delivery_address", "notes",
+    "reservation", "refund_required", "created_at", "updated_at"
+})
+
+class UnknownFieldsError(ValueError):
+    """В ?fields= указаны поля, которых нет у модели"""
+    
+    def __init__(self, fields):
+        super().__init__(f"Unknown fields: {', '.join(fields)}")
+        self.fields = fields
+
+def resolve_fields(views, view=None, fields=None, allowed=None):
+    """Поля проекции из ?view= или ?fields= (fields важнее); None - все поля.
+    id включается всегда, секретные поля отбрасываются, поля вне allowed -
+    ошибка UnknownFieldsError"""
+    if fields:
+        names = [name for name in (name.strip() for name in fields.split(",")) if name]
+        if allowed is not None:
+            unknown = [name for name in names if name not in allowed and name not in SECRET_FIELDS]
+            if unknown:
+                raise UnknownFieldsError(unknown)
+        return tuple(dict.fromkeys(
+            ["id"] + [name for name in names if name not in SECRET_FIELDS]
+        ))
+    if view:
+        if view not in views:
+            raise ValueError(f"Unknown view '{view}', expected one of: {', '.join(views)}")
+        return views[view]
+    return None
+
+def project_record(record, fields):
+    """Копия записи только с выбранными полями (или со всеми публичными)"""
+    if fields is None:
+        if SECRET_FIELDS.isdisjoint(record):
+            return record
+        return {key: value for key, value in record.items() if key not in SECRET_FIELDS}
+    return {name: record[name] for name in fields if name in record}
+
+class ProjectionMixin:
+    """Проекции записей индекса, кэшируемые вместе с индексом: пока версия
+    коллекции не изменилась, одна и та же проекция не строится повторно.
+    Хранятся проекции для MAX_PROJECTIONS последних наборов полей"""
+    
+    MAX_PROJECTIONS = 32
+    
+    def _init_projections(self):
+        self._projections = OrderedDict()
+        self._projections_lock = threading.Lock()
+    
+    def project(self, records, fields):
+        if fields is None and not self.has_secrets:
+            return list(records)
+        with self._projections_lock:
+            projections = self._projections.get(fields)
+            if projections is None:
+                projections = self._projections[fields] = {}
+                while len(self._projections) > self.MAX_PROJECTIONS:
+                    self._projections.popitem(last=False)
+            else:
+                self._projections.move_to_end(fields)
+        result = []
+        for record in records:
+            key = id(record)
+            projected = projections.get(key)
+            if projected is None:
+                projected = projections[key] = project_record(record, fields)
+            result.append(projected)
+        return result
+
+class ProductIndex(ProjectionMixin):
+    """Индексы каталога: по id, slug, бренду, категории и строки поиска"""
+    
+    has_secrets = False
+    
+    def __init__(self, products):
+        self.products = products
+        self._init_projections()
+        self.by_id = {}
+        self.by_slug = {}
+        self.by_brand = {}
+        self.by_category = {}
+        self.search_text = []
+        
+        for product in products:
+            self.by_id.setdefault(product.get("id"), product)
+            if product.get("slug"):
+                self.by_slug.setdefault(product["slug"], product)
+            self.by_brand.setdefault(str(product.get("brand") or "").lower(), []).append(product)
+            self.by_category.setdefault(str(product.get("category") or "").lower(), []).append(product)
+            self.search_text.append((
+                " ".join([
+                    str(product.get("name") or ""),
+                    str(product.get("description") or ""),
+                    str(product.get("part_number") or "")
+                ]).lower(),
+                product
+            ))
+    
+    def filter(self, brand=None, category=None, search=None):
+        """Фильтрация каталога с использованием индексов"""
+        products = self.products
+        if brand:
+            products = self.by_brand.get(brand.lower(), [])
+        if category:
+            by_category = self.by_category.get(category.lower(), [])
+            if products is self.products:
+                products = by_category
+            else:
+                allowed = {id(p) for p in by_category}
+                products = [p for p in products if id(p) in allowed]
+        if search:
+            search_lower = search.lower()
+            allowed = None if products is self.products else {id(p) for p in products}
+            products = [p for text, p in self.search_text
+                        if search_lower in text and (allowed is None or id(p) in allowed)]
+        return list(products)
+    
+    def get_many(self, product_ids):
+        """Товары по списку id в порядке запроса (без повторов) и
+        ненайденные id"""
+        found, missing, seen = [], [], set()
+        for product_id in product_ids:
+            if product_id in seen:
+                continue
+            seen.add(product_id)
+            product = self.by_id.get(product_id)
+            if product is None:
+                missing.append(product_id)
+            else:
+                found.append(product)
+        return found, missing
+
+class UserIndex(ProjectionMixin):
+    """Индексы пользователей: по id, логину (username/email), email и телефону"""
+    
+    has_secrets = True
+    
+    def __init__(self, users):
+        self.users = users
+        self._init_projections()
+        self.by_id = {}
+        self.by_login = {}
+        self.by_email = {}
+        self.by_phone = {}
+        
+        for user in users:
+            self.by_id.setdefault(user.get("id"), user)
+            for key in (user.get("username"), user.get("email")):
+                if key is not None:
+                    self.by_login.setdefault(key, user)
+            if user.get("email") is not None:
+                self.by_email.setdefault(user["email"], user)
+            if user.get("phone") is not None:
+                self.by_phone.setdefault(user["phone"], user)
+
+class MediaIndex:
+    """Индекс медиафайлов: по id, имени файла и SHA-256 содержимого"""
+    
+    def __init__(self, files):
+        self.by_id = {}
+        self.by_filename = {}
+        self.by_sha256 = {}
+        
+        for file_info in files:
+            self.by_id.setdefault(file_info.get("id"), file_info)
+            self.by_filename.setdefault(file_info.get("filename"), file_info)
+            if file_info.get("sha256"):
+                self.by_sha256.setdefault(file_info["sha256"], file_info)
+
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессная блокировка недоступна
+    fcntl = None
+
+@contextmanager
+def _process_lock(lock_path):
+    """Эксклюзивная блокировка файла, общая для всех воркеров"""
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+# Поколение записей коллекции, последнее увиденное этим процессом
+_lock_generations = {}
+# Глубина вложенных collection_lock текущего потока по файлам
+_lock_depth = threading.local()
+
+def _reload_json(file_path):
+    """Чтение коллекции с диска в обход кэша"""
+    if not os.path.exists(file_path):
+        return
+    stamp = _file_stamp(file_path)
+    with open(file_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    with _cache_lock:
+        _collection_cache[file_path] = (stamp, data)
+        _bump_version(file_path)
+
+@contextmanager
+def collection_lock(file_path):
+    """Чтение-изменение-запись коллекции, согласованное между потоками и
+    воркерами: файловая блокировка и счетчик записей (поколение) в
+    lock-файле. Если поколение изменил другой воркер, коллекция
+    перечитывается с диска, даже если mtime и размер файла совпали.
+    Повторный вход в том же потоке не блокирует. Оповещения об изменениях
+    лучше отправлять после выхода"""
+    depth = getattr(_lock_depth, "files", None)
+    if depth is None:
+        depth = _lock_depth.files = {}
+    if depth.get(file_path):
+        depth[file_path] += 1
+        try:
+            yield
+        finally:
+            depth[file_path] -= 1
+        return
+    
+    fd = os.open(f"{file_path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    depth[file_path] = 1
+    try:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            generation = int(os.pread(fd, 32, 0) or b"0")
+        except ValueError:
+            generation = 0
+        if _lock_generations.get(file_path) != generation:
+            _reload_json(file_path)
+        version = collection_version(file_path)
+        try:
+            yield
+        finally:
+            if collection_version(file_path) != version:
+                generation += 1
+                os.ftruncate(fd, 0)
+                os.pwrite(fd, str(generation).encode("ascii"), 0)
+            _lock_generations[file_path] = generation
+    finally:
+        depth[file_path] = 0
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+class SequenceAllocator:
+    """Монотонная последовательность номеров без чтения истории.
+    Старшее выданное значение хранится в sequences.json под файловой
+    блокировкой; воркер может брать номера блоками (block_size), чтобы
+    обращаться к файлу один раз на блок"""
+    
+    def __init__(self, name, block_size=1, seed=None):
+        self.name = name
+        self.block_size = max(1, block_size)
+        self.seed = seed
+        self._lock = threading.Lock()
+        self._next = 1
+        self._block_end = 0
+    
+    def _reserve_block(self):
+        with _process_lock(f"{SEQUENCES_FILE}.lock"):
+            try:
+                with open(SEQUENCES_FILE, 'r', encoding='utf-8') as f:
+                    sequences = json.load(f)
+            except (FileNotFoundError, ValueError):
+                sequences = {}
+            
+            current = sequences.get(self.name)
+            if current is None:
+                # Первый запуск: продолжаем нумерацию существующих данных
+                current = self.seed() if self.seed else 0
+            
+            sequences[self.name] = current + self.block_size
+            temp_path = f"{SEQUENCES_FILE}.{os.getpid()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(sequences, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, SEQUENCES_FILE)
+        
+        self._next = current + 1
+        self._block_end = current + self.block_size
+    
+    def next(self):
+        with self._lock:
+            if self._next > self._block_end:
+                self._reserve_block()
+            value = self._next
+            self._next += 1
+            return value
+
+def _max_order_number():
+    numbers = [0]
+    for order in load_json(ORDERS_FILE, []):
+        try:
+            numbers.append(int(str(order.get("order_number", "")).rsplit("-", 1)[-1]))
+        except ValueError:
+            continue
+    return max(numbers)
+
+order_number_sequence = SequenceAllocator(
+    "order_number",
+    block_size=int(os.environ.get("ORDER_NUMBER_BLOCK_SIZE", "1")),
+    seed=_max_order_number
+)
+
+class PaymentIndex:
+    """Индекс платежей: по id платежа у провайдера и незавершенные
+    платежи, отсортированные по created_at"""
+    
+    OPEN_STATUSES = ("pending", "waiting_for_capture")
+    
+    def __init__(self, payments):
+        self.by_payment_id = {}
+        self.open_by_created = []
+        
+        for payment in payments:
+            if payment.get("payment_id"):
+                self.by_payment_id.setdefault(payment["payment_id"], payment)
+                if payment.get("status") in self.OPEN_STATUSES:
+                    self.open_by_created.append((payment.get("created_at") or "", payment["payment_id"]))
+        self.open_by_created.sort()
+    
+    def open_before(self, created_before):
+        """Незавершенные платежи, созданные раньше указанного времени (старые первыми)"""
+        end = bisect.bisect_left(self.open_by_created, (created_before, ""))
+        return [self.by_payment_id[payment_id] for _, payment_id in self.open_by_created[:end]]
+
 def init_database():
     """Initialize database with default data"""
     
@@ -148,8 +642,8 @@ def init_database():
     if not os.path.exists(ORDERS_FILE):
         save_json(ORDERS_FILE, [])
     
-    if not os.path.exists(CART_FILE):
-        save_json(CART_FILE, {})
+    os.makedirs(CARTS_DIR, exist_ok=True)
+    _migrate_legacy_carts()
     
     if not os.path.exists(SETTINGS_FILE):
         settings = {
@@ -161,6 +655,44 @@ def init_database():
         }
         save_json(SETTINGS_FILE, settings)
 
+def cart_path(user_id):
+    """Файл корзины пользователя: carts/<2 символа хеша>/<хеш>.json"""
+    digest = hashlib.sha256(str(user_id).encode('utf-8')).hexdigest()
+    return f"{CARTS_DIR}/{digest[:2]}/{digest}.json"
+
+# Полосатые блокировки корзин: изменения одной корзины последовательны,
+# разные пользователи друг друга не ждут
+_cart_locks = [threading.Lock() for _ in range(64)]
+
+def _cart_lock(user_id):
+    return _cart_locks[hash(user_id) % len(_cart_locks)]
+
+def _save_cart(user_id, items):
+    path = cart_path(user_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    save_json(path, {
+        "user_id": user_id,
+        "items": items,
+        "updated_at": datetime.now().isoformat()
+    })
+    return items
+
+def _migrate_legacy_carts():
+    """Разнести общий cart.json по файлам пользователей (однократно). Модуль
+    импортируется каждым воркером: миграцию выполняет первый, взявший
+    блокировку, остальные видят, что файла уже нет"""
+    if not os.path.exists(CART_FILE):
+        return
+    with _process_lock(f"{CART_FILE}.lock"):
+        if not os.path.exists(CART_FILE):
+            return
+        carts = load_json(CART_FILE, {})
+        for user_id, items in carts.items():
+            if items and not os.path.exists(cart_path(user_id)):
+                _save_cart(user_id, items)
+        os.replace(CART_FILE, f"{CART_FILE}.migrated")
+        forget_cached(CART_FILE)
+
 # Database operations
 class Database:
     
@@ -168,51 +700,129 @@ class Database:
     def get_products():
         return load_json(PRODUCTS_FILE, [])
     
+    @staticmethod
+    def get_product_index():
+        return get_index(PRODUCTS_FILE, ProductIndex)
+    
     @staticmethod
     def get_product(product_id):
-        products = Database.get_products()
-        return next((p for p in products if p["id"] == product_id), None)
+        return Database.get_product_index().by_id.get(product_id)
     
     @staticmethod
     def add_product(product_data):
-        products = Database.get_products()
-        product = {
-            "id": str(uuid.uuid4()),
-            **product_data,
-            "created_at": datetime.now().isoformat()
-        }
-        products.append(product)
-        save_json(PRODUCTS_FILE, products)
+        with collection_lock(PRODUCTS_FILE):
+            products = Database.get_products()
+            product = {
+                "id": str(uuid.uuid4()),
+                **product_data,
+                "created_at": datetime.now().isoformat()
+            }
+            products.append(product)
+            save_json(PRODUCTS_FILE, products)
+        notify_change(PRODUCTS_FILE, "add", product)
         return product
     
     @staticmethod
     def update_product(product_id, product_data):
-        products = Database.get_products()
-        for i, product in enumerate(products):
-            if product["id"] == product_id:
-                products[i].update({
-                    **product_data,
-                    "updated_at": datetime.now().isoformat()
-                })
-                save_json(PRODUCTS_FILE, products)
-                return products[i]
-        return None
+        with collection_lock(PRODUCTS_FILE):
+            products = Database.get_products()
+            for i, product in enumerate(products):
+                if product["id"] == product_id:
+                    previous = dict(product)
+                    products[i].update({
+                        **product_data,
+                        "updated_at": datetime.now().isoformat()
+                    })
+                    save_json(PRODUCTS_FILE, products)
+                    break
+            else:
+                return None
+        notify_change(PRODUCTS_FILE, "update", products[i], previous)
+        return products[i]
+    
+    @staticmethod
+    def _apply_stock(deltas):
+        """Изменение остатков одной записью файла (вызывать под collection_lock)"""
+        index = Database.get_product_index()
+        now = datetime.now().isoformat()
+        changed = []
+        for product_id, delta in deltas.items():
+            product = index.by_id.get(product_id)
+            if product is None or not delta:
+                continue
+            previous = dict(product)
+            product["stock_quantity"] = int(product.get("stock_quantity") or 0) + delta
+            product["in_stock"] = product["stock_quantity"] > 0
+            product["updated_at"] = now
+            changed.append((product, previous))
+        
+        if changed and not save_json(PRODUCTS_FILE, index.products):
+            for product, previous in changed:
+                product.clear()
+                product.update(previous)
+            raise IOError("Failed to save stock changes")
+        return changed
+    
+    @staticmethod
+    def adjust_stock(deltas):
+        """Изменить остатки нескольких товаров одной записью файла.
+        deltas: {product_id: изменение остатка}. Для списания с проверкой
+        доступности - reserve_stock"""
+        with collection_lock(PRODUCTS_FILE):
+            changed = Database._apply_stock(deltas)
+        for product, previous in changed:
+            notify_change(PRODUCTS_FILE, "update", product, previous)
+        return [product for product, _ in changed]
+    
+    @staticmethod
+    def reserve_stock(quantities):
+        """Проверка и списание остатков одной операцией под блокировкой,
+        общей для всех воркеров, по свежим данным. quantities: {product_id:
+        количество}. Возвращает нехватку; если она есть, ничего не списано"""
+        with collection_lock(PRODUCTS_FILE):
+            index = Database.get_product_index()
+            shortages = []
+            for product_id, quantity in quantities.items():
+                product = index.by_id.get(product_id)
+                try:
+                    available = int(product.get("stock_quantity") or 0) if product else 0
+                except (TypeError, ValueError):
+                    available = 0
+                if available < quantity:
+                    shortages.append({
+                        "product_id": product_id,
+                        "requested": quantity,
+                        "available": max(available, 0)
+                    })
+            if shortages:
+                return shortages
+            changed = Database._apply_stock({pid: -qty for pid, qty in quantities.items()})
+        for product, previous in changed:
+            notify_change(PRODUCTS_FILE, "update", product, previous)
+        return []
     
     @staticmethod
     def delete_product(product_id):
-        products = Database.get_products()
-        products = [p for p in products if p["id"] != product_id]
-        save_json(PRODUCTS_FILE, products)
+        with collection_lock(PRODUCTS_FILE):
+            products = Database.get_products()
+            removed = [p for p in products if p["id"] == product_id]
+            products = [p for p in products if p["id"] != product_id]
+            save_json(PRODUCTS_FILE, products)
+        for product in removed:
+            notify_change(PRODUCTS_FILE, "delete", product)
         return True
     
     @staticmethod
     def get_users():
         return load_json(USERS_FILE, [])
     
+    @staticmethod
+    def get_user_index():
+        return get_index(USERS_FILE, UserIndex)
+    
     @staticmethod
     def get_user_by_username(username):
-        users = Database.get_users()
-        return next((u for u in users if u["username"] == username or u["email"] == username), None)
+        return Database.get_user_index().by_login.get(username)
     
     @staticmethod
     def add_user(user_data):
@@ -224,90 +834,216 @@ class Database:
         }
         users.append(user)
         save_json(USERS_FILE, users)
+        notify_change(USERS_FILE, "add", user)
         return user
     
+    @staticmethod
+    def cart_version(user_id):
+        """Версия корзины пользователя для кэширования ее представления"""
+        return collection_version(cart_path(user_id))
+    
     @staticmethod
     def get_cart(user_id):
-        carts = load_json(CART_FILE, {})
-        return carts.get(user_id, [])
+        return load_json(cart_path(user_id), {}).get("items", [])
     
     @staticmethod
     def add_to_cart(user_id, product_id, quantity=1):
-        carts = load_json(CART_FILE, {})
-        if user_id not in carts:
-            carts[user_id] = []
-        
-        # Check if product already in cart
-        for item in carts[user_id]:
-            if item["product_id"] == product_id:
-                item["quantity"] += quantity
-                save_json(CART_FILE, carts)
-                return carts[user_id]
-        
-        # Add new item
-        product = Database.get_product(product_id)
-        if product:
-            cart_item = {
-                "id": str(uuid.uuid4()),
-                "product_id": product_id,
-                "product_name": product["name"],
-                "product_price": product["price"],
-                "quantity": quantity,
-                "added_at": datetime.now().isoformat()
-            }
-            carts[user_id].append(cart_item)
-            save_json(CART_FILE, carts)
-        
-        return carts[user_id]
+        with _cart_lock(user_id):
+            items = [dict(item) for item in Database.get_cart(user_id)]
+            
+            # Check if product already in cart
+            for item in items:
+                if item["product_id"] == product_id:
+                    item["quantity"] += quantity
+                    return _save_cart(user_id, items)
+            
+            # Add new item
+            product = Database.get_product(product_id)
+            if product:
+                cart_item = {
+                    "id": str(uuid.uuid4()),
+                    "product_id": product_id,
+                    "product_name": product["name"],
+                    "product_price": product["price"],
+                    "quantity": quantity,
+                    "added_at": datetime.now().isoformat()
+                }
+                items.append(cart_item)
+                _save_cart(user_id, items)
+            
+            return items
+    
+    @staticmethod
+    def merge_into_cart(user_id, lines):
+        """Добавить строки [(product_id, quantity)] в корзину одной записью.
+        Для товара, который уже есть в корзине, остается большее из двух
+        количеств, поэтому повторное слияние тех же строк ничего не меняет"""
+        with _cart_lock(user_id):
+            items = [dict(item) for item in Database.get_cart(user_id)]
+            by_product = {item["product_id"]: item for item in items}
+            product_index = Database.get_product_index()
+            
+            for product_id, quantity in lines:
+                if product_id in by_product:
+                    item = by_product[product_id]
+                    item["quantity"] = max(item["quantity"], quantity)
+                    continue
+                product = product_index.by_id.get(product_id)
+                if product and quantity > 0:
+                    item = {
+                        "id": str(uuid.uuid4()),
+                        "product_id": product_id,
+                        "product_name": product["name"],
+                        "product_price": product["price"],
+                        "quantity": quantity,
+                        "added_at": datetime.now().isoformat()
+                    }
+                    items.append(item)
+                    by_product[product_id] = item
+            
+            return _save_cart(user_id, items)
     
     @staticmethod
     def update_cart_item(user_id, item_id, quantity):
-        carts = load_json(CART_FILE, {})
-        if user_id in carts:
-            for item in carts[user_id]:
+        with _cart_lock(user_id):
+            items = [dict(item) for item in Database.get_cart(user_id)]
+            for item in items:
                 if item["id"] == item_id:
                     if quantity <= 0:
-                        carts[user_id] = [i for i in carts[user_id] if i["id"] != item_id]
+                        items = [i for i in items if i["id"] != item_id]
                     else:
                         item["quantity"] = quantity
-                    save_json(CART_FILE, carts)
-                    break
-        return carts.get(user_id, [])
+                    return _save_cart(user_id, items)
+            return items
     
     @staticmethod
     def remove_from_cart(user_id, item_id):
-        carts = load_json(CART_FILE, {})
-        if user_id in carts:
-            carts[user_id] = [i for i in carts[user_id] if i["id"] != item_id]
-            save_json(CART_FILE, carts)
-        return carts.get(user_id, [])
+        with _cart_lock(user_id):
+            items = Database.get_cart(user_id)
+            remaining = [i for i in items if i["id"] != item_id]
+            if len(remaining) != len(items):
+                _save_cart(user_id, remaining)
+            return remaining
     
     @staticmethod
     def clear_cart(user_id):
-        carts = load_json(CART_FILE, {})
-        if user_id in carts:
-            carts[user_id] = []
-            save_json(CART_FILE, carts)
+        with _cart_lock(user_id):
+            if Database.get_cart(user_id):
+                _save_cart(user_id, [])
         return []
     
+    @staticmethod
+    def evict_idle_carts(max_idle_seconds, archive=True, cache_idle_seconds=3600):
+        """Удаление корзин, не изменявшихся дольше max_idle_seconds. Непустые
+        корзины переносятся в архив. Возраст берется из mtime файла, сами
+        корзины не читаются. Корзины, не менявшиеся дольше cache_idle_seconds,
+        убираются из кэша коллекций: иначе он хранит каждую открытую корзину"""
+        now = datetime.now().timestamp()
+        cutoff = now - max_idle_seconds
+        cache_cutoff = now - cache_idle_seconds
+        stats = {"scanned": 0, "archived": 0, "deleted": 0, "uncached": 0}
+        
+        for shard in os.scandir(CARTS_DIR):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if not entry.name.endswith(".json"):
+                    continue
+                stats["scanned"] += 1
+                try:
+                    mtime = entry.stat().st_mtime
+                    if mtime >= cutoff:
+                        if mtime < cache_cutoff and entry.path in _collection_cache:
+                            forget_cached(entry.path)
+                            stats["uncached"] += 1
+                        continue
+                    record = load_json(entry.path, {})
+                    with _cart_lock(record.get("user_id")):
+                        # Корзину могли изменить, пока мы до нее дошли
+                        if os.stat(entry.path).st_mtime >= cutoff:
+                            continue
+                        if archive and record.get("items"):
+                            archive_dir = os.path.join(CARTS_ARCHIVE_DIR, shard.name)
+                            os.makedirs(archive_dir, exist_ok=True)
+                            os.replace(entry.path, os.path.join(archive_dir, entry.name))
+                            stats["archived"] += 1
+                        else:
+                            os.remove(entry.path)
+                            stats["deleted"] += 1
+                    forget_cached(entry.path)
+                except OSError as e:
+                    print(f"Cart eviction error for {entry.path}: {e}")
+        
+        return stats
+    
     @staticmethod
     def get_orders():
         return load_json(ORDERS_FILE, [])
     
     @staticmethod
-    def add_order(order_data):
-        orders = Database.get_orders()
-        order = {
+    def build_order(order_data):
+        """Новая запись заказа с номером из последовательности (без сохранения)"""
+        order_number = order_number_sequence.next()
+        return {
             "id": str(uuid.uuid4()),
-            "order_number": f"NEXX-{len(orders) + 1:06d}",
+            "order_number": f"NEXX-{order_number:06d}",
             **order_data,
             "status": "pending",
             "created_at": datetime.now().isoformat()
         }
-        orders.append(order)
-        save_json(ORDERS_FILE, orders)
+    
+    @staticmethod
+    def add_order(order_data):
+        return Database.insert_order(Database.build_order(order_data))
+    
+    @staticmethod
+    def insert_order(order):
+        """Сохранение заказа, собранного build_order"""
+        with collection_lock(ORDERS_FILE):
+            orders = Database.get_orders()
+            orders.append(order)
+            if not save_json(ORDERS_FILE, orders):
+                raise IOError(f"Failed to write {ORDERS_FILE}")
+        notify_change(ORDERS_FILE, "add", order)
         return order
     
+    @staticmethod
+    def get_order(order_id):
+        orders = Database.get_orders()
+        return next((o for o in orders if o.get("id") == order_id), None)
+    
+    @staticmethod
+    def update_order(order_id, update_data):
+        """Обновить заказ"""
+        with collection_lock(ORDERS_FILE):
+            orders = Database.get_orders()
+            for i, order in enumerate(orders):
+                if order.get("id") == order_id:
+                    previous = dict(order)
+                    orders[i].update({
+                        **update_data,
+                        "updated_at": datetime.now().isoformat()
+                    })
+                    save_json(ORDERS_FILE, orders)
+                    break
+            else:
+                return None
+        notify_change(ORDERS_FILE, "update", orders[i], previous)
+        return orders[i]
+    
+    # Общие настройки магазина
+    @staticmethod
+    def get_settings():
+        return load_json(SETTINGS_FILE, {})
+    
+    @staticmethod
+    def update_settings(settings_data):
+        settings = Database.get_settings()
+        settings.update(settings_data)
+        save_json(SETTINGS_FILE, settings)
+        notify_change(SETTINGS_FILE, "update", settings)
+        return settings
+    
     # Платежные системы
     @staticmethod
     def get_payment_settings():
@@ -331,26 +1067,103 @@ class Database:
     
     @staticmethod
     def add_payment(payment_data):
-        payments = Database.get_payments()
         payment = {
             "id": str(uuid.uuid4()),
             **payment_data,
             "created_at": datetime.now().isoformat()
         }
-        payments.append(payment)
-        save_json(PAYMENTS_FILE, payments)
+        with collection_lock(PAYMENTS_FILE):
+            payments = Database.get_payments()
+            payments.append(payment)
+            save_json(PAYMENTS_FILE, payments)
+        notify_change(PAYMENTS_FILE, "add", payment)
         return payment
     
+    @staticmethod
+    def commit_checkout(user_id, order, payment_data=None):
+        """Фиксация оформления заказа одним шагом: заказ, платеж и удаление
+        оформленных строк из корзины. Строки, добавленные во время оформления,
+        остаются в корзине. Заказ, уже сохраненный при резервировании, не
+        перезаписывается: его статус и резерв могли измениться. При ошибке
+        записи уже сохраненные файлы возвращаются в исходное состояние"""
+        payment = None
+        if payment_data is not None:
+            payment = {
+                "id": str(uuid.uuid4()),
+                **payment_data,
+                "created_at": datetime.now().isoformat()
+            }
+        
+        # Оформленное количество по строкам корзины
+        ordered = {}
+        for item in order.get("items", []):
+            ordered[item.get("id")] = ordered.get(item.get("id"), 0) + int(item.get("quantity") or 0)
+        
+        cart_file = cart_path(user_id)
+        with _cart_lock(user_id), collection_lock(ORDERS_FILE), collection_lock(PAYMENTS_FILE):
+            orders = Database.get_orders()
+            payments = Database.get_payments()
+            cart = load_json(cart_file, {})
+            
+            remaining = []
+            for item in cart.get("items", []):
+                left = int(item.get("quantity") or 0) - ordered.get(item.get("id"), 0)
+                if item.get("id") not in ordered:
+                    remaining.append(item)
+                elif left > 0:
+                    # Количество увеличили после начала оформления: остаток не оформлен
+                    remaining.append({**item, "quantity": left})
+            
+            stored = next((o for o in orders if o.get("id") == order.get("id")), None)
+            changes = []
+            if stored is None:
+                changes.append((ORDERS_FILE, orders, orders + [order]))
+            else:
+                order = stored
+            if payment is not None:
+                changes.append((PAYMENTS_FILE, payments, payments + [payment]))
+            if remaining != cart.get("items", []):
+                changes.append((cart_file, cart, {**cart, "items": remaining, "updated_at": datetime.now().isoformat()}))
+            
+            written = []
+            try:
+                for file_path, original, updated in changes:
+                    if not save_json(file_path, updated):
+                        raise IOError(f"Failed to write {file_path}")
+                    written.append((file_path, original))
+            except Exception:
+                for file_path, original in reversed(written):
+                    save_json(file_path, original)
+                raise
+        
+        if stored is None:
+            notify_change(ORDERS_FILE, "add", order)
+        if payment is not None:
+            notify_change(PAYMENTS_FILE, "add", payment)
+        return order, payment
+    
+    @staticmethod
+    def get_payment_index():
+        return get_index(PAYMENTS_FILE, PaymentIndex)
+    
+    @staticmethod
+    def get_payment(payment_id):
+        return Database.get_payment_index().by_payment_id.get(payment_id)
+    
     @staticmethod
     def update_payment_status(payment_id, status):
-        payments = Database.get_payments()
-        for payment in payments:
-            if payment.get("payment_id") == payment_id:
-                payment["status"] = status
-                payment["updated_at"] = datetime.now().isoformat()
-                save_json(PAYMENTS_FILE, payments)
-                return payment
-        return None
+        with collection_lock(PAYMENTS_FILE):
+            index = Database.get_payment_index()
+            payment = index.by_payment_id.get(payment_id)
+            if payment is None:
+                return None
+            
+            previous = dict(payment)
+            payment["status"] = status
+            payment["updated_at"] = datetime.now().isoformat()
+            save_json(PAYMENTS_FILE, Database.get_payments())
+        notify_change(PAYMENTS_FILE, "update", payment, previous)
+        return payment
     
     # Поставщики
     @staticmethod
@@ -405,35 +1218,24 @@ class Database:
         current_settings.update(settings_data)
         current_settings["updated_at"] = datetime.now().isoformat()
         save_json(SITE_SETTINGS_FILE, current_settings)
+        notify_change(SITE_SETTINGS_FILE, "update", current_settings)
         return current_settings
     
     # Расширенные методы для пользователей
     @staticmethod
     def get_user_by_phone(phone):
         """Получить пользователя по номеру телефона"""
-        users = Database.get_users()
-        for user in users:
-            if user.get("phone") == phone:
-                return user
-        return None
+        return Database.get_user_index().by_phone.get(phone)
     
     @staticmethod
     def get_user_by_email(email):
         """Получить пользователя по email"""
-        users = Database.get_users()
-        for user in users:
-            if user.get("email") == email:
-                return user
-        return None
+        return Database.get_user_index().by_email.get(email)
     
     @staticmethod
     def get_user_by_id(user_id):
         """Получить пользователя по ID"""
-        users = Database.get_users()
-        for user in users:
-            if user.get("id") == user_id:
-                return user
-        return None
+        return Database.get_user_index().by_id.get(user_id)
     
     @staticmethod
     def update_user(user_id, update_data):
@@ -441,8 +1243,10 @@ class Database:
         users = Database.get_users()
         for i, user in enumerate(users):
             if user.get("id") == user_id:
+                previous = dict(user)
                 users[i].update(update_data)
                 save_json(USERS_FILE, users)
+                notify_change(USERS_FILE, "update", users[i], previous)
                 return users[i]
         return None
     
@@ -454,6 +1258,7 @@ class Database:
             if user.get("id") == user_id:
                 users.pop(i)
                 save_json(USERS_FILE, users)
+                notify_change(USERS_FILE, "delete", user)
                 return True
         return False
     
@@ -473,6 +1278,7 @@ class Database:
         }
         pages.append(page)
         save_json(PAGES_FILE, pages)
+        notify_change(PAGES_FILE, "add", page)
         return page
     
     @staticmethod
@@ -490,8 +1296,10 @@ class Database:
         pages = Database.get_pages()
         for i, page in enumerate(pages):
             if page.get("id") == page_id:
+                previous = dict(page)
                 pages[i].update(update_data)
                 save_json(PAGES_FILE, pages)
+                notify_change(PAGES_FILE, "update", pages[i], previous)
                 return pages[i]
         return None
     
@@ -503,6 +1311,7 @@ class Database:
             if page.get("id") == page_id:
                 pages.pop(i)
                 save_json(PAGES_FILE, pages)
+                notify_change(PAGES_FILE, "delete", page)
                 return True
         return False
     
@@ -515,11 +1324,54 @@ class Database:
     @staticmethod
     def add_media_file(file_data):
         """Добавить медиафайл"""
-        files = Database.get_media_files()
-        files.append(file_data)
-        save_json(MEDIA_FILE, files)
+        with collection_lock(MEDIA_FILE):
+            files = Database.get_media_files()
+            files.append(file_data)
+            save_json(MEDIA_FILE, files)
         return file_data
     
+    @staticmethod
+    def get_media_index():
+        return get_index(MEDIA_FILE, MediaIndex)
+    
+    @staticmethod
+    def get_media_by_sha256(sha256):
+        """Получить медиафайл по хешу содержимого"""
+        return Database.get_media_index().by_sha256.get(sha256)
+    
+    @staticmethod
+    def add_media_reference(media_id):
+        """Увеличить счетчик ссылок на медиафайл (повторная загрузка);
+        None - записи уже нет"""
+        with collection_lock(MEDIA_FILE):
+            files = Database.get_media_files()
+            for file_info in files:
+                if file_info.get("id") == media_id:
+                    file_info["ref_count"] = file_info.get("ref_count", 1) + 1
+                    file_info["last_uploaded_at"] = datetime.now().isoformat()
+                    save_json(MEDIA_FILE, files)
+                    return file_info
+        return None
+    
+    @staticmethod
+    def release_media_file(media_id):
+        """Уменьшить счетчик ссылок; запись удаляется, когда ссылок не осталось.
+        Возвращает (найден ли файл, оставшаяся запись или None)"""
+        with collection_lock(MEDIA_FILE):
+            files = Database.get_media_files()
+            for i, file_info in enumerate(files):
+                if file_info.get("id") == media_id:
+                    ref_count = file_info.get("ref_count", 1) - 1
+                    if ref_count > 0:
+                        file_info["ref_count"] = ref_count
+                        remaining = file_info
+                    else:
+                        files.pop(i)
+                        remaining = None
+                    save_json(MEDIA_FILE, files)
+                    return True, remaining
+        return False, None
+    
     # 1C интеграция
     @staticmethod
     def get_1c_settings():
@@ -562,7 +1414,22 @@ class Database:
     def save_seo_settings(settings_data):
         """Сохранить SEO настройки"""
         save_json(SEO_SETTINGS_FILE, settings_data)
+        notify_change(SEO_SETTINGS_FILE, "update", settings_data)
         return settings_data
+    
+    # Прогрев
+    @staticmethod
+    def warm_up():
+        """Загрузить все коллекции в кэш и построить индексы"""
+        for file_path in (PRODUCTS_FILE, USERS_FILE, ORDERS_FILE, SETTINGS_FILE,
+                          PAYMENTS_FILE, SUPPLIERS_FILE, PAYMENT_SETTINGS_FILE, ABCP_SETTINGS_FILE,
+                          SITE_SETTINGS_FILE, PAGES_FILE, MEDIA_FILE, SEO_SETTINGS_FILE):
+            load_json(file_path)
+        
+        return {
+            "products": len(Database.get_product_index().by_id),
+            "users": len(Database.get_user_index().by_id)
+        }
 
 # Initialize database on import
 init_database()
\ No newline at end of file
@@ -3,14 +3,15 @@ NEXX Store - Полноценный Backend API
 Комплексный интернет-магазин со всеми интеграциями
 """
 
-from fastapi import FastAPI, HTTPException, APIRouter, Query, BackgroundTasks, File, UploadFile, Form, Depends, Request
+from fastapi import FastAPI, HTTPException, APIRouter, Query, BackgroundTasks, File, UploadFile, Form, Depends, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, Field, validator
 from typing import List, Optional, Dict, Any, Union
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import bcrypt
 import logging
 import os
@@ -23,9 +24,14 @@ import io
 import json
 import base64
 import secrets
+from contextlib import asynccontextmanager
 from pathlib import Path
 from dotenv import load_dotenv
 
+from services.serialization import DefaultResponse
+from services.compression import CompressionMiddleware
+from services.media_service import UploadSizeLimitMiddleware
+
 # Загружаем переменные окружения
 load_dotenv()
 
@@ -58,8 +64,41 @@ except ImportError:
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Прогрев воркера при старте и закрытие внешних клиентов при остановке"""
+    from services.warmup_service import get_warmup_service
+    
+    from services.inventory_service import run_reservation_sweeper
+    from services.webhook_queue import get_webhook_queue
+    from services.payment_reconciler import get_payment_reconciler
+    from services.cart_service import run_cart_sweeper
+    from services.feed_service import get_feed_exporter
+    
+    warmup_task = get_warmup_service().start()
+    background_tasks = [
+        asyncio.create_task(run_reservation_sweeper()),
+        asyncio.create_task(run_cart_sweeper()),
+        asyncio.create_task(get_feed_exporter().run()),
+        asyncio.create_task(get_payment_reconciler().run())
+    ]
+    background_tasks.extend(await get_webhook_queue().start())
+    yield
+    
+    for task in [warmup_task, *background_tasks]:
+        if not task.done():
+            task.cancel()
+    
+    from services.image_service import get_image_service
+    get_image_service().shutdown()
+    
+    from services import abcp_service, yoomoney_service
+    for service in (abcp_service.abcp_service, yoomoney_service.yoomoney_service):
+        if service is not None:
+            await service.close()
+
 # Create FastAPI app
-app = FastAPI(title="NEXX E-Commerce API")
+app = FastAPI(title="NEXX E-Commerce API", lifespan=lifespan, default_response_class=DefaultResponse)
 
 # CORS middleware
 app.add_middleware(
@@ -70,6 +109,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Сжатие ответов (gzip/brotli); кэшированные ответы уже сжаты заранее
+app.add_middleware(CompressionMiddleware)
+
+# Лимит размера загрузок до того, как Starlette запишет тело на диск
+app.add_middleware(UploadSizeLimitMiddleware)
+
 # API Router with /api prefix
 api_router = APIRouter(prefix="/api")
 
@@ -85,6 +130,7 @@ class StatusCheckCreate(BaseModel):
 class LoginRequest(BaseModel):
     username: str
     password: str
+    guest_cart: Optional[str] = None
 
 class RegisterRequest(BaseModel):
     username: str
@@ -121,6 +167,22 @@ class CartAddRequest(BaseModel):
     product_id: str
     quantity: int = 1
 
+# Guest Cart Models
+class ProductBatchRequest(BaseModel):
+    ids: List[str]
+    view: Optional[str] = None
+    fields: Optional[str] = None
+
+class GuestCartRequest(BaseModel):
+    token: Optional[str] = None
+
+class GuestCartAddRequest(GuestCartRequest):
+    product_id: str
+    quantity: int = 1
+
+class GuestCartUpdateRequest(GuestCartRequest):
+    quantity: int
+
 class OrderCreate(BaseModel):
     user_name: str
     user_email: str
@@ -128,6 +190,10 @@ class OrderCreate(BaseModel):
     delivery_address: str
     notes: Optional[str] = None
 
+class CheckoutCreate(OrderCreate):
+    pay_online: bool = True
+    return_url: Optional[str] = None
+
 # Новые модели для полноценного интернет-магазина
 class PaymentSettings(BaseModel):
     provider: str  # yoomoney, sberbank, tinkoff
@@ -178,6 +244,7 @@ class SMSLoginRequest(BaseModel):
 class SMSVerifyRequest(BaseModel):
     phone: str
     code: str
+    guest_cart: Optional[str] = None
 
 class SMSSettingsRequest(BaseModel):
     provider: str  # "smsc", "smsru", "unifone"
@@ -278,6 +345,35 @@ class SEOSettings(BaseModel):
     structured_data: bool = True
     open_graph: bool = True
 
+# Inventory Models
+class LowStockThresholds(BaseModel):
+    default: int = 5
+    categories: Dict[str, int] = {}
+
+async def run_idempotent(request: Request, scope: str, idempotency_key: Optional[str], payload: Any, handler):
+    """Выполнение обработчика с учетом заголовка Idempotency-Key"""
+    if not idempotency_key:
+        return await handler()
+    
+    from services.idempotency_service import (
+        get_idempotency_service, IdempotencyConflictError, IdempotencyInProgressError
+    )
+    
+    idempotency = get_idempotency_service()
+    fingerprint = idempotency.fingerprint(request.method, request.url.path, payload)
+    try:
+        status_code, body, replayed = await idempotency.execute(scope, idempotency_key, fingerprint, handler)
+    except IdempotencyConflictError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except IdempotencyInProgressError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    return JSONResponse(
+        status_code=status_code,
+        content=body,
+        headers={"Idempotent-Replayed": "true" if replayed else "false"}
+    )
+
 # Routes
 @api_router.get("/")
 def root():
@@ -292,6 +388,23 @@ def create_status_check(input: StatusCheckCreate):
 def get_status_checks():
     return []
 
+# Health Routes
+@api_router.get("/health/live")
+def health_live():
+    """Liveness: процесс жив и обрабатывает запросы"""
+    return {"status": "alive"}
+
+@api_router.get("/health/ready")
+def health_ready():
+    """Readiness: прогрев завершен, воркер готов принимать трафик"""
+    from services.warmup_service import get_warmup_service
+    
+    warmup = get_warmup_service()
+    status = warmup.get_status()
+    if not warmup.ready:
+        return JSONResponse(status_code=503, content={"status": "warming_up", **status})
+    return {"status": "ready", **status}
+
 # Authentication Routes
 @api_router.post("/auth/login")
 def login_user(login_data: LoginRequest):
@@ -315,6 +428,7 @@ def login_user(login_data: LoginRequest):
     return {
         "success": True,
         "user": user_response,
+        "cart_merged": merge_guest_cart(user["id"], login_data.guest_cart),
         "message": "Login successful"
     }
 
@@ -414,6 +528,7 @@ def verify_sms_code(request: SMSVerifyRequest):
     return {
         "success": True,
         "user": user_response,
+        "cart_merged": merge_guest_cart(user["id"], request.guest_cart),
         "message": message,
         "auth_method": "sms"
     }
@@ -439,34 +554,120 @@ def create_product(product_data: ProductCreate):
     product = Database.add_product(product_data.dict())
     return product
 
+def projection_fields(views: Dict[str, Any], view: Optional[str], fields: Optional[str], allowed=None):
+    """Поля проекции из ?view= / ?fields=; неизвестное представление - 400,
+    неизвестные поля - 422"""
+    from database import resolve_fields, UnknownFieldsError
+    
+    try:
+        return resolve_fields(views, view, fields, allowed)
+    except UnknownFieldsError as e:
+        raise HTTPException(status_code=422, detail={"message": str(e), "fields": e.fields})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @api_router.get("/products")
 def get_products(
+    request: Request,
+    response: Response,
     brand: Optional[str] = Query(None),
     category: Optional[str] = Query(None),
-    search: Optional[str] = Query(None)
+    search: Optional[str] = Query(None),
+    view: Optional[str] = Query(None, description="card, full или admin"),
+    fields: Optional[str] = Query(None, description="Список полей через запятую")
 ):
-    products = Database.get_products()
-    
-    # Filter products
-    if brand:
-        products = [p for p in products if p.get("brand", "").lower() == brand.lower()]
-    if category:
-        products = [p for p in products if p.get("category", "").lower() == category.lower()]
-    if search:
-        search_lower = search.lower()
-        products = [p for p in products if 
-                   search_lower in p.get("name", "").lower() or 
-                   search_lower in p.get("description", "").lower() or
-                   search_lower in p.get("part_number", "").lower()]
-    
-    return products
+    from database import PRODUCTS_FILE, PRODUCT_VIEWS, PRODUCT_FIELDS
+    from services.http_cache import conditional
+    from services.response_cache import get_response_cache
+    from services.serialization import get_product_fragments
+    
+    selected = projection_fields(PRODUCT_VIEWS, view, fields, PRODUCT_FIELDS)
+    not_modified = conditional(request, response, "products", PRODUCTS_FILE)
+    if not_modified:
+        return not_modified
+    
+    def build():
+        # Filter products
+        index = Database.get_product_index()
+        products = index.filter(brand=brand, category=category, search=search)
+        return get_product_fragments().encode_list(index.project(products, selected), selected)
+    
+    return get_response_cache().respond(request, response, ("products",), build)
+
+MAX_BATCH_PRODUCTS = 500
+
+def product_batch_body(product_ids: List[str], selected) -> bytes:
+    """Ответ пакетного запроса: товары в порядке id и ненайденные id.
+    Товары склеиваются из закэшированных фрагментов"""
+    from services.serialization import dumps, get_product_fragments
+    
+    if not product_ids:
+        raise HTTPException(status_code=400, detail="Не указаны id товаров")
+    if len(product_ids) > MAX_BATCH_PRODUCTS:
+        raise HTTPException(status_code=400, detail=f"Не более {MAX_BATCH_PRODUCTS} товаров за запрос")
+    
+    index = Database.get_product_index()
+    products, missing = index.get_many(product_ids)
+    data = get_product_fragments().encode_list(index.project(products, selected), selected)
+    return b'{"success":true,"data":' + data + b',"missing":' + dumps(missing) + b"}"
+
+@api_router.get("/products/batch")
+def get_products_batch(
+    request: Request,
+    response: Response,
+    ids: str = Query(..., description="Список id через запятую"),
+    view: Optional[str] = Query(None, description="card, full или admin"),
+    fields: Optional[str] = Query(None, description="Список полей через запятую")
+):
+    """Товары по списку id (корзина, избранное, сравнение)"""
+    from database import PRODUCTS_FILE, PRODUCT_VIEWS, PRODUCT_FIELDS
+    from services.http_cache import conditional
+    from services.response_cache import get_response_cache
+    
+    selected = projection_fields(PRODUCT_VIEWS, view, fields, PRODUCT_FIELDS)
+    product_ids = [product_id.strip() for product_id in ids.split(",") if product_id.strip()]
+    not_modified = conditional(request, response, "products", PRODUCTS_FILE)
+    if not_modified:
+        return not_modified
+    
+    return get_response_cache().respond(
+        request, response, ("products",),
+        lambda: product_batch_body(product_ids, selected)
+    )
+
+@api_router.post("/products/batch")
+def post_products_batch(batch: ProductBatchRequest):
+    """Товары по списку id в теле запроса (для длинных списков)"""
+    from database import PRODUCT_VIEWS, PRODUCT_FIELDS
+    
+    selected = projection_fields(PRODUCT_VIEWS, batch.view, batch.fields, PRODUCT_FIELDS)
+    return Response(product_batch_body(batch.ids, selected), media_type="application/json")
 
 @api_router.get("/products/{product_id}")
-def get_product(product_id: str):
-    product = Database.get_product(product_id)
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    return product
+def get_product(
+    product_id: str,
+    request: Request,
+    response: Response,
+    view: Optional[str] = Query(None, description="card, full или admin"),
+    fields: Optional[str] = Query(None, description="Список полей через запятую")
+):
+    from database import PRODUCTS_FILE, PRODUCT_VIEWS, PRODUCT_FIELDS, project_record
+    from services.http_cache import conditional
+    from services.response_cache import get_response_cache
+    from services.serialization import get_product_fragments
+    
+    selected = projection_fields(PRODUCT_VIEWS, view, fields, PRODUCT_FIELDS)
+    not_modified = conditional(request, response, "product", PRODUCTS_FILE)
+    if not_modified:
+        return not_modified
+    
+    def build():
+        product = Database.get_product(product_id)
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        return get_product_fragments().encode_one(project_record(product, selected), selected)
+    
+    return get_response_cache().respond(request, response, ("products",), build)
 
 @api_router.put("/products/{product_id}")
 def update_product(product_id: str, product_data: ProductUpdate):
@@ -493,6 +694,12 @@ def get_cart(user_id: str):
     cart = Database.get_cart(user_id)
     return cart
 
+@api_router.get("/cart/{user_id}/view")
+def get_cart_view(user_id: str):
+    """Корзина с актуальными ценами, итогами и отметками об изменении цен"""
+    from services.cart_service import get_cart_view_engine
+    return {"success": True, "data": get_cart_view_engine().view(user_id)}
+
 @api_router.put("/cart/{user_id}/items/{item_id}")
 def update_cart_item(user_id: str, item_id: str, request: dict):
     quantity = request.get("quantity", 1)
@@ -509,28 +716,114 @@ def clear_cart(user_id: str):
     cart = Database.clear_cart(user_id)
     return {"message": "Cart cleared", "cart": cart}
 
+# Guest Cart Routes
+def merge_guest_cart(user_id: str, token: Optional[str]) -> int:
+    """Перенос корзины гостя при входе; возвращает число перенесенных строк"""
+    if not token:
+        return 0
+    from services.guest_cart_service import get_guest_cart_service
+    return get_guest_cart_service().merge(user_id, token)
+
+def guest_cart_response(token: str):
+    from services.guest_cart_service import get_guest_cart_service
+    return {"success": True, "data": {"token": token, "cart": get_guest_cart_service().view(token)}}
+
+@api_router.post("/guest-cart/view")
+def view_guest_cart(request: GuestCartRequest):
+    """Корзина гостя по токену (без обращения к хранилищу корзин)"""
+    from services.guest_cart_service import GuestCartError
+    
+    try:
+        return guest_cart_response(request.token or "")
+    except GuestCartError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.post("/guest-cart/items")
+def add_to_guest_cart(request: GuestCartAddRequest):
+    """Добавление товара в корзину гостя; возвращает новый токен"""
+    from services.guest_cart_service import get_guest_cart_service, GuestCartError
+    
+    try:
+        token = get_guest_cart_service().set_quantity(request.token, request.product_id, request.quantity, add=True)
+        return guest_cart_response(token)
+    except GuestCartError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.put("/guest-cart/items/{product_id}")
+def update_guest_cart_item(product_id: str, request: GuestCartUpdateRequest):
+    """Изменение количества товара в корзине гостя (0 - удалить)"""
+    from services.guest_cart_service import get_guest_cart_service, GuestCartError
+    
+    try:
+        token = get_guest_cart_service().set_quantity(request.token, product_id, request.quantity)
+        return guest_cart_response(token)
+    except GuestCartError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 # Orders Routes
 @api_router.post("/orders/{user_id}")
-def create_order(user_id: str, order_data: OrderCreate):
-    cart = Database.get_cart(user_id)
-    if not cart:
-        raise HTTPException(status_code=400, detail="Cart is empty")
-    
-    order = Database.add_order({
-        "user_id": user_id,
-        "items": cart,
-        "total_amount": sum(item["product_price"] * item["quantity"] for item in cart),
-        **order_data.dict()
-    })
+async def create_order(
+    user_id: str,
+    order_data: OrderCreate,
+    request: Request,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    async def handler():
+        result = await run_checkout(user_id, order_data.dict())
+        return result["order"]
+    
+    return await run_idempotent(request, f"orders:{user_id}", idempotency_key, order_data.dict(), handler)
+
+@api_router.post("/checkout/{user_id}")
+async def checkout(
+    user_id: str,
+    checkout_data: CheckoutCreate,
+    request: Request,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    """Оформление заказа с резервом и созданием платежа за один запрос"""
+    order_data = checkout_data.dict(exclude={"pay_online", "return_url"})
+    payment_options = None
+    if checkout_data.pay_online:
+        if not checkout_data.return_url:
+            raise HTTPException(status_code=400, detail="return_url is required for online payment")
+        from services.idempotency_service import IdempotencyService
+        
+        payment_options = {
+            "return_url": checkout_data.return_url,
+            "idempotency_key": IdempotencyService.provider_key(f"checkout:{user_id}", idempotency_key)
+            if idempotency_key else None
+        }
     
-    # Clear cart after creating order
-    Database.clear_cart(user_id)
+    async def handler():
+        result = await run_checkout(user_id, order_data, payment_options)
+        return {"success": True, "data": result}
+    
+    return await run_idempotent(request, f"checkout:{user_id}", idempotency_key, checkout_data.dict(), handler)
+
+async def run_checkout(user_id: str, order_data: Dict[str, Any], payment_options: Optional[Dict[str, Any]] = None):
+    from services.checkout_service import get_checkout_pipeline, CheckoutError
     
-    return order
+    try:
+        return await get_checkout_pipeline().run(user_id, order_data, payment_options)
+    except CheckoutError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+@api_router.get("/admin/checkout/metrics")
+def get_checkout_metrics():
+    """Время выполнения этапов оформления заказа"""
+    from services.checkout_service import get_checkout_pipeline
+    return {"success": True, "data": get_checkout_pipeline().get_metrics()}
 
 @api_router.get("/orders")
-def get_orders():
-    return Database.get_orders()
+def get_orders(fields: Optional[str] = Query(None, description="Список полей через запятую")):
+    from database import ORDER_FIELDS, project_record
+    
+    orders = Database.get_orders()
+    selected = projection_fields({}, None, fields, ORDER_FIELDS)
+    if selected is None:
+        return orders
+    return [project_record(order, selected) for order in orders]
 
 # Платежные системы
 @api_router.post("/payments/settings")
@@ -546,8 +839,26 @@ def get_payment_settings():
     return {"success": True, "data": settings}
 
 @api_router.post("/payments/create")
-async def create_payment(payment_data: PaymentCreate):
+async def create_payment(
+    payment_data: PaymentCreate,
+    request: Request,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """Создание платежа"""
+    from services.idempotency_service import IdempotencyService
+    
+    # Ключи идемпотентности живут в области владельца заказа, а не общей для всех
+    order = Database.get_order(payment_data.order_id)
+    owner = (order or {}).get("user_id") or f"order-{payment_data.order_id}"
+    scope = f"payments:{owner}"
+    provider_key = IdempotencyService.provider_key(scope, idempotency_key) if idempotency_key else None
+    
+    async def handler():
+        return await process_payment(payment_data, provider_key)
+    
+    return await run_idempotent(request, scope, idempotency_key, payment_data.dict(), handler)
+
+async def process_payment(payment_data: PaymentCreate, idempotency_key: Optional[str] = None):
     try:
         from services.yoomoney_service import get_yoomoney_service
         
@@ -556,7 +867,8 @@ async def create_payment(payment_data: PaymentCreate):
             amount=payment_data.amount,
             description=payment_data.description,
             return_url=payment_data.return_url,
-            metadata={"order_id": payment_data.order_id}
+            metadata={"order_id": payment_data.order_id},
+            idempotency_key=idempotency_key
         )
         
         # Сохраняем платеж в базу данных
@@ -583,22 +895,105 @@ async def create_payment(payment_data: PaymentCreate):
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.post("/webhooks/yoomoney")
-async def yoomoney_webhook(request: dict):
-    """Webhook для уведомлений от YooMoney"""
+async def yoomoney_webhook(request: Request):
+    """Webhook для уведомлений от YooMoney: проверка, запись в очередь и быстрый ответ"""
+    from services import yoomoney_service
+    from services.webhook_queue import get_webhook_queue
+    
+    body = await request.body()
     try:
-        from services.yoomoney_service import get_yoomoney_service
+        webhook_data = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    
+    yoomoney = yoomoney_service.yoomoney_service
+    signature = request.headers.get("X-Webhook-Signature")
+    if signature:
+        if yoomoney is None or not yoomoney.verify_webhook(body, signature):
+            raise HTTPException(status_code=401, detail="Invalid webhook signature")
+    elif yoomoney is None or os.environ.get("YOOMONEY_WEBHOOK_REQUIRE_SIGNATURE", "1") != "0":
+        # Без подписи уведомление принимается только если это явно разрешено
+        raise HTTPException(status_code=401, detail="Webhook signature required")
+    
+    if not isinstance(webhook_data, dict) or not (webhook_data.get("object") or {}).get("id"):
+        raise HTTPException(status_code=400, detail="Webhook processing failed")
+    
+    if not signature:
+        # Содержимому неподписанного уведомления не доверяем: в очередь идет
+        # только id платежа, статус воркер очереди возьмет из API
+        from services.webhook_queue import STATUS_EVENTS
         
-        yoomoney = get_yoomoney_service()
-        success = await yoomoney.process_webhook(request)
-        
-        if success:
-            return {"status": "ok"}
-        else:
-            raise HTTPException(status_code=400, detail="Webhook processing failed")
-            
-    except Exception as e:
-        logger.error(f"Webhook processing error: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        if webhook_data.get("event") not in STATUS_EVENTS.values():
+            return {"status": "ignored"}
+        webhook_data = {
+            "event": webhook_data.get("event"),
+            "object": {"id": webhook_data["object"]["id"]},
+            "unverified": True
+        }
+    
+    queued = await get_webhook_queue().enqueue(webhook_data)
+    return {"status": "ok" if queued else "duplicate"}
+
+@api_router.get("/admin/webhooks/status")
+def get_webhook_queue_status():
+    """Состояние очереди webhook"""
+    from services.webhook_queue import get_webhook_queue
+    return {"success": True, "data": get_webhook_queue().get_status()}
+
+@api_router.get("/admin/webhooks/dead-letter")
+def get_webhook_dead_letters():
+    """Уведомления, которые не удалось обработать"""
+    from services.webhook_queue import get_webhook_queue
+    return {"success": True, "data": get_webhook_queue().get_dead_letters()}
+
+@api_router.post("/admin/webhooks/dead-letter/{letter_id}/retry")
+async def retry_webhook_dead_letter(letter_id: str):
+    """Повторная обработка уведомления из dead-letter"""
+    from services.webhook_queue import get_webhook_queue
+    
+    if not await get_webhook_queue().retry_dead_letter(letter_id):
+        raise HTTPException(status_code=404, detail="Уведомление не найдено")
+    return {"success": True}
+
+@api_router.get("/admin/payments/reconciliation")
+def get_payment_reconciliation_status():
+    """Метрики сверки статусов платежей"""
+    from services.payment_reconciler import get_payment_reconciler
+    return {"success": True, "data": get_payment_reconciler().get_metrics()}
+
+@api_router.post("/admin/payments/reconciliation/run")
+async def run_payment_reconciliation():
+    """Внеочередной цикл сверки статусов платежей"""
+    from services.payment_reconciler import get_payment_reconciler
+    
+    await get_payment_reconciler().tick()
+    return {"success": True, "data": get_payment_reconciler().get_metrics()}
+
+@api_router.get("/admin/feeds")
+def get_feeds_status():
+    """Состояние товарных фидов"""
+    from services.feed_service import get_feed_exporter
+    return {"success": True, "data": get_feed_exporter().status}
+
+@api_router.post("/admin/feeds/rebuild")
+async def rebuild_feeds(force: bool = False):
+    """Внеочередная пересборка товарных фидов"""
+    from services.feed_service import get_feed_exporter
+    
+    status = await asyncio.to_thread(get_feed_exporter().rebuild, force)
+    return {"success": True, "data": status}
+
+@api_router.get("/admin/cache/stats")
+def get_response_cache_stats():
+    """Статистика кэша ответов"""
+    from services.response_cache import get_response_cache
+    return {"success": True, "data": get_response_cache().get_stats()}
+
+@api_router.get("/admin/compression/stats")
+def get_compression_stats():
+    """Статистика сжатия ответов"""
+    from services.compression import get_compression_stats
+    return {"success": True, "data": get_compression_stats()}
 
 # Поставщики ABCP
 @api_router.post("/suppliers/abcp/settings")
@@ -683,39 +1078,30 @@ def update_site_settings(settings: SiteSettings):
     return {"success": True, "data": site_settings}
 
 @api_router.get("/settings/site")
-def get_site_settings():
+def get_site_settings(request: Request, response: Response):
     """Получение настроек сайта"""
-    settings = Database.get_site_settings()
-    return {"success": True, "data": settings}
+    from database import SITE_SETTINGS_FILE
+    from services.http_cache import conditional
+    
+    not_modified = conditional(request, response, "site_settings", SITE_SETTINGS_FILE)
+    if not_modified:
+        return not_modified
+    
+    from services.response_cache import get_response_cache
+    
+    return get_response_cache().respond(
+        request, response, ("site_settings",),
+        lambda: {"success": True, "data": Database.get_site_settings()}
+    )
 
 # Аналитика и статистика
 @api_router.get("/analytics/dashboard")
 def get_dashboard_analytics():
     """Получение данных для дашборда"""
     try:
-        analytics = {
-            "orders": {
-                "total": len(Database.get_orders()),
-                "today": 0,  # TODO: подсчет заказов за сегодня
-                "pending": 0,  # TODO: подсчет ожидающих заказов
-                "completed": 0  # TODO: подсчет выполненных заказов
-            },
-            "revenue": {
-                "total": 0,  # TODO: подсчет общей выручки
-                "today": 0,  # TODO: выручка за сегодня
-                "this_month": 0  # TODO: выручка за месяц
-            },
-            "products": {
-                "total": len(Database.get_products()),
-                "low_stock": 0,  # TODO: товары с низким остатком
-                "out_of_stock": 0  # TODO: товары без остатка
-            },
-            "users": {
-                "total": len(Database.get_users()),
-                "new_today": 0,  # TODO: новые пользователи за сегодня
-                "active": 0  # TODO: активные пользователи
-            }
-        }
+        from services.analytics_service import get_dashboard_aggregates
+        
+        analytics = get_dashboard_aggregates().get_dashboard()
         
         return {"success": True, "data": analytics}
         
@@ -723,6 +1109,63 @@ def get_dashboard_analytics():
         logger.error(f"Analytics error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.get("/admin/reports/sales")
+def get_sales_report(
+    start: Optional[str] = Query(None, description="Начало периода, YYYY-MM-DD"),
+    end: Optional[str] = Query(None, description="Конец периода включительно, YYYY-MM-DD"),
+    interval: str = Query("day", description="day, week или month"),
+    group_by: str = Query("none", description="none, brand, category или product")
+):
+    """Отчет по продажам: выручка и количество по периодам"""
+    from services.reports_service import get_sales_report_engine
+    
+    try:
+        report = get_sales_report_engine().query(start=start, end=end, interval=interval, group_by=group_by)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return {"success": True, "data": report}
+
+@api_router.get("/admin/inventory/low-stock")
+def get_low_stock_products(
+    category: Optional[str] = Query(None),
+    include_out_of_stock: bool = Query(False),
+    only_out_of_stock: bool = Query(False),
+    page: int = Query(1, ge=1),
+    per_page: int = Query(50, ge=1, le=500)
+):
+    """Товары с низким остатком (по возрастанию остатка)"""
+    from services.inventory_service import get_stock_index
+    
+    result = get_stock_index().query(
+        category=category,
+        include_out_of_stock=include_out_of_stock,
+        only_out_of_stock=only_out_of_stock,
+        page=page,
+        per_page=per_page
+    )
+    return {"success": True, "data": result}
+
+@api_router.get("/admin/inventory/thresholds")
+def get_low_stock_thresholds():
+    """Пороги низкого остатка по категориям"""
+    from services.inventory_service import get_stock_index
+    
+    thresholds = dict(get_stock_index().thresholds)
+    default = thresholds.pop("default")
+    return {"success": True, "data": {"default": default, "categories": thresholds}}
+
+@api_router.put("/admin/inventory/thresholds")
+def update_low_stock_thresholds(thresholds: LowStockThresholds):
+    """Обновление порогов низкого остатка"""
+    from services.inventory_service import get_stock_index
+    
+    Database.update_settings({
+        "low_stock_thresholds": {"default": thresholds.default, **thresholds.categories}
+    })
+    get_stock_index().load_thresholds()
+    return {"success": True, "data": thresholds.dict()}
+
 def get_mock_supplier_offers(product):
     """Мок-данные для предложений поставщиков"""
     return {
@@ -763,10 +1206,16 @@ def get_all_users(
     role: Optional[str] = Query(None),
     user_type: Optional[str] = Query(None),
     active: Optional[bool] = Query(None),
-    search: Optional[str] = Query(None)
+    search: Optional[str] = Query(None),
+    view: Optional[str] = Query(None, description="card, full или admin"),
+    fields: Optional[str] = Query(None, description="Список полей через запятую")
 ):
     """Получение всех пользователей с фильтрами"""
-    users = Database.get_users()
+    from database import USER_VIEWS, USER_FIELDS
+    
+    selected = projection_fields(USER_VIEWS, view, fields, USER_FIELDS)
+    index = Database.get_user_index()
+    users = index.users
     
     # Применяем фильтры
     if role:
@@ -783,14 +1232,8 @@ def get_all_users(
                 search_lower in u.get("email", "").lower() or
                 search_lower in u.get("phone", "").lower()]
     
-    # Убираем пароли из ответа
-    safe_users = []
-    for user in users:
-        safe_user = user.copy()
-        safe_user.pop("password_hash", None)
-        safe_users.append(safe_user)
-    
-    return {"success": True, "data": safe_users}
+    # Проекция без password_hash, кэшируется вместе с индексом
+    return {"success": True, "data": index.project(users, selected)}
 
 @api_router.post("/admin/users")
 def create_user_admin(user_data: UserCreate):
@@ -818,10 +1261,8 @@ def create_user_admin(user_data: UserCreate):
     user = Database.add_user(user_dict)
     
     # Убираем пароль из ответа
-    safe_user = user.copy()
-    safe_user.pop("password_hash", None)
-    
-    return {"success": True, "data": safe_user}
+    from database import project_record
+    return {"success": True, "data": project_record(user, None)}
 
 @api_router.put("/admin/users/{user_id}")
 def update_user_admin(user_id: str, user_data: UserUpdate):
@@ -840,10 +1281,8 @@ def update_user_admin(user_id: str, user_data: UserUpdate):
         raise HTTPException(status_code=404, detail="Пользователь не найден")
     
     # Убираем пароль из ответа
-    safe_user = user.copy()
-    safe_user.pop("password_hash", None)
-    
-    return {"success": True, "data": safe_user}
+    from database import project_record
+    return {"success": True, "data": project_record(user, None)}
 
 @api_router.delete("/admin/users/{user_id}")
 def delete_user_admin(user_id: str):
@@ -862,30 +1301,45 @@ def get_user_admin(user_id: str):
         raise HTTPException(status_code=404, detail="Пользователь не найден")
     
     # Убираем пароль из ответа
-    safe_user = user.copy()
-    safe_user.pop("password_hash", None)
-    
-    return {"success": True, "data": safe_user}
+    from database import project_record
+    return {"success": True, "data": project_record(user, None)}
 
 # Content Management Routes
 @api_router.get("/pages")
-def get_pages(active: Optional[bool] = Query(None)):
+def get_pages(request: Request, active: Optional[bool] = Query(None)):
     """Получение всех страниц"""
-    pages = Database.get_pages()
+    from services.response_cache import get_response_cache
     
-    if active is not None:
-        pages = [p for p in pages if p.get("active", True) == active]
+    def build():
+        pages = Database.get_pages()
+        
+        if active is not None:
+            pages = [p for p in pages if p.get("active", True) == active]
+        
+        return {"success": True, "data": pages}
     
-    return {"success": True, "data": pages}
+    return get_response_cache().respond(request, None, ("pages",), build)
 
 @api_router.get("/pages/{slug}")
-def get_page_by_slug(slug: str):
+def get_page_by_slug(slug: str, request: Request, response: Response):
     """Получение страницы по slug"""
-    page = Database.get_page_by_slug(slug)
-    if not page:
-        raise HTTPException(status_code=404, detail="Страница не найдена")
+    from database import PAGES_FILE
+    from services.http_cache import conditional
     
-    return {"success": True, "data": page}
+    not_modified = conditional(request, response, "page", PAGES_FILE)
+    if not_modified:
+        return not_modified
+    
+    from services.response_cache import get_response_cache
+    
+    def build():
+        page = Database.get_page_by_slug(slug)
+        if not page:
+            raise HTTPException(status_code=404, detail="Страница не найдена")
+        
+        return {"success": True, "data": page}
+    
+    return get_response_cache().respond(request, response, ("pages",), build)
 
 @api_router.post("/admin/pages")
 def create_page(page_data: PageCreate):
@@ -923,45 +1377,33 @@ def delete_page(page_id: str):
 
 # Media Upload Route
 @api_router.post("/admin/media/upload")
-async def upload_media(file: UploadFile = File(...)):
+async def upload_media(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
     """Загрузка медиафайлов"""
-    # Создаем директорию для загрузок если не существует
-    upload_dir = Path("/app/uploads")
-    upload_dir.mkdir(exist_ok=True)
-    
-    # Генерируем уникальное имя файла
-    file_extension = Path(file.filename).suffix
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    file_path = upload_dir / unique_filename
+    from services.media_service import get_media_service, MediaUploadError
+    from services.image_service import get_image_service
     
-    # Сохраняем файл
     try:
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        # Сохраняем файл и информацию о нем; повторная загрузка того же содержимого
+        # возвращает существующую запись
+        file_info, duplicate = await get_media_service().save_upload(file)
         
-        # Сохраняем информацию о файле
-        file_info = {
-            "id": str(uuid.uuid4()),
-            "original_filename": file.filename,
-            "filename": unique_filename,
-            "file_path": str(file_path),
-            "url": f"/uploads/{unique_filename}",
-            "content_type": file.content_type,
-            "size": len(content),
-            "uploaded_at": datetime.now().isoformat()
-        }
-        
-        Database.add_media_file(file_info)
+        # Уменьшенные копии для каталога готовим в фоне
+        if not duplicate:
+            background_tasks.add_task(get_image_service().generate_presets, file_info)
         
         return {
             "success": True,
-            "data": file_info
+            "data": file_info,
+            "duplicate": duplicate
         }
         
+    except MediaUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
     except Exception as e:
         logger.error(f"File upload error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка загрузки файла: {str(e)}")
+    finally:
+        await file.close()
 
 @api_router.get("/admin/media")
 def get_media_files():
@@ -969,6 +1411,74 @@ def get_media_files():
     files = Database.get_media_files()
     return {"success": True, "data": files}
 
+@api_router.delete("/admin/media/{media_id}")
+def delete_media_file(media_id: str, background_tasks: BackgroundTasks):
+    """Удаление ссылки на медиафайл; файл удаляется, когда ссылок не осталось"""
+    from services.media_service import get_media_service
+    
+    found, remaining = get_media_service().release(media_id)
+    if not found:
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    
+    if remaining is None:
+        background_tasks.add_task(get_media_service().collect_garbage)
+    
+    return {"success": True, "data": remaining}
+
+@api_router.post("/admin/media/gc")
+def collect_media_garbage():
+    """Сборка мусора: удаление файлов без ссылок"""
+    from services.media_service import get_media_service
+    
+    result = get_media_service().collect_garbage()
+    return {"success": True, "data": result}
+
+@api_router.get("/media/{media_id}")
+async def get_media_derivative(
+    media_id: str,
+    request: Request,
+    w: Optional[int] = Query(None, ge=1, le=4096),
+    fmt: Optional[str] = Query(None)
+):
+    """Изображение в нужной ширине и формате (WebP/AVIF); id медиафайла или товара"""
+    from services.image_service import get_image_service, FORMATS
+    from services.media_service import upload_response_headers
+    from services.static_files import RangeFileResponse
+    
+    media_index = Database.get_media_index()
+    media = media_index.by_id.get(media_id)
+    if not media:
+        # Для товара берем его изображение, если оно загружено через медиатеку
+        product = Database.get_product(media_id)
+        image_url = (product or {}).get("image_url") or ""
+        if image_url.startswith("/uploads/"):
+            media = media_index.by_filename.get(image_url[len("/uploads/"):])
+    if not media or not os.path.exists(media.get("file_path", "")):
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    
+    images = get_image_service()
+    headers = {}
+    # Оригинал отдается с типом по содержимому, как и /uploads
+    original_type, original_headers = upload_response_headers(Path(media["file_path"]))
+    if not images.is_processable(media):
+        return RangeFileResponse(media["file_path"], request.headers, media_type=original_type,
+                                 cache_control="public, max-age=86400", headers=original_headers)
+    
+    if fmt in (None, "auto"):
+        headers["Vary"] = "Accept"
+    target_format = images.negotiate_format(fmt, request.headers.get("accept", ""), media)
+    width = images.normalize_width(w)
+    
+    try:
+        path = await images.get_derivative(media, width, target_format)
+    except Exception as e:
+        logger.error(f"Image derivative error: {str(e)}")
+        return RangeFileResponse(media["file_path"], request.headers, media_type=original_type,
+                                 cache_control="public, max-age=86400", headers={**headers, **original_headers})
+    
+    return RangeFileResponse(path, request.headers, media_type=FORMATS[target_format]["content_type"],
+                             cache_control="public, max-age=86400", headers=headers)
+
 # 1C Integration Routes
 @api_router.post("/admin/1c/settings")
 def save_1c_settings(settings: OneCSettings):
@@ -1042,68 +1552,125 @@ def save_seo_settings(settings: SEOSettings):
     return {"success": True, "message": "SEO настройки сохранены"}
 
 @api_router.get("/admin/seo/settings")
-def get_seo_settings():
+def get_seo_settings(request: Request, response: Response):
     """Получение SEO настроек"""
+    from database import SEO_SETTINGS_FILE
+    from services.http_cache import conditional
+    
+    not_modified = conditional(request, response, "seo_settings", SEO_SETTINGS_FILE)
+    if not_modified:
+        return not_modified
+    
     settings = Database.get_seo_settings()
     return {"success": True, "data": settings}
 
 @api_router.get("/robots.txt")
-def get_robots_txt():
+def get_robots_txt(request: Request):
     """Генерация robots.txt"""
-    seo_settings = Database.get_seo_settings()
-    
-    if seo_settings and seo_settings.get("robots_txt"):
-        return seo_settings["robots_txt"]
+    from services.response_cache import get_response_cache
     
-    # Дефолтный robots.txt
-    default_robots = """User-agent: *
+    def build():
+        seo_settings = Database.get_seo_settings()
+        
+        if seo_settings and seo_settings.get("robots_txt"):
+            return seo_settings["robots_txt"]
+        
+        # Дефолтный robots.txt
+        default_robots = """User-agent: *
 Allow: /
 
 Sitemap: /sitemap.xml"""
+        
+        return default_robots
     
-    return default_robots
+    return get_response_cache().respond(request, None, ("seo_settings",), build)
 
 @api_router.get("/sitemap.xml")
-def get_sitemap():
-    """Генерация sitemap.xml"""
-    seo_settings = Database.get_seo_settings()
+def get_sitemap(request: Request):
+    """Индекс sitemap"""
+    return sitemap_response(request, "sitemap.xml")
+
+@api_router.get("/sitemap-{shard:int}.xml")
+def get_sitemap_shard(shard: int, request: Request):
+    """Файл sitemap с URL товаров и страниц (до 50 000 на файл)"""
+    return sitemap_response(request, f"sitemap-{shard}.xml")
+
+def sitemap_response(request: Request, name: str):
+    from email.utils import format_datetime
+    from services.compression import accepts
+    from services.sitemap_service import get_sitemap_service
     
+    seo_settings = Database.get_seo_settings()
     if not seo_settings or not seo_settings.get("sitemap_enabled", True):
         raise HTTPException(status_code=404, detail="Sitemap отключен")
     
-    # Базовая генерация sitemap
-    pages = Database.get_pages()
-    products = Database.get_products()
-    
-    sitemap_urls = []
-    
-    # Добавляем основные страницы
-    sitemap_urls.append("https://nexx.ru/")
-    sitemap_urls.append("https://nexx.ru/catalog")
+    sitemap = get_sitemap_service()
+    sitemap_file = sitemap.get_file(name)
+    if sitemap_file is None:
+        raise HTTPException(status_code=404, detail="Sitemap не найден")
     
-    # Добавляем страницы
-    for page in pages:
-        if page.get("active", True):
-            sitemap_urls.append(f"https://nexx.ru/{page['slug']}")
-    
-    # Добавляем товары
-    for product in products[:100]:  # Ограничиваем для примера
-        sitemap_urls.append(f"https://nexx.ru/product/{product['id']}")
-    
-    # Генерируем XML
-    sitemap_xml = '<?xml version="1.0" encoding="UTF-8"?>\n'
-    sitemap_xml += '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
-    
-    for url in sitemap_urls:
-        sitemap_xml += f'  <url><loc>{url}</loc></url>\n'
-    
-    sitemap_xml += '</urlset>'
-    
-    return sitemap_xml
+    headers = {
+        "ETag": sitemap_file.etag,
+        "Cache-Control": "public, max-age=3600",
+        "Vary": "Accept-Encoding"
+    }
+    if sitemap_file.last_modified:
+        headers["Last-Modified"] = format_datetime(sitemap_file.last_modified.replace(tzinfo=timezone.utc), usegmt=True)
+    
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        if sitemap_file.etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+    elif sitemap_file.last_modified and request.headers.get("if-modified-since"):
+        from email.utils import parsedate_to_datetime
+        try:
+            since = parsedate_to_datetime(request.headers["if-modified-since"]).replace(tzinfo=None)
+            if sitemap_file.last_modified <= since:
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+    
+    if accepts(request.headers.get("accept-encoding"), "gzip"):
+        return Response(sitemap_file.body, media_type="application/xml", headers={**headers, "Content-Encoding": "gzip"})
+    return Response(sitemap.decompress(sitemap_file), media_type="application/xml", headers=headers)
 
 # Include API router
 app.include_router(api_router)
 
+# Загруженные медиафайлы
+@app.api_route("/uploads/{filename:path}", methods=["GET", "HEAD"], include_in_schema=False)
+def serve_upload(filename: str, request: Request):
+    """Отдача загруженных файлов с ETag, Range и кэшированием"""
+    from services.media_service import UPLOAD_DIR, upload_response_headers
+    from services.static_files import RangeFileResponse
+    
+    path = (UPLOAD_DIR / filename).resolve()
+    if path.parent != UPLOAD_DIR.resolve() or path.name.startswith("."):
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    
+    media_type, headers = upload_response_headers(path)
+    return RangeFileResponse(path, request.headers, media_type=media_type, headers=headers)
+
+# Товарные фиды
+@app.api_route("/feeds/{filename}", methods=["GET", "HEAD"], include_in_schema=False)
+def serve_feed(filename: str, request: Request):
+    """Отдача опубликованных фидов с ETag и условными запросами"""
+    from services.feed_service import FEEDS, FEEDS_DIR
+    from services.static_files import RangeFileResponse
+    
+    media_types = {
+        "yml": "application/xml; charset=utf-8",
+        "google": "application/xml; charset=utf-8",
+        "csv": "text/csv; charset=utf-8"
+    }
+    for name, feed in FEEDS.items():
+        if feed.filename == filename:
+            return RangeFileResponse(
+                FEEDS_DIR / filename, request.headers,
+                media_type=media_types[name], cache_control="public, max-age=600"
+            )
+    raise HTTPException(status_code=404, detail="Фид не найден")
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -31,6 +31,9 @@ class ABCPCartItem(BaseModel):
     item_key: str
 
 class ABCPService:
+    # Время жизни кэша предложений поставщиков (секунды)
+    OFFERS_CACHE_TTL = 300
+    
     def __init__(self, username: str, password: str, host: str = "api.abcp.ru"):
         self.username = username
         self.password = password
@@ -44,6 +47,11 @@ class ABCPService:
             timeout=30.0,
             limits=httpx.Limits(max_connections=10)
         )
+        
+        # Кэш предложений: (артикул, бренд) -> (время получения, предложения)
+        self._offers_cache: Dict[tuple, tuple] = {}
+        # Увеличивается при каждом обновлении кэша предложений
+        self.offers_version = 0
     
     def _get_auth_params(self) -> Dict[str, str]:
         """Получение параметров аутентификации"""
@@ -118,6 +126,11 @@ class ABCPService:
         brand: Optional[str] = None
     ) -> List[Dict[str, Any]]:
         """Получение предложений по товару от разных поставщиков"""
+        cache_key = (part_number, brand)
+        cached = self._offers_cache.get(cache_key)
+        if cached and (datetime.now() - cached[0]).total_seconds() < self.OFFERS_CACHE_TTL:
+            return cached[1]
+        
         try:
             # Поиск товаров
             products = await self.search_products(part_number, brand, 10)
@@ -146,6 +159,10 @@ class ABCPService:
             # Сортируем по цене
             offers.sort(key=lambda x: x["client_price"])
             
+            if offers:
+                self._offers_cache[cache_key] = (datetime.now(), offers)
+                self.offers_version += 1
+            
             return offers
             
         except Exception as e:
@@ -309,6 +326,31 @@ class ABCPService:
                 "response_time_ms": 0
             }
     
+    def get_cached_offers(self, part_number: str, brand: Optional[str] = None) -> Optional[List[Dict[str, Any]]]:
+        """Предложения из кэша без обращения к API (None - нет актуальных данных)"""
+        cached = self._offers_cache.get((part_number, brand))
+        if cached and (datetime.now() - cached[0]).total_seconds() < self.OFFERS_CACHE_TTL:
+            return cached[1]
+        return None
+    
+    async def prefetch_offers(self, products: List[Dict[str, Any]], concurrency: int = 5) -> int:
+        """Предзагрузка предложений для списка товаров в кэш"""
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def fetch(product):
+            async with semaphore:
+                offers = await self.get_product_offers(
+                    part_number=product.get("part_number"),
+                    brand=product.get("brand")
+                )
+                return bool(offers)
+        
+        results = await asyncio.gather(
+            *(fetch(p) for p in products if p.get("part_number")),
+            return_exceptions=True
+        )
+        return sum(1 for r in results if r is True)
+    
     async def close(self):
         """Закрытие HTTP клиента"""
         await self.client.aclose()
@@ -0,0 +1,190 @@
+"""
+Analytics Service
+Материализованные агрегаты для дашборда: счетчики и суммы обновляются
+при каждом изменении заказов, товаров и пользователей, выручка и заказы
+хранятся по дням и месяцам, при старте все пересчитывается из хранилища
+"""
+
+import logging
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Any, Optional
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Статусы заказов, не учитываемые в выручке
+EXCLUDED_REVENUE_STATUSES = {"cancelled", "canceled"}
+COMPLETED_STATUSES = {"completed", "delivered"}
+
+def _day(timestamp: Optional[str]) -> str:
+    return (timestamp or "")[:10]
+
+def _amount(order: Dict[str, Any]) -> float:
+    try:
+        return float(order.get("total_amount") or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+class DashboardAggregates:
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Версии коллекций, которым соответствуют агрегаты
+        self._trackers: Dict[str, Any] = {}
+        self._reset_orders()
+        self._reset_products()
+        self._reset_users()
+    
+    def _reset_orders(self):
+        self.orders_total = 0
+        self.orders_by_status = Counter()
+        self.orders_by_day = Counter()
+        self.revenue_total = 0.0
+        self.revenue_by_day = defaultdict(float)
+        self.revenue_by_month = defaultdict(float)
+    
+    def _reset_products(self):
+        self.products_total = 0
+    
+    def _reset_users(self):
+        self.users_total = 0
+        self.users_active = 0
+        self.users_by_day = Counter()
+    
+    # Применение изменений (sign = +1 добавить, -1 вычесть)
+    def _apply_order(self, order: Dict[str, Any], sign: int):
+        day = _day(order.get("created_at"))
+        self.orders_total += sign
+        self.orders_by_status[order.get("status")] += sign
+        self.orders_by_day[day] += sign
+        
+        if order.get("status") not in EXCLUDED_REVENUE_STATUSES:
+            amount = _amount(order) * sign
+            self.revenue_total += amount
+            self.revenue_by_day[day] += amount
+            self.revenue_by_month[day[:7]] += amount
+    
+    def _apply_product(self, product: Dict[str, Any], sign: int):
+        self.products_total += sign
+    
+    def _apply_user(self, user: Dict[str, Any], sign: int):
+        self.users_total += sign
+        self.users_by_day[_day(user.get("created_at"))] += sign
+        if user.get("active", True):
+            self.users_active += sign
+    
+    def _sections(self):
+        from database import ORDERS_FILE, PRODUCTS_FILE, USERS_FILE, Database
+        return {
+            ORDERS_FILE: (self._reset_orders, self._apply_order, Database.get_orders),
+            PRODUCTS_FILE: (self._reset_products, self._apply_product, Database.get_products),
+            USERS_FILE: (self._reset_users, self._apply_user, Database.get_users),
+        }
+    
+    def _tracker(self, file_path: str):
+        from database import ChangeTracker
+        return self._trackers.setdefault(file_path, ChangeTracker())
+    
+    def _rebuild_section(self, file_path: str):
+        from database import collection_snapshot
+        
+        reset, apply, load = self._sections()[file_path]
+        with self._lock:
+            items, version = collection_snapshot(file_path, load)
+            reset()
+            for item in items:
+                apply(item, 1)
+            self._tracker(file_path).rebuilt(version)
+    
+    def rebuild(self):
+        """Полный пересчет агрегатов из хранилища"""
+        for file_path in self._sections():
+            self._rebuild_section(file_path)
+        logger.info(f"Dashboard aggregates rebuilt: {self.orders_total} orders, "
+                    f"{self.products_total} products, {self.users_total} users")
+    
+    def handle_change(self, file_path: str, action: str, item: Dict[str, Any], previous: Optional[Dict[str, Any]]):
+        """Подписчик на изменения коллекций Database"""
+        from database import collection_version
+        
+        sections = self._sections()
+        if file_path not in sections:
+            return
+        
+        _, apply, _ = sections[file_path]
+        with self._lock:
+            version = collection_version(file_path)
+            tracker = self._tracker(file_path)
+            decision = tracker.classify(version)
+            if decision == tracker.SKIP:
+                # Изменение уже вошло в снимок последнего пересчета
+                return
+            if decision == tracker.REBUILD:
+                # Пропущены изменения (другой поток/воркер) - пересчитываем раздел
+                self._rebuild_section(file_path)
+                return
+            
+            if action in ("update", "delete"):
+                apply(previous if action == "update" else item, -1)
+            if action in ("add", "update"):
+                apply(item, 1)
+            tracker.applied(version)
+    
+    def _ensure_fresh(self):
+        """Проверка, что файлы не менялись извне (stat без повторного чтения)"""
+        from database import load_json, collection_version
+        
+        for file_path in self._sections():
+            load_json(file_path)
+            if self._tracker(file_path).version != collection_version(file_path):
+                self._rebuild_section(file_path)
+    
+    def get_dashboard(self) -> Dict[str, Any]:
+        from services.inventory_service import get_stock_index
+        
+        self._ensure_fresh()
+        # Низкий остаток считается по порогам категорий из индекса остатков
+        stock = get_stock_index().counts()
+        
+        now = datetime.now()
+        today = now.date().isoformat()
+        month = today[:7]
+        with self._lock:
+            return {
+                "orders": {
+                    "total": self.orders_total,
+                    "today": self.orders_by_day.get(today, 0),
+                    "pending": self.orders_by_status.get("pending", 0),
+                    "completed": sum(self.orders_by_status.get(s, 0) for s in COMPLETED_STATUSES)
+                },
+                "revenue": {
+                    "total": round(self.revenue_total, 2),
+                    "today": round(self.revenue_by_day.get(today, 0.0), 2),
+                    "this_month": round(self.revenue_by_month.get(month, 0.0), 2)
+                },
+                "products": {
+                    "total": self.products_total,
+                    "low_stock": stock["low_stock"],
+                    "out_of_stock": stock["out_of_stock"]
+                },
+                "users": {
+                    "total": self.users_total,
+                    "new_today": self.users_by_day.get(today, 0),
+                    "active": self.users_active
+                }
+            }
+
+# Глобальный экземпляр сервиса
+dashboard_aggregates = DashboardAggregates()
+
+def get_dashboard_aggregates() -> DashboardAggregates:
+    """Получение экземпляра агрегатов дашборда"""
+    return dashboard_aggregates
+
+def init_analytics():
+    """Подписка на изменения и первичный расчет"""
+    from database import on_change
+    
+    on_change(dashboard_aggregates.handle_change)
+    dashboard_aggregates.rebuild()
+    return dashboard_aggregates
@@ -0,0 +1,194 @@
+"""
+Cart Service
+Представление корзины: все строки за один проход соединяются с текущими
+данными каталога и кэшем предложений поставщиков, пересчитываются по
+актуальным ценам с учетом tax_rate/shipping_cost из settings.json и
+помечаются при изменении цены. Результат запоминается по версиям корзины,
+каталога, настроек и предложений - повторный просмотр без изменений
+ничего не пересчитывает.
+Очистка брошенных корзин: корзины, не изменявшиеся дольше CART_TTL_DAYS,
+переносятся в архив (пустые удаляются)
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CART_TTL_SECONDS = int(os.environ.get("CART_TTL_DAYS", "30")) * 86400
+
+def _money(value: float) -> float:
+    return round(float(value), 2)
+
+class CartViewEngine:
+    MAX_MEMO_ENTRIES = 2048
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # user_id -> (ключ версий, представление корзины)
+        self._memo: "OrderedDict[str, Tuple[tuple, Dict[str, Any]]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def _offers_source():
+        from services import abcp_service
+        return abcp_service.abcp_service
+
+    def _versions(self, user_id: str) -> tuple:
+        """Ключ состояния источников представления. Файлы сначала
+        перечитываются через load_json, а ключ строится по mtime/размеру
+        файла: запись другого воркера должна сменить ключ, а не вернуть
+        устаревшее представление"""
+        from database import collection_etag, cart_path, Database, PRODUCTS_FILE, SETTINGS_FILE
+
+        Database.get_cart(user_id)
+        Database.get_products()
+        Database.get_settings()
+        offers = self._offers_source()
+        return (
+            collection_etag(cart_path(user_id)),
+            collection_etag(PRODUCTS_FILE),
+            collection_etag(SETTINGS_FILE),
+            offers.offers_version if offers is not None else 0
+        )
+
+    def price_lines(self, lines: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Пересчет строк корзины по текущему каталогу и настройкам магазина"""
+        from database import Database
+
+        product_index = Database.get_product_index()
+        settings = Database.get_settings()
+        offers_source = self._offers_source()
+
+        tax_rate = float(settings.get("tax_rate") or 0)
+        prices_include_tax = settings.get("prices_include_tax", True)
+
+        items = []
+        subtotal = 0.0
+        price_changes = 0
+        unavailable = 0
+        for line in lines:
+            product = product_index.by_id.get(line.get("product_id"))
+            quantity = int(line.get("quantity") or 0)
+            snapshot_price = line.get("product_price")
+            item = {
+                **line,
+                "snapshot_price": snapshot_price,
+                "available": product is not None,
+                "price_changed": False
+            }
+
+            if product is None:
+                unavailable += 1
+                item["line_total"] = 0
+                items.append(item)
+                continue
+
+            price = product.get("price", snapshot_price) or 0
+            stock = product.get("stock_quantity")
+            item.update({
+                "product_name": product.get("name", line.get("product_name")),
+                "product_price": price,
+                "slug": product.get("slug"),
+                "image_url": product.get("image_url"),
+                "part_number": product.get("part_number"),
+                "brand": product.get("brand"),
+                "stock_quantity": stock,
+                "in_stock": stock is None or stock >= quantity,
+                "line_total": _money(price * quantity)
+            })
+            if snapshot_price is not None and snapshot_price != price:
+                item["price_changed"] = True
+                item["price_delta"] = _money(price - snapshot_price)
+                price_changes += 1
+
+            if offers_source is not None and product.get("part_number"):
+                offers = offers_source.get_cached_offers(product["part_number"], product.get("brand"))
+                if offers:
+                    best = offers[0]
+                    item["supplier_offer"] = {
+                        "client_price": _money(best["client_price"]),
+                        "delivery_time_days": best.get("delivery_time_days"),
+                        "stock_quantity": best.get("stock_quantity")
+                    }
+
+            subtotal += price * quantity
+            items.append(item)
+
+        shipping_cost = float(settings.get("shipping_cost") or 0) if subtotal > 0 else 0.0
+        free_shipping_threshold = settings.get("free_shipping_threshold")
+        if free_shipping_threshold is not None and subtotal >= float(free_shipping_threshold):
+            shipping_cost = 0.0
+
+        if prices_include_tax:
+            tax_amount = subtotal * tax_rate / (1 + tax_rate)
+            total = subtotal + shipping_cost
+        else:
+            tax_amount = subtotal * tax_rate
+            total = subtotal + tax_amount + shipping_cost
+
+        return {
+            "items": items,
+            "items_count": sum(int(item.get("quantity") or 0) for item in items if item["available"]),
+            "subtotal": _money(subtotal),
+            "tax_rate": tax_rate,
+            "tax_included": bool(prices_include_tax),
+            "tax_amount": _money(tax_amount),
+            "shipping_cost": _money(shipping_cost),
+            "total": _money(total),
+            "currency": settings.get("currency", "RUB"),
+            "price_changes": price_changes,
+            "unavailable_items": unavailable
+        }
+
+    def view(self, user_id: str) -> Dict[str, Any]:
+        """Представление корзины пользователя (из кэша, если ничего не менялось)"""
+        from database import Database
+
+        versions = self._versions(user_id)
+        with self._lock:
+            cached = self._memo.get(user_id)
+            if cached and cached[0] == versions:
+                self._memo.move_to_end(user_id)
+                self.stats["hits"] += 1
+                return cached[1]
+
+        result = self.price_lines(Database.get_cart(user_id))
+        with self._lock:
+            self.stats["misses"] += 1
+            self._memo[user_id] = (versions, result)
+            self._memo.move_to_end(user_id)
+            while len(self._memo) > self.MAX_MEMO_ENTRIES:
+                self._memo.popitem(last=False)
+        return result
+
+    def invalidate(self, user_id: Optional[str] = None):
+        with self._lock:
+            if user_id is None:
+                self._memo.clear()
+            else:
+                self._memo.pop(user_id, None)
+
+# Глобальный экземпляр сервиса
+cart_view_engine = CartViewEngine()
+
+def get_cart_view_engine() -> CartViewEngine:
+    """Получение движка представления корзины"""
+    return cart_view_engine
+
+async def run_cart_sweeper(interval: float = 3600.0):
+    """Фоновая задача: архивирование брошенных корзин"""
+    from database import Database
+    
+    while True:
+        try:
+            stats = await asyncio.to_thread(Database.evict_idle_carts, CART_TTL_SECONDS)
+            if stats["archived"] or stats["deleted"]:
+                logger.info(f"Idle carts evicted: {stats}")
+        except Exception as e:
+            logger.error(f"Cart sweeper error: {str(e)}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,239 @@
+"""
+Checkout Service
+Оформление заказа одним конвейером: корзина -> расчет цен -> резерв ->
+платеж -> фиксация. Вместе с резервом сохраняется заказ в статусе pending,
+которому резерв принадлежит: если процесс упадет во время обращения к
+платежной системе, резерв снимет фоновая задача по истечении срока.
+Платеж и очистка корзины записываются одним шагом в конце, при ошибке на
+любом этапе выполняются компенсирующие действия в обратном порядке. Для
+каждого этапа замеряется время выполнения
+"""
+
+import asyncio
+import logging
+import time
+from collections import defaultdict, deque
+from typing import Dict, Any, List, Optional, Callable
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("cart", "pricing", "reservation", "payment", "commit")
+
+class CheckoutError(Exception):
+    def __init__(self, message: str, status_code: int = 400, detail: Any = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.detail = detail if detail is not None else message
+
+class CheckoutContext:
+    """Состояние одного оформления: данные этапов, компенсации и замеры"""
+
+    def __init__(self, user_id: str, order_data: Dict[str, Any]):
+        self.user_id = user_id
+        self.order_data = order_data
+        self.cart: List[Dict[str, Any]] = []
+        self.order: Optional[Dict[str, Any]] = None
+        self.payment: Optional[Dict[str, Any]] = None
+        self.confirmation_url: Optional[str] = None
+        self.timings: Dict[str, float] = {}
+        self._compensations: List[Callable] = []
+
+    def on_failure(self, action: Callable):
+        """Компенсирующее действие: функция или корутинная функция без аргументов"""
+        self._compensations.append(action)
+
+    async def compensate(self):
+        for action in reversed(self._compensations):
+            try:
+                if asyncio.iscoroutinefunction(action):
+                    await action()
+                else:
+                    await asyncio.to_thread(action)
+            except Exception as e:
+                logger.error(f"Checkout compensation failed for user {self.user_id}: {str(e)}")
+        self._compensations.clear()
+
+class CheckoutPipeline:
+    SAMPLES_PER_STAGE = 500
+
+    def __init__(self):
+        self._samples: Dict[str, deque] = {stage: deque(maxlen=self.SAMPLES_PER_STAGE) for stage in STAGES}
+        self.stats: Dict[str, int] = defaultdict(int)
+
+    async def _stage(self, context: CheckoutContext, name: str, action: Callable, *args):
+        started = time.perf_counter()
+        try:
+            if asyncio.iscoroutinefunction(action):
+                return await action(context, *args)
+            return await asyncio.to_thread(action, context, *args)
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            context.timings[name] = round(elapsed, 2)
+            self._samples[name].append(elapsed)
+
+    def _load_cart(self, context: CheckoutContext):
+        from database import Database
+
+        context.cart = [dict(item) for item in Database.get_cart(context.user_id)]
+        if not context.cart:
+            raise CheckoutError("Cart is empty")
+
+    def _price(self, context: CheckoutContext):
+        """Пересчет корзины по текущему каталогу и настройкам магазина; номер
+        заказа выделяется здесь, чтобы передать его платежной системе"""
+        from database import Database
+        from services.cart_service import get_cart_view_engine
+
+        pricing = get_cart_view_engine().price_lines(context.cart)
+        unavailable = [item["product_id"] for item in pricing["items"] if not item["available"]]
+        if unavailable:
+            raise CheckoutError("Some products are no longer available", 409, {
+                "message": "Some products are no longer available",
+                "unavailable": unavailable
+            })
+        context.cart = pricing["items"]
+
+        context.order = Database.build_order({
+            "user_id": context.user_id,
+            "items": context.cart,
+            "subtotal": pricing["subtotal"],
+            "tax_amount": pricing["tax_amount"],
+            "shipping_cost": pricing["shipping_cost"],
+            "total_amount": pricing["total"],
+            "currency": pricing["currency"],
+            **context.order_data
+        })
+
+    def _reserve(self, context: CheckoutContext):
+        """Резерв и заказ-владелец резерва сохраняются до обращения к платежной
+        системе, чтобы списанный товар не потерялся при падении процесса"""
+        from database import Database
+        from services.inventory_service import get_reservation_engine, InsufficientStockError
+
+        reservations = get_reservation_engine()
+        try:
+            reservation = reservations.reserve(context.cart)
+        except InsufficientStockError as e:
+            raise CheckoutError(str(e), 409, {"message": str(e), "shortages": e.shortages})
+        context.order["reservation"] = reservation
+        try:
+            Database.insert_order(context.order)
+        except Exception:
+            reservations.return_stock(reservation["lines"])
+            raise
+
+        order_id = context.order["id"]
+        reservations.track(context.order)
+        context.on_failure(lambda: reservations.release(order_id))
+
+    async def _create_payment(self, context: CheckoutContext, payment_options: Dict[str, Any]):
+        from services import yoomoney_service
+
+        yoomoney = yoomoney_service.yoomoney_service
+        if yoomoney is None:
+            raise CheckoutError("Payment provider is not configured", 503)
+
+        order = context.order
+        try:
+            payment = await yoomoney.create_payment(
+                amount=order["total_amount"],
+                description=payment_options.get("description") or f"Заказ {order['order_number']}",
+                return_url=payment_options["return_url"],
+                metadata={"order_id": order["id"]},
+                # Повтор оформления с тем же ключом не создаст второй платеж
+                idempotency_key=payment_options.get("idempotency_key") or f"checkout-{order['id']}"
+            )
+        except Exception as e:
+            raise CheckoutError(f"Payment creation failed: {str(e)}", 502)
+
+        context.confirmation_url = payment.confirmation.get("confirmation_url") if payment.confirmation else None
+        context.payment = {
+            "payment_id": payment.id,
+            "order_id": order["id"],
+            "amount": order["total_amount"],
+            "currency": order.get("currency", "RUB"),
+            "status": payment.status,
+            "provider": "yoomoney",
+            "confirmation_url": context.confirmation_url
+        }
+
+        async def cancel_payment():
+            from database import Database
+
+            logger.warning(f"Checkout for order {order['id']} failed after payment {payment.id} was created, canceling it")
+            try:
+                await yoomoney.cancel_payment(payment.id)
+            except Exception:
+                # Платеж не отменился: сохраняем его без заказа, чтобы поздняя
+                # оплата дошла до записи с пометкой о возврате, а не потерялась
+                await asyncio.to_thread(Database.add_payment, {
+                    **context.payment, "order_id": None, "refund_required": True
+                })
+                raise
+
+        context.on_failure(cancel_payment)
+
+    def _commit(self, context: CheckoutContext):
+        from database import Database
+
+        context.order, context.payment = Database.commit_checkout(context.user_id, context.order, context.payment)
+
+    async def run(
+        self,
+        user_id: str,
+        order_data: Dict[str, Any],
+        payment_options: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """Оформление заказа; payment_options=None - без онлайн-оплаты"""
+        context = CheckoutContext(user_id, order_data)
+        self.stats["started"] += 1
+        stage = None
+        try:
+            stage = "cart"
+            await self._stage(context, stage, self._load_cart)
+            stage = "pricing"
+            await self._stage(context, stage, self._price)
+            stage = "reservation"
+            await self._stage(context, stage, self._reserve)
+            if payment_options is not None:
+                stage = "payment"
+                await self._stage(context, stage, self._create_payment, payment_options)
+            stage = "commit"
+            await self._stage(context, stage, self._commit)
+        except BaseException:
+            self.stats[f"failed_{stage}"] += 1
+            await asyncio.shield(context.compensate())
+            raise
+
+        self.stats["completed"] += 1
+        return {
+            "order": context.order,
+            "payment": {
+                "payment_id": context.payment["payment_id"],
+                "status": context.payment["status"],
+                "confirmation_url": context.confirmation_url
+            } if context.payment else None,
+            "timings_ms": context.timings
+        }
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Время выполнения этапов (мс) по последним оформлениям"""
+        stages = {}
+        for stage, samples in self._samples.items():
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            stages[stage] = {
+                "count": len(ordered),
+                "avg": round(sum(ordered) / len(ordered), 2),
+                "p50": round(ordered[len(ordered) // 2], 2),
+                "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2)
+            }
+        return {"stages": stages, "outcomes": dict(self.stats)}
+
+# Глобальный экземпляр сервиса
+checkout_pipeline = CheckoutPipeline()
+
+def get_checkout_pipeline() -> CheckoutPipeline:
+    """Получение конвейера оформления заказа"""
+    return checkout_pipeline
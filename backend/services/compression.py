@@ -0,0 +1,185 @@
+"""
+Compression
+Сжатие ответов gzip/brotli с выбором кодировки по Accept-Encoding. Ответы
+меньше порога отдаются как есть. Крупные тела сжимаются в отдельном потоке,
+чтобы не блокировать цикл событий. Закэшированные ответы хранят уже сжатые
+варианты (см. response_cache) и повторно не сжимаются. brotli опционален:
+без него используется только gzip
+"""
+
+import asyncio
+import gzip
+import os
+from typing import Dict, Any, Optional
+
+try:
+    import brotli
+except ImportError:  # brotli не установлен: только gzip
+    brotli = None
+
+MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", "1024"))
+# Тела меньше этого размера сжимаются прямо в цикле событий: поток дороже
+THREAD_MIN_SIZE = int(os.environ.get("COMPRESSION_THREAD_MIN_SIZE", str(32 * 1024)))
+GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("COMPRESSION_BROTLI_QUALITY", "5"))
+
+COMPRESSIBLE_TYPES = (
+    "application/json",
+    "application/xml",
+    "application/javascript",
+    "text/",
+    "image/svg+xml"
+)
+
+# Статистика сжатия: middleware и кэш ответов
+stats = {"compressed": 0, "skipped": 0, "cached_variants": 0, "bytes_in": 0, "bytes_out": 0}
+
+def supported_encodings() -> tuple:
+    """Кодировки в порядке предпочтения сервера"""
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+def _weights(accept_encoding: Optional[str]) -> Dict[str, float]:
+    """Разбор Accept-Encoding: кодировка -> q"""
+    weights: Dict[str, float] = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding] = q
+    return weights
+
+def accepts(accept_encoding: Optional[str], coding: str) -> bool:
+    """Принимает ли клиент кодировку (q > 0)"""
+    weights = _weights(accept_encoding)
+    return weights.get(coding, weights.get("*", 0.0)) > 0
+
+def negotiate(accept_encoding: Optional[str]) -> Optional[str]:
+    """Выбор кодировки по Accept-Encoding с учетом q-значений; None - без сжатия"""
+    weights = _weights(accept_encoding)
+    best, best_q = None, 0.0
+    for coding in supported_encodings():
+        q = weights.get(coding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+def is_compressible(content_type: Optional[str]) -> bool:
+    if not content_type:
+        return False
+    content_type = content_type.lower()
+    return any(content_type.startswith(prefix) for prefix in COMPRESSIBLE_TYPES)
+
+def count(body: bytes, compressed: bytes, key: str = "compressed"):
+    stats[key] += 1
+    stats["bytes_in"] += len(body)
+    stats["bytes_out"] += len(compressed)
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == "gzip":
+        # mtime=0: одинаковое тело дает одинаковый результат
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+class CompressionMiddleware:
+    """ASGI middleware: сжатие ответов, отправленных одним куском. Потоковые
+    ответы, файлы с Range и уже сжатые ответы пропускаются"""
+
+    def __init__(self, app, minimum_size: int = MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accept_encoding = None
+        for name, value in scope.get("headers", ()):
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+                break
+        encoding = negotiate(accept_encoding)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough
+            if passthrough:
+                await send(message)
+                return
+
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+
+            if message["type"] != "http.response.body":
+                # http.response.pathsend/zerocopy и другие расширения: тело идет
+                # мимо middleware, поэтому задержанные заголовки уходят как есть
+                passthrough = True
+                if start_message is not None:
+                    stats["skipped"] += 1
+                    await send(start_message)
+                await send(message)
+                return
+
+            if start_message is None:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            headers = {k.lower(): v for k, v in start_message.get("headers", ())}
+            if (
+                message.get("more_body", False)
+                or start_message["status"] in (204, 206, 304)
+                or b"content-encoding" in headers
+                or len(body) < self.minimum_size
+                or not is_compressible(headers.get(b"content-type", b"").decode("latin-1"))
+            ):
+                passthrough = True
+                stats["skipped"] += 1
+                await send(start_message)
+                await send(message)
+                return
+
+            if len(body) >= THREAD_MIN_SIZE:
+                compressed = await asyncio.to_thread(compress, body, encoding)
+            else:
+                compressed = compress(body, encoding)
+            count(body, compressed)
+
+            raw_headers = [
+                (k, v) for k, v in start_message.get("headers", ())
+                if k.lower() not in (b"content-length", b"vary")
+            ]
+            raw_headers.append((b"content-encoding", encoding.encode("latin-1")))
+            raw_headers.append((b"content-length", str(len(compressed)).encode("latin-1")))
+            raw_headers.append((b"vary", add_vary(headers.get(b"vary", b"").decode("latin-1")).encode("latin-1")))
+            await send({**start_message, "headers": raw_headers})
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_wrapper)
+
+def add_vary(vary: Optional[str]) -> str:
+    """Добавляет Accept-Encoding в заголовок Vary"""
+    values = [v.strip() for v in (vary or "").split(",") if v.strip()]
+    if not any(v.lower() == "accept-encoding" for v in values):
+        values.append("Accept-Encoding")
+    return ", ".join(values)
+
+def get_compression_stats() -> Dict[str, Any]:
+    """Статистика сжатия ответов"""
+    return {**stats, "encodings": list(supported_encodings()), "min_size": MIN_SIZE}
@@ -0,0 +1,311 @@
+"""
+Feed Service
+Товарные фиды для маркетплейсов и агрегаторов: Яндекс.Маркет (YML), Google
+Merchant (RSS 2.0) и CSV. Фид пишется потоком во временный файл и атомарно
+подменяет опубликованный. Фрагменты предложений кэшируются: между запусками
+заново формируются только товары из журнала изменений или с другими
+updated_at/ценой/остатком. Пересборку выполняет фоновая задача
+"""
+
+import asyncio
+import csv
+import io
+import logging
+import os
+import threading
+import time
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any, Iterator, Optional, Set, Tuple
+from xml.sax.saxutils import escape, quoteattr
+
+logger = logging.getLogger(__name__)
+
+FEEDS_DIR = Path(os.environ.get("FEEDS_DIR", "/app/feeds"))
+BASE_URL = os.environ.get("SITE_URL", "https://nexx.ru").rstrip("/")
+
+def _absolute_url(url: Optional[str]) -> Optional[str]:
+    if not url:
+        return None
+    return url if url.startswith(("http://", "https://")) else f"{BASE_URL}/{url.lstrip('/')}"
+
+def _category_id(name: str) -> int:
+    """Устойчивый числовой id категории (YML требует целые id)"""
+    return zlib.crc32(name.encode("utf-8")) + 1
+
+def _product_url(product: Dict[str, Any]) -> str:
+    return f"{BASE_URL}/product/{product['id']}"
+
+def _price(product: Dict[str, Any]) -> str:
+    return f"{float(product.get('price') or 0):.2f}"
+
+def _stock(product: Dict[str, Any]) -> int:
+    try:
+        return int(product.get("stock_quantity") or 0)
+    except (TypeError, ValueError):
+        return 0
+
+class YMLFeed:
+    filename = "yandex_market.yml"
+
+    def header(self, shop: Dict[str, Any], categories) -> Iterator[str]:
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield f'<yml_catalog date="{datetime.now().strftime("%Y-%m-%dT%H:%M")}">\n<shop>\n'
+        yield f"<name>{escape(shop['name'])}</name>\n<company>{escape(shop['company'])}</company>\n"
+        yield f"<url>{escape(BASE_URL)}</url>\n"
+        yield f'<currencies><currency id={quoteattr(shop["currency"])} rate="1"/></currencies>\n'
+        yield "<categories>\n"
+        for name in categories:
+            yield f'<category id="{_category_id(name)}">{escape(name)}</category>\n'
+        yield "</categories>\n<offers>\n"
+
+    def offer(self, product: Dict[str, Any], shop: Dict[str, Any]) -> str:
+        stock = _stock(product)
+        parts = [
+            f'<offer id={quoteattr(str(product["id"]))} available="{"true" if stock > 0 else "false"}">',
+            f"<url>{escape(_product_url(product))}</url>",
+            f"<price>{_price(product)}</price>",
+            f"<currencyId>{escape(shop['currency'])}</currencyId>"
+        ]
+        if product.get("category"):
+            parts.append(f"<categoryId>{_category_id(product['category'])}</categoryId>")
+        picture = _absolute_url(product.get("image_url"))
+        if picture:
+            parts.append(f"<picture>{escape(picture)}</picture>")
+        parts.append(f"<name>{escape(product.get('name') or '')}</name>")
+        if product.get("brand"):
+            parts.append(f"<vendor>{escape(product['brand'])}</vendor>")
+        if product.get("part_number"):
+            parts.append(f"<vendorCode>{escape(product['part_number'])}</vendorCode>")
+        if product.get("description"):
+            parts.append(f"<description>{escape(product['description'])}</description>")
+        parts.append(f"<count>{stock}</count>")
+        parts.append("</offer>\n")
+        return "".join(parts)
+
+    def footer(self) -> str:
+        return "</offers>\n</shop>\n</yml_catalog>\n"
+
+class GoogleFeed:
+    filename = "google_merchant.xml"
+
+    def header(self, shop: Dict[str, Any], categories) -> Iterator[str]:
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield '<rss version="2.0" xmlns:g="http://base.google.com/ns/1.0">\n<channel>\n'
+        yield f"<title>{escape(shop['name'])}</title>\n<link>{escape(BASE_URL)}</link>\n"
+        yield f"<description>{escape(shop['description'])}</description>\n"
+
+    def offer(self, product: Dict[str, Any], shop: Dict[str, Any]) -> str:
+        parts = [
+            "<item>",
+            f"<g:id>{escape(str(product['id']))}</g:id>",
+            f"<title>{escape(product.get('name') or '')}</title>",
+            f"<description>{escape(product.get('description') or product.get('name') or '')}</description>",
+            f"<link>{escape(_product_url(product))}</link>",
+            f"<g:price>{_price(product)} {escape(shop['currency'])}</g:price>",
+            f"<g:availability>{'in_stock' if _stock(product) > 0 else 'out_of_stock'}</g:availability>",
+            "<g:condition>new</g:condition>"
+        ]
+        picture = _absolute_url(product.get("image_url"))
+        if picture:
+            parts.append(f"<g:image_link>{escape(picture)}</g:image_link>")
+        if product.get("brand"):
+            parts.append(f"<g:brand>{escape(product['brand'])}</g:brand>")
+        if product.get("part_number"):
+            parts.append(f"<g:mpn>{escape(product['part_number'])}</g:mpn>")
+        if product.get("category"):
+            parts.append(f"<g:product_type>{escape(product['category'])}</g:product_type>")
+        parts.append("</item>\n")
+        return "".join(parts)
+
+    def footer(self) -> str:
+        return "</channel>\n</rss>\n"
+
+class CSVFeed:
+    filename = "products.csv"
+    COLUMNS = ["id", "title", "description", "link", "image_link", "price", "currency",
+               "availability", "stock_quantity", "brand", "part_number", "category"]
+
+    @staticmethod
+    def _row(values) -> str:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(values)
+        return buffer.getvalue()
+
+    def header(self, shop: Dict[str, Any], categories) -> Iterator[str]:
+        yield self._row(self.COLUMNS)
+
+    def offer(self, product: Dict[str, Any], shop: Dict[str, Any]) -> str:
+        stock = _stock(product)
+        return self._row([
+            product["id"],
+            product.get("name") or "",
+            product.get("description") or "",
+            _product_url(product),
+            _absolute_url(product.get("image_url")) or "",
+            _price(product),
+            shop["currency"],
+            "in_stock" if stock > 0 else "out_of_stock",
+            stock,
+            product.get("brand") or "",
+            product.get("part_number") or "",
+            product.get("category") or ""
+        ])
+
+    def footer(self) -> str:
+        return ""
+
+FEEDS = {"yml": YMLFeed(), "google": GoogleFeed(), "csv": CSVFeed()}
+
+class FeedExporter:
+    INTERVAL = float(os.environ.get("FEED_REBUILD_INTERVAL", "900"))
+    WRITE_BUFFER = 256 * 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Журнал изменений: id товаров, измененных после последней сборки
+        self._changed: Set[str] = set()
+        # Формат -> id товара -> (отпечаток товара, фрагмент)
+        self._fragments: Dict[str, Dict[str, Tuple[tuple, str]]] = {name: {} for name in FEEDS}
+        self._built_version = None
+        self._shop_key = None
+        self.status: Dict[str, Any] = {}
+
+    def handle_change(self, file_path: str, action: str, item: Dict[str, Any], previous: Optional[Dict[str, Any]]):
+        from database import PRODUCTS_FILE
+
+        if file_path != PRODUCTS_FILE:
+            return
+        with self._lock:
+            for record in (item, previous):
+                if record and record.get("id"):
+                    self._changed.add(record["id"])
+
+    @staticmethod
+    def _stamp(product: Dict[str, Any]) -> tuple:
+        """Отпечаток товара: ловит и изменения, сделанные другими воркерами"""
+        return (product.get("updated_at"), product.get("price"), product.get("stock_quantity"))
+
+    @staticmethod
+    def _shop() -> Dict[str, Any]:
+        from database import Database
+
+        settings = Database.get_settings()
+        site = Database.get_site_settings() or {}
+        return {
+            "name": settings.get("site_name", "NEXX"),
+            "company": site.get("company_name") or settings.get("site_name", "NEXX"),
+            "description": settings.get("site_description", ""),
+            "currency": settings.get("currency", "RUB")
+        }
+
+    def _write(self, name: str, shop: Dict[str, Any], products, categories, changed: Set[str]) -> Dict[str, Any]:
+        feed = FEEDS[name]
+        fragments = self._fragments[name]
+        target = FEEDS_DIR / feed.filename
+        temp_path = FEEDS_DIR / f".{feed.filename}.{os.getpid()}.tmp"
+
+        rendered = 0
+        seen = set()
+        try:
+            with open(temp_path, "w", encoding="utf-8", newline="", buffering=self.WRITE_BUFFER) as f:
+                for chunk in feed.header(shop, categories):
+                    f.write(chunk)
+                for product in products:
+                    product_id = product.get("id")
+                    if not product_id:
+                        continue
+                    seen.add(product_id)
+                    stamp = self._stamp(product)
+                    cached = fragments.get(product_id)
+                    if cached is None or cached[0] != stamp or product_id in changed:
+                        cached = (stamp, feed.offer(product, shop))
+                        fragments[product_id] = cached
+                        rendered += 1
+                    f.write(cached[1])
+                f.write(feed.footer())
+            os.replace(temp_path, target)
+        except Exception:
+            # Опубликованный фид остается прежним, недописанный файл удаляется
+            temp_path.unlink(missing_ok=True)
+            raise
+
+        # Удаленные товары больше не нужны в кэше
+        for product_id in set(fragments) - seen:
+            del fragments[product_id]
+
+        return {
+            "file": feed.filename,
+            "offers": len(seen),
+            "rendered": rendered,
+            "size": target.stat().st_size,
+            "built_at": datetime.now().isoformat()
+        }
+
+    def rebuild(self, force: bool = False) -> Dict[str, Any]:
+        """Пересборка фидов; без изменений каталога - ничего не делает"""
+        from database import Database, collection_version, _process_lock, PRODUCTS_FILE, SETTINGS_FILE, SITE_SETTINGS_FILE
+
+        version = (collection_version(PRODUCTS_FILE), collection_version(SETTINGS_FILE),
+                   collection_version(SITE_SETTINGS_FILE))
+        if not force and version == self._built_version and all(
+            (FEEDS_DIR / feed.filename).exists() for feed in FEEDS.values()
+        ):
+            return {"skipped": True, **self.status}
+
+        FEEDS_DIR.mkdir(parents=True, exist_ok=True)
+        started = time.perf_counter()
+        with self._lock:
+            changed, self._changed = self._changed, set()
+
+        try:
+            # Один воркер за раз пишет фиды
+            with _process_lock(str(FEEDS_DIR / ".lock")):
+                shop = self._shop()
+                shop_key = tuple(sorted(shop.items()))
+                if force or shop_key != self._shop_key:
+                    for fragments in self._fragments.values():
+                        fragments.clear()
+                    self._shop_key = shop_key
+
+                index = Database.get_product_index()
+                categories = sorted({p["category"] for p in index.products if p.get("category")})
+                feeds = {
+                    name: self._write(name, shop, index.products, categories, changed)
+                    for name in FEEDS
+                }
+        except Exception:
+            with self._lock:
+                self._changed |= changed
+            raise
+
+        self._built_version = version
+        self.status = {
+            "feeds": feeds,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 1)
+        }
+        return self.status
+
+    async def run(self):
+        """Фоновая задача периодической пересборки фидов"""
+        while True:
+            try:
+                await asyncio.to_thread(self.rebuild)
+            except Exception as e:
+                logger.error(f"Feed rebuild error: {str(e)}")
+            await asyncio.sleep(self.INTERVAL)
+
+# Глобальный экземпляр сервиса
+feed_exporter = FeedExporter()
+
+def get_feed_exporter() -> FeedExporter:
+    """Получение экспортера фидов"""
+    return feed_exporter
+
+def init_feeds():
+    """Подписка на изменения товаров для инкрементальной пересборки"""
+    from database import on_change
+
+    on_change(feed_exporter.handle_change)
+    return feed_exporter
@@ -0,0 +1,174 @@
+"""
+Guest Cart Service
+Корзина гостя хранится у клиента в компактном токене: строки (id товара,
+количество) в JSON, при выигрыше по размеру сжатые zlib, подписанные HMAC.
+Сервер проверяет токен без обращения к хранилищу; в постоянную корзину
+строки попадают только при входе или подтверждении SMS
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import time
+import zlib
+from typing import Dict, Any, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+TOKEN_VERSION = "g1"
+
+class GuestCartError(Exception):
+    pass
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+class GuestCartService:
+    MAX_LINES = 100
+    MAX_QUANTITY = 999
+    MAX_TOKEN_LENGTH = 4096
+    SIGNATURE_BYTES = 16
+    TOKEN_TTL = int(os.environ.get("GUEST_CART_TTL_DAYS", "30")) * 86400
+
+    def __init__(self):
+        self._secret = None
+
+    def _get_secret(self) -> bytes:
+        """Ключ подписи: из GUEST_CART_SECRET или общий файл для всех воркеров"""
+        if self._secret is not None:
+            return self._secret
+
+        secret = os.environ.get("GUEST_CART_SECRET")
+        if not secret:
+            from database import DATA_DIR
+
+            path = os.path.join(DATA_DIR, "guest_cart_secret.key")
+            if not os.path.exists(path):
+                # Ключ пишется во временный файл и появляется под своим именем
+                # целиком; os.link не заменяет существующий файл, поэтому при
+                # одновременном старте остается ключ только одного воркера
+                tmp_path = f"{path}.{os.getpid()}.{secrets.token_hex(4)}.tmp"
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                try:
+                    with os.fdopen(fd, "w") as f:
+                        f.write(secrets.token_hex(32))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.link(tmp_path, path)
+                except FileExistsError:
+                    pass
+                finally:
+                    os.unlink(tmp_path)
+            with open(path) as f:
+                secret = f.read().strip()
+            if not secret:
+                # Пустой ключ не кэшируется: следующий вызов прочитает файл заново
+                raise GuestCartError(f"Guest cart signing key {path} is empty")
+
+        self._secret = secret.encode("utf-8")
+        return self._secret
+
+    def _sign(self, body: str) -> str:
+        digest = hmac.new(self._get_secret(), f"{TOKEN_VERSION}.{body}".encode("ascii"), hashlib.sha256).digest()
+        return _b64encode(digest[:self.SIGNATURE_BYTES])
+
+    def encode(self, lines: List[Tuple[str, int]]) -> str:
+        """Токен из строк корзины [(product_id, quantity)]"""
+        raw = json.dumps(
+            {"l": [[product_id, quantity] for product_id, quantity in lines], "t": int(time.time())},
+            separators=(",", ":")
+        ).encode("utf-8")
+        compressed = zlib.compress(raw, 9)
+        # Первый байт - формат полезной нагрузки: z - zlib, j - JSON как есть
+        payload = b"z" + compressed if len(compressed) < len(raw) else b"j" + raw
+        body = _b64encode(payload)
+        return f"{TOKEN_VERSION}.{body}.{self._sign(body)}"
+
+    def decode(self, token: str) -> List[Tuple[str, int]]:
+        """Проверка подписи и срока действия токена; пустой токен - пустая корзина"""
+        if not token:
+            return []
+        if len(token) > self.MAX_TOKEN_LENGTH:
+            raise GuestCartError("Guest cart token is too long")
+
+        parts = token.split(".")
+        if len(parts) != 3 or parts[0] != TOKEN_VERSION:
+            raise GuestCartError("Invalid guest cart token")
+        _, body, signature = parts
+        if not hmac.compare_digest(signature, self._sign(body)):
+            raise GuestCartError("Invalid guest cart token signature")
+
+        try:
+            payload = _b64decode(body)
+            raw = zlib.decompress(payload[1:]) if payload[:1] == b"z" else payload[1:]
+            data = json.loads(raw)
+            lines = [(str(product_id), quantity) for product_id, quantity in data["l"]]
+            issued_at = int(data["t"])
+        except (ValueError, KeyError, TypeError, zlib.error) as e:
+            raise GuestCartError(f"Invalid guest cart token: {str(e)}")
+
+        for _, quantity in lines:
+            if type(quantity) is not int or not 0 < quantity <= self.MAX_QUANTITY:
+                raise GuestCartError(f"Invalid guest cart quantity: {quantity!r}")
+
+        if time.time() - issued_at > self.TOKEN_TTL:
+            raise GuestCartError("Guest cart token has expired")
+        return lines
+
+    def set_quantity(self, token: str, product_id: str, quantity: int, add: bool = False) -> str:
+        """Новый токен с измененным количеством товара (0 - удалить строку)"""
+        from database import Database
+
+        lines = dict(self.decode(token))
+        if add:
+            quantity += lines.get(product_id, 0)
+        if quantity <= 0:
+            lines.pop(product_id, None)
+        else:
+            if product_id not in lines:
+                if Database.get_product_index().by_id.get(product_id) is None:
+                    raise GuestCartError("Product not found")
+                if len(lines) >= self.MAX_LINES:
+                    raise GuestCartError(f"Guest cart is limited to {self.MAX_LINES} lines")
+            lines[product_id] = min(quantity, self.MAX_QUANTITY)
+        return self.encode(list(lines.items()))
+
+    def view(self, token: str) -> Dict[str, Any]:
+        """Представление корзины гостя с актуальными ценами и итогами"""
+        from services.cart_service import get_cart_view_engine
+
+        lines = [
+            {"id": product_id, "product_id": product_id, "quantity": quantity}
+            for product_id, quantity in self.decode(token)
+        ]
+        return get_cart_view_engine().price_lines(lines)
+
+    def merge(self, user_id: str, token: str) -> int:
+        """Перенос корзины гостя в корзину пользователя; неверный токен не
+        мешает входу и просто игнорируется. Повторный перенос того же токена
+        (повтор запроса входа) количества не меняет"""
+        from database import Database
+
+        try:
+            lines = self.decode(token)
+        except GuestCartError as e:
+            logger.warning(f"Guest cart not merged for user {user_id}: {str(e)}")
+            return 0
+        if not lines:
+            return 0
+        Database.merge_into_cart(user_id, lines)
+        return len(lines)
+
+# Глобальный экземпляр сервиса
+guest_cart_service = GuestCartService()
+
+def get_guest_cart_service() -> GuestCartService:
+    """Получение сервиса корзины гостя"""
+    return guest_cart_service
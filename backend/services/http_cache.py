@@ -0,0 +1,52 @@
+"""
+HTTP Cache
+Условные запросы для публичных read-only маршрутов: ETag строится из
+состояния файлов коллекций (одинакового во всех воркерах), а не из тела
+ответа, поэтому If-None-Match проверяется и 304 отдается до чтения данных. Для каждого маршрута задается своя
+политика Cache-Control со stale-while-revalidate
+"""
+
+import hashlib
+from typing import Optional
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+CACHE_POLICIES = {
+    "products": "public, max-age=60, stale-while-revalidate=600",
+    "product": "public, max-age=300, stale-while-revalidate=3600",
+    "page": "public, max-age=300, stale-while-revalidate=3600",
+    "site_settings": "public, max-age=600, stale-while-revalidate=86400",
+    # Админские данные не должны оседать в общих кэшах, но 304 допустим
+    "seo_settings": "private, no-cache"
+}
+
+def make_etag(policy: str, *files: str) -> str:
+    from database import collection_etag
+
+    state = "|".join(collection_etag(file_path) for file_path in files)
+    digest = hashlib.sha1(f"{policy}|{state}".encode("utf-8")).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Слабое сравнение ETag (RFC 9110): префикс W/ не учитывается"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith("W/") else tag) == opaque:
+            return True
+    return False
+
+def conditional(request: Request, response: Response, policy: str, *files: str) -> Optional[Response]:
+    """Проставляет ETag и Cache-Control; возвращает 304, если клиент уже
+    имеет актуальную версию"""
+    etag = make_etag(policy, *files)
+    headers = {"ETag": etag, "Cache-Control": CACHE_POLICIES[policy]}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
@@ -0,0 +1,191 @@
+"""
+Idempotency Service
+Поддержка заголовка Idempotency-Key: повтор запроса с тем же ключом
+возвращает сохраненный ответ, параллельные дубликаты ждут первое
+выполнение, записи хранятся с TTL. Ключи живут в области (scope) владельца
+запроса, хранилище общее для воркеров: запись занимается и сохраняется под
+файловой блокировкой, выполнение в другом воркере видно как in_progress
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Dict, Any, Optional, Callable, Awaitable, Tuple
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+class IdempotencyConflictError(Exception):
+    """Ключ уже использован с другими параметрами запроса"""
+
+class IdempotencyInProgressError(Exception):
+    """Запрос с этим ключом еще выполняется в другом воркере"""
+
+class IdempotencyService:
+    TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))
+    MAX_KEY_LENGTH = 64
+    
+    # Сколько держится отметка о выполнении, если воркер упал не сняв ее
+    IN_PROGRESS_TTL = int(os.environ.get("IDEMPOTENCY_IN_PROGRESS_TTL", "120"))
+    # Сколько дубликат ждет завершения выполнения в другом воркере
+    IN_PROGRESS_WAIT = float(os.environ.get("IDEMPOTENCY_IN_PROGRESS_WAIT", "10"))
+    POLL_INTERVAL = 0.1
+    
+    def __init__(self):
+        # Выполняющиеся в этом процессе запросы: ключ -> future с результатом
+        self._in_flight: Dict[str, asyncio.Future] = {}
+    
+    @staticmethod
+    def fingerprint(method: str, path: str, body: Any) -> str:
+        """Отпечаток запроса: метод, путь и канонический JSON тела"""
+        canonical = json.dumps(body, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(f"{method} {path}\n{canonical}".encode("utf-8")).hexdigest()
+    
+    @staticmethod
+    def provider_key(scope: str, key: str) -> str:
+        """Ключ идемпотентности для внешнего API (YooKassa): одинаковые
+        ключи разных пользователей не должны совпасть и у провайдера"""
+        return hashlib.sha256(f"{scope}:{key}".encode("utf-8")).hexdigest()
+    
+    def _evict_expired(self, records: Dict[str, Dict[str, Any]]):
+        now = time.time()
+        for key in [k for k, r in records.items() if r.get("expires_at", 0) <= now]:
+            del records[key]
+    
+    def _claim(self, key: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """Занять ключ для выполнения. Если ключ уже занят - возвращает его
+        запись (готовый ответ или чужое выполнение), иначе None"""
+        from database import load_json, save_json, collection_lock, IDEMPOTENCY_FILE
+        
+        now = time.time()
+        with collection_lock(IDEMPOTENCY_FILE):
+            records = load_json(IDEMPOTENCY_FILE, {})
+            record = records.get(key)
+            if record and record.get("expires_at", 0) > now:
+                return record
+            self._evict_expired(records)
+            records[key] = {
+                "fingerprint": fingerprint,
+                "status": "in_progress",
+                "created_at": now,
+                "expires_at": now + self.IN_PROGRESS_TTL
+            }
+            save_json(IDEMPOTENCY_FILE, records)
+        return None
+    
+    def _store(self, key: str, fingerprint: str, status_code: int, body: Any):
+        from database import load_json, save_json, collection_lock, IDEMPOTENCY_FILE
+        
+        with collection_lock(IDEMPOTENCY_FILE):
+            records = load_json(IDEMPOTENCY_FILE, {})
+            self._evict_expired(records)
+            records[key] = {
+                "fingerprint": fingerprint,
+                "status": "completed",
+                "status_code": status_code,
+                "body": body,
+                "created_at": time.time(),
+                "expires_at": time.time() + self.TTL_SECONDS
+            }
+            save_json(IDEMPOTENCY_FILE, records)
+    
+    def _release(self, key: str):
+        """Снять отметку о выполнении после ошибки: клиент может повторить запрос"""
+        from database import load_json, save_json, collection_lock, IDEMPOTENCY_FILE
+        
+        with collection_lock(IDEMPOTENCY_FILE):
+            records = load_json(IDEMPOTENCY_FILE, {})
+            if (records.get(key) or {}).get("status") == "in_progress":
+                del records[key]
+                save_json(IDEMPOTENCY_FILE, records)
+    
+    def _check(self, record: Dict[str, Any], fingerprint: str) -> Tuple[int, Any]:
+        if record["fingerprint"] != fingerprint:
+            raise IdempotencyConflictError("Idempotency-Key уже использован с другими параметрами запроса")
+        return record["status_code"], record["body"]
+    
+    async def execute(
+        self,
+        scope: str,
+        key: str,
+        fingerprint: str,
+        handler: Callable[[], Awaitable[Any]]
+    ) -> Tuple[int, Any, bool]:
+        """Выполнение обработчика один раз на ключ.
+        Возвращает (HTTP статус, тело ответа, был ли ответ повтором)"""
+        if len(key) > self.MAX_KEY_LENGTH:
+            raise IdempotencyConflictError(f"Idempotency-Key длиннее {self.MAX_KEY_LENGTH} символов")
+        
+        record_key = f"{scope}:{key}"
+        waited = 0.0
+        while True:
+            pending = self._in_flight.get(record_key)
+            if pending is not None:
+                # Дубликат в этом же процессе: ждем первый запрос и берем его результат.
+                # Если первый запрос упал, результата нет - пробуем сами
+                try:
+                    result_fingerprint, status_code, body = await asyncio.shield(pending)
+                except Exception:
+                    continue
+                return (*self._check({"fingerprint": result_fingerprint, "status_code": status_code, "body": body},
+                                     fingerprint), True)
+            
+            future = asyncio.get_running_loop().create_future()
+            self._in_flight[record_key] = future
+            try:
+                record = await asyncio.to_thread(self._claim, record_key, fingerprint)
+            except BaseException:
+                self._in_flight.pop(record_key, None)
+                future.cancel()
+                raise
+            if record is None:
+                break
+            
+            self._in_flight.pop(record_key, None)
+            if record.get("status") != "in_progress":
+                future.cancel()
+                status_code, body = self._check(record, fingerprint)
+                return status_code, body, True
+            
+            # Ключ выполняется в другом воркере: ждем сохраненный ответ
+            future.cancel()
+            if record["fingerprint"] != fingerprint:
+                raise IdempotencyConflictError("Idempotency-Key уже использован с другими параметрами запроса")
+            if waited >= self.IN_PROGRESS_WAIT:
+                raise IdempotencyInProgressError("Запрос с этим Idempotency-Key еще выполняется")
+            await asyncio.sleep(self.POLL_INTERVAL)
+            waited += self.POLL_INTERVAL
+        
+        try:
+            try:
+                body = await handler()
+                status_code = 200
+            except HTTPException as e:
+                if e.status_code >= 500:
+                    # Серверные ошибки не фиксируем: клиент может повторить запрос
+                    raise
+                status_code, body = e.status_code, {"detail": e.detail}
+            
+            await asyncio.to_thread(self._store, record_key, fingerprint, status_code, body)
+            future.set_result((fingerprint, status_code, body))
+            return status_code, body, False
+        except BaseException as e:
+            await asyncio.shield(asyncio.to_thread(self._release, record_key))
+            if not future.done():
+                future.set_exception(e if isinstance(e, Exception) else asyncio.CancelledError())
+                # Исключение получат ожидающие дубликаты; не даем asyncio ругаться на неполученное
+                future.exception()
+            raise
+        finally:
+            self._in_flight.pop(record_key, None)
+
+# Глобальный экземпляр сервиса
+idempotency_service = IdempotencyService()
+
+def get_idempotency_service() -> IdempotencyService:
+    """Получение экземпляра сервиса идемпотентности"""
+    return idempotency_service
@@ -0,0 +1,159 @@
+"""
+Image Service
+Производные изображения (уменьшенные копии, WebP/AVIF): генерация в пуле
+процессов, кэш на диске под детерминированным ключом, рендер по запросу
+один раз и далее чтение из кэша
+"""
+
+import asyncio
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+try:
+    from PIL import Image, ImageOps, features
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVES_DIR = Path(os.environ.get("MEDIA_CACHE_DIR", "/app/media_cache"))
+
+# Параметры кодирования для поддерживаемых форматов
+FORMATS = {
+    "webp": {"pil_format": "WEBP", "content_type": "image/webp", "options": {"quality": 80, "method": 4}},
+    "avif": {"pil_format": "AVIF", "content_type": "image/avif", "options": {"quality": 60}},
+    "jpeg": {"pil_format": "JPEG", "content_type": "image/jpeg", "options": {"quality": 85, "optimize": True, "progressive": True}},
+    "png": {"pil_format": "PNG", "content_type": "image/png", "options": {"optimize": True}},
+}
+
+def render_derivative(source_path: str, target_path: str, width: Optional[int], fmt: str) -> int:
+    """Рендер производного изображения (выполняется в отдельном процессе).
+    Запись через временный файл, чтобы кэш не содержал недописанных файлов"""
+    spec = FORMATS[fmt]
+    temp_path = f"{target_path}.{os.getpid()}.part"
+    
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        if width and image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS)
+        
+        if spec["pil_format"] == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA")
+        
+        image.save(temp_path, spec["pil_format"], **spec["options"])
+    
+    os.replace(temp_path, target_path)
+    return os.path.getsize(target_path)
+
+class ImageService:
+    # Допустимые ширины: запрошенная ширина округляется вверх до ближайшей,
+    # чтобы произвольные ?w= не раздували кэш
+    WIDTHS = (160, 320, 480, 640, 960, 1280, 1920)
+    # Производные, которые готовятся сразу после загрузки
+    PRESETS = ((320, "webp"), (640, "webp"), (1280, "webp"))
+    MAX_WORKERS = int(os.environ.get("IMAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
+    
+    SOURCE_TYPES = {"image/jpeg", "image/png", "image/webp", "image/gif", "image/bmp", "image/tiff"}
+    
+    def __init__(self, cache_dir: Path = DERIVATIVES_DIR):
+        self.cache_dir = cache_dir
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # Рендеры в процессе: ключ -> future, параллельные запросы ждут один рендер
+        self._in_flight: Dict[str, asyncio.Future] = {}
+    
+    @property
+    def available(self) -> bool:
+        return PIL_AVAILABLE
+    
+    def supports_format(self, fmt: str) -> bool:
+        if not PIL_AVAILABLE or fmt not in FORMATS:
+            return False
+        if fmt in ("webp", "avif"):
+            return features.check(fmt)
+        return True
+    
+    def is_processable(self, media: Dict[str, Any]) -> bool:
+        return PIL_AVAILABLE and media.get("content_type") in self.SOURCE_TYPES
+    
+    def normalize_width(self, width: Optional[int]) -> Optional[int]:
+        if not width:
+            return None
+        for allowed in self.WIDTHS:
+            if width <= allowed:
+                return allowed
+        return self.WIDTHS[-1]
+    
+    def negotiate_format(self, fmt: Optional[str], accept: str, media: Dict[str, Any]) -> str:
+        """Выбор формата: явный ?fmt= или лучший из поддерживаемых клиентом (fmt=auto)"""
+        if fmt and fmt != "auto":
+            fmt = "jpeg" if fmt == "jpg" else fmt
+            if self.supports_format(fmt):
+                return fmt
+        for candidate in ("avif", "webp"):
+            if f"image/{candidate}" in (accept or "") and self.supports_format(candidate):
+                return candidate
+        return "png" if media.get("content_type") in ("image/png", "image/gif") else "jpeg"
+    
+    def cache_key(self, media: Dict[str, Any], width: Optional[int], fmt: str) -> str:
+        """Детерминированный ключ: содержимое источника + параметры рендера"""
+        source_key = media.get("sha256") or media["id"]
+        return f"{source_key}-w{width or 0}.{fmt}"
+    
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.MAX_WORKERS)
+        return self._executor
+    
+    async def get_derivative(self, media: Dict[str, Any], width: Optional[int], fmt: str) -> Path:
+        """Путь к производному изображению; рендерит его при первом обращении"""
+        key = self.cache_key(media, width, fmt)
+        target_path = self.cache_dir / key
+        if target_path.exists():
+            return target_path
+        
+        pending = self._in_flight.get(key)
+        if pending is None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            loop = asyncio.get_running_loop()
+            pending = loop.run_in_executor(
+                self._get_executor(), render_derivative,
+                media["file_path"], str(target_path), width, fmt
+            )
+            self._in_flight[key] = pending
+            pending.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        
+        await asyncio.shield(pending)
+        return target_path
+    
+    async def generate_presets(self, media: Dict[str, Any]):
+        """Фоновая генерация стандартных производных после загрузки"""
+        if not self.is_processable(media):
+            return
+        
+        for width, fmt in self.PRESETS:
+            if not self.supports_format(fmt):
+                continue
+            try:
+                await self.get_derivative(media, width, fmt)
+            except Exception as e:
+                logger.warning(f"Derivative {width}/{fmt} for {media.get('id')} failed: {str(e)}")
+                return
+    
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+# Глобальный экземпляр сервиса
+image_service = ImageService()
+
+def get_image_service() -> ImageService:
+    """Получение экземпляра сервиса изображений"""
+    return image_service
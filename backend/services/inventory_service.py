@@ -0,0 +1,359 @@
+"""
+Inventory Service
+Индекс остатков: отсортированные по stock_quantity списки товаров в
+каждой категории с настраиваемыми порогами низкого остатка. Обновляется
+по событиям изменения товаров, запросы low/out-of-stock без сканирования
+всего каталога.
+Резервирование остатков при оформлении заказа: атомарное резервирование
+всех строк корзины под файловой блокировкой каталога, истечение резервов
+неоплаченных заказов, списание/возврат по результату оплаты.
+Ограничение: остатки хранятся в общем products.json, и каждый резерв
+перезаписывает файл целиком под одной блокировкой. Поэтому резервы
+выполняются строго по одному, даже для разных товаров, и пропускная
+способность не растет с числом SKU. Раздельные блокировки по товарам здесь
+не помогут, пока запись каталога остается одной
+"""
+
+import bisect
+import heapq
+import itertools
+import logging
+import os
+import threading
+from collections import defaultdict
+from typing import Dict, Any, List, Optional, Tuple
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOW_STOCK_THRESHOLD = 5
+
+def _quantity(product: Dict[str, Any]) -> int:
+    try:
+        return int(product.get("stock_quantity") or 0)
+    except (TypeError, ValueError):
+        return 0
+
+class StockIndex:
+    def __init__(self):
+        from database import ChangeTracker
+        
+        self._lock = threading.RLock()
+        # Версия products.json, которой соответствует индекс
+        self.tracker = ChangeTracker()
+        self._reset()
+        self.thresholds: Dict[str, int] = {"default": DEFAULT_LOW_STOCK_THRESHOLD}
+    
+    def _reset(self):
+        # Категория -> отсортированный список (остаток, id товара)
+        self.by_category: Dict[str, List[Tuple[int, str]]] = {}
+        # id товара -> (остаток, категория)
+        self.entries: Dict[str, Tuple[int, str]] = {}
+    
+    def _insert(self, product: Dict[str, Any]):
+        product_id = product.get("id")
+        if product_id is None or product_id in self.entries:
+            return
+        entry = (_quantity(product), product.get("category") or "")
+        self.entries[product_id] = entry
+        bisect.insort(self.by_category.setdefault(entry[1], []), (entry[0], product_id))
+    
+    def _remove(self, product_id: Optional[str]):
+        entry = self.entries.pop(product_id, None)
+        if entry is None:
+            return
+        items = self.by_category.get(entry[1], [])
+        position = bisect.bisect_left(items, (entry[0], product_id))
+        if position < len(items) and items[position] == (entry[0], product_id):
+            items.pop(position)
+    
+    def threshold(self, category: str) -> int:
+        return int(self.thresholds.get(category, self.thresholds.get("default", DEFAULT_LOW_STOCK_THRESHOLD)))
+    
+    def load_thresholds(self):
+        from database import Database
+        
+        thresholds = Database.get_settings().get("low_stock_thresholds") or {}
+        with self._lock:
+            self.thresholds = {"default": DEFAULT_LOW_STOCK_THRESHOLD, **thresholds}
+    
+    def rebuild(self):
+        """Полное построение индекса из products.json"""
+        from database import Database, PRODUCTS_FILE, collection_snapshot
+        
+        with self._lock:
+            products, version = collection_snapshot(PRODUCTS_FILE, Database.get_products)
+            self._reset()
+            for product in products:
+                self._insert(product)
+            self.tracker.rebuilt(version)
+        self.load_thresholds()
+        logger.info(f"Stock index built for {len(self.entries)} products")
+    
+    def handle_change(self, file_path: str, action: str, item: Dict[str, Any], previous: Optional[Dict[str, Any]]):
+        """Подписчик на изменения товаров"""
+        from database import PRODUCTS_FILE, collection_version
+        
+        if file_path != PRODUCTS_FILE:
+            return
+        
+        with self._lock:
+            version = collection_version(PRODUCTS_FILE)
+            decision = self.tracker.classify(version)
+            if decision == self.tracker.SKIP:
+                # Изменение уже вошло в снимок последнего построения
+                return
+            if decision == self.tracker.REBUILD:
+                self.rebuild()
+                return
+            
+            self._remove(item.get("id"))
+            if action != "delete":
+                self._insert(item)
+            self.tracker.applied(version)
+    
+    def _ensure_fresh(self):
+        from database import load_json, PRODUCTS_FILE, collection_version
+        
+        load_json(PRODUCTS_FILE)
+        if self.tracker.version != collection_version(PRODUCTS_FILE):
+            self.rebuild()
+    
+    def _ranges(self, category: Optional[str], low: bool, out: bool):
+        """Срезы отсортированных списков, попадающие в запрошенные состояния"""
+        categories = [category] if category is not None else list(self.by_category)
+        ranges = []
+        for name in categories:
+            items = self.by_category.get(name, [])
+            # Остаток <= 0 - нет в наличии; 0 < остаток <= порог - мало
+            out_end = bisect.bisect_right(items, (0, "\uffff"))
+            low_end = bisect.bisect_right(items, (self.threshold(name), "\uffff"))
+            start = 0 if out else out_end
+            end = low_end if low else out_end
+            if end > start:
+                ranges.append(items[start:end])
+        return ranges
+    
+    def counts(self) -> Dict[str, int]:
+        """Количество товаров с низким остатком и без остатка"""
+        self._ensure_fresh()
+        with self._lock:
+            out_of_stock = sum(len(r) for r in self._ranges(None, low=False, out=True))
+            low_stock = sum(len(r) for r in self._ranges(None, low=True, out=False))
+        return {"low_stock": low_stock, "out_of_stock": out_of_stock}
+    
+    def query(
+        self,
+        category: Optional[str] = None,
+        include_out_of_stock: bool = False,
+        only_out_of_stock: bool = False,
+        page: int = 1,
+        per_page: int = 50
+    ) -> Dict[str, Any]:
+        """Товары с низким остатком по возрастанию остатка, с пагинацией"""
+        from database import Database
+        
+        self._ensure_fresh()
+        low = not only_out_of_stock
+        out = include_out_of_stock or only_out_of_stock
+        with self._lock:
+            ranges = self._ranges(category, low=low, out=out)
+            total = sum(len(r) for r in ranges)
+            offset = (page - 1) * per_page
+            page_items = list(itertools.islice(heapq.merge(*ranges), offset, offset + per_page))
+        
+        product_index = Database.get_product_index()
+        items = []
+        for quantity, product_id in page_items:
+            product = product_index.by_id.get(product_id)
+            if product:
+                items.append({
+                    **product,
+                    "low_stock_threshold": self.threshold(product.get("category") or "")
+                })
+        
+        return {
+            "items": items,
+            "total": total,
+            "page": page,
+            "per_page": per_page,
+            "pages": (total + per_page - 1) // per_page
+        }
+
+# Глобальный экземпляр сервиса
+stock_index = StockIndex()
+
+def get_stock_index() -> StockIndex:
+    """Получение экземпляра индекса остатков"""
+    return stock_index
+
+class InsufficientStockError(Exception):
+    """Недостаточно остатка для резервирования"""
+    
+    def __init__(self, shortages: List[Dict[str, Any]]):
+        super().__init__("Недостаточно товара на складе")
+        self.shortages = shortages
+
+class ReservationEngine:
+    """Резерв списывается из stock_quantity при создании заказа и хранится в
+    заказе (order["reservation"]), поэтому переживает перезапуск. Проверка и
+    списание выполняются одной операцией под файловой блокировкой каталога
+    (Database.reserve_stock), общей для всех воркеров: все оформления
+    заказов, в том числе по разным товарам, резервируют последовательно"""
+    
+    RESERVATION_TTL = timedelta(minutes=int(os.environ.get("RESERVATION_TTL_MINUTES", "30")))
+    
+    def __init__(self):
+        # Очередь истечения: (expires_at, order_id)
+        self._expiry_heap: List[Tuple[str, str]] = []
+        self._heap_lock = threading.Lock()
+    
+    @staticmethod
+    def _merge_lines(lines: List[Dict[str, Any]]) -> Dict[str, int]:
+        quantities: Dict[str, int] = defaultdict(int)
+        for line in lines:
+            quantities[line["product_id"]] += int(line.get("quantity") or 0)
+        return {pid: qty for pid, qty in quantities.items() if qty > 0}
+    
+    def reserve(self, lines: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Атомарное резервирование всех строк: либо все, либо ничего"""
+        from database import Database
+        
+        quantities = self._merge_lines(lines)
+        shortages = Database.reserve_stock(quantities)
+        if shortages:
+            raise InsufficientStockError(shortages)
+        
+        now = datetime.now()
+        return {
+            "status": "reserved",
+            "lines": [{"product_id": pid, "quantity": qty} for pid, qty in quantities.items()],
+            "reserved_at": now.isoformat(),
+            "expires_at": (now + self.RESERVATION_TTL).isoformat()
+        }
+    
+    def return_stock(self, lines: List[Dict[str, Any]]):
+        """Возврат товара в остаток (отмена резерва или компенсация)"""
+        from database import Database
+        
+        Database.adjust_stock(self._merge_lines(lines))
+    
+    def track(self, order: Dict[str, Any]):
+        """Поставить резерв заказа в очередь истечения"""
+        reservation = order.get("reservation") or {}
+        if reservation.get("status") == "reserved":
+            with self._heap_lock:
+                heapq.heappush(self._expiry_heap, (reservation["expires_at"], order["id"]))
+    
+    def _transition(self, order_id: str, new_status: str, order_update: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Перевод резерва из reserved в committed/released/expired (идемпотентно).
+        Переходы одного заказа в разных воркерах выполняются по очереди"""
+        from database import Database, ORDERS_FILE, collection_lock
+        
+        with collection_lock(ORDERS_FILE):
+            order = Database.get_order(order_id)
+            reservation = (order or {}).get("reservation")
+            if not reservation:
+                return order
+            
+            if reservation.get("status") != "reserved":
+                if new_status == "committed" and reservation.get("status") in ("expired", "released"):
+                    return self._commit_released(order, reservation)
+                return order
+            
+            if new_status != "committed":
+                self.return_stock(reservation.get("lines", []))
+            
+            return Database.update_order(order_id, {
+                **order_update,
+                "reservation": {
+                    **reservation,
+                    "status": new_status,
+                    f"{new_status}_at": datetime.now().isoformat()
+                }
+            })
+    
+    def _commit_released(self, order: Dict[str, Any], reservation: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Оплата пришла после того, как резерв истек или был снят: товар
+        резервируется заново, а если его уже нет - заказ помечается к возврату
+        денег. Вызывается под блокировкой заказов"""
+        from database import Database
+        
+        now = datetime.now().isoformat()
+        shortages = Database.reserve_stock(self._merge_lines(reservation.get("lines", [])))
+        if not shortages:
+            logger.warning(f"Order {order['id']} paid after its reservation was {reservation['status']}, stock reserved again")
+            return Database.update_order(order["id"], {
+                "status": "paid",
+                "reservation": {**reservation, "status": "committed", "committed_at": now, "rereserved_at": now}
+            })
+        
+        logger.error(f"Order {order['id']} paid after its reservation was {reservation['status']}, "
+                     f"stock is no longer available: refund required")
+        return Database.update_order(order["id"], {
+            "status": "paid",
+            "refund_required": True,
+            "reservation": {**reservation, "shortages": shortages, "paid_at": now}
+        })
+    
+    def commit(self, order_id: str) -> Optional[Dict[str, Any]]:
+        """Оплата прошла: резерв становится окончательным списанием"""
+        return self._transition(order_id, "committed", {"status": "paid"})
+    
+    def release(self, order_id: str, status: str = "cancelled") -> Optional[Dict[str, Any]]:
+        """Оплата отменена: товар возвращается в остаток"""
+        return self._transition(order_id, "released", {"status": status})
+    
+    def expire_stale(self) -> int:
+        """Снятие просроченных резервов неоплаченных заказов"""
+        now = datetime.now().isoformat()
+        expired = 0
+        while True:
+            with self._heap_lock:
+                if not self._expiry_heap or self._expiry_heap[0][0] > now:
+                    break
+                _, order_id = heapq.heappop(self._expiry_heap)
+            
+            order = self._transition(order_id, "expired", {"status": "cancelled"})
+            if order and (order.get("reservation") or {}).get("status") == "expired":
+                expired += 1
+        
+        if expired:
+            logger.info(f"Expired {expired} stock reservations")
+        return expired
+    
+    def load_pending(self):
+        """Восстановление очереди истечения из заказов после перезапуска"""
+        from database import Database
+        
+        with self._heap_lock:
+            self._expiry_heap = []
+        for order in Database.get_orders():
+            self.track(order)
+
+# Глобальный экземпляр сервиса
+reservation_engine = ReservationEngine()
+
+def get_reservation_engine() -> ReservationEngine:
+    """Получение экземпляра движка резервирования"""
+    return reservation_engine
+
+async def run_reservation_sweeper(interval: float = 60.0):
+    """Фоновая задача: периодическое снятие просроченных резервов"""
+    import asyncio
+    
+    while True:
+        try:
+            await asyncio.to_thread(reservation_engine.expire_stale)
+        except Exception as e:
+            logger.error(f"Reservation sweeper error: {str(e)}")
+        await asyncio.sleep(interval)
+
+def init_inventory():
+    """Подписка на изменения товаров и первичное построение индекса"""
+    from database import on_change
+    
+    on_change(stock_index.handle_change)
+    stock_index.rebuild()
+    reservation_engine.load_pending()
+    return stock_index
@@ -0,0 +1,317 @@
+"""
+Media Service
+Потоковая загрузка медиафайлов: чтение частями, запись без блокировки
+event loop, подсчет SHA-256 и контроль размера на лету, атомарная фиксация.
+Файлы хранятся по адресу содержимого ({sha256}{ext}) с дедупликацией
+и счетчиком ссылок в media.json
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Any, Optional, Set, Tuple
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = Path(os.environ.get("UPLOAD_DIR", "/app/uploads"))
+
+# Имя файла, адресованного по содержимому: 64 hex-символа SHA-256 и расширение
+CONTENT_ADDRESSED_NAME = re.compile(r"^[0-9a-f]{64}(\.[A-Za-z0-9]+)?$")
+# Ссылка на blob в данных (image_url, HTML страниц): /uploads/{sha256}{ext}
+UPLOAD_REFERENCE = re.compile(r"/uploads/([0-9a-f]{64}(?:\.[A-Za-z0-9]+)?)")
+
+# Типы, которые отдаются inline, и их сигнатуры. SVG и HTML сюда не входят:
+# браузер выполнит встроенные в них скрипты на домене сайта
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+def sniff_image_type(path: Path) -> Optional[str]:
+    """MIME изображения по первым байтам файла; None - не изображение из списка"""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(16)
+    except OSError:
+        return None
+    for signature, content_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:12] in (b"ftypavif", b"ftypavis"):
+        return "image/avif"
+    return None
+
+def upload_response_headers(path: Path) -> Tuple[str, Dict[str, str]]:
+    """Тип и заголовки для отдачи загруженного файла. Тип берется из
+    содержимого, а не из заявленного при загрузке: inline отдаются только
+    изображения, остальное - как вложение"""
+    headers = {"X-Content-Type-Options": "nosniff"}
+    content_type = sniff_image_type(path)
+    if content_type is None:
+        content_type = "application/octet-stream"
+        headers["Content-Disposition"] = f'attachment; filename="{path.name}"'
+    return content_type, headers
+
+def is_content_addressed(filename: str) -> bool:
+    """Имя файла однозначно определяется его содержимым (неизменяемый файл)"""
+    return bool(CONTENT_ADDRESSED_NAME.match(filename))
+
+class MediaUploadError(Exception):
+    """Ошибка загрузки с HTTP статусом для ответа клиенту"""
+    
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+class MediaService:
+    # Размер блока чтения/записи - память на загрузку не зависит от размера файла
+    CHUNK_SIZE = 1024 * 1024
+    MAX_FILE_SIZE = int(os.environ.get("MEDIA_MAX_FILE_SIZE", str(50 * 1024 * 1024)))
+    
+    # Незавершенные временные файлы старше этого возраста удаляет сборщик мусора
+    STALE_TEMP_AGE = 3600
+    # Blob без ссылок удаляется не раньше, чем через этот срок после записи:
+    # файл могли загрузить, но еще не сохранить товар или страницу с ним
+    ORPHAN_GRACE_PERIOD = float(os.environ.get("MEDIA_GC_GRACE_PERIOD", str(24 * 3600)))
+    
+    def __init__(self, upload_dir: Path = UPLOAD_DIR):
+        self.upload_dir = upload_dir
+        # Проверка дубликата и запись в индекс должны быть одной операцией
+        self._commit_lock = threading.Lock()
+    
+    async def _stream_to_temp(self, upload) -> Dict[str, Any]:
+        """Запись загрузки во временный файл блоками с подсчетом хеша и размера"""
+        if getattr(upload, "size", None) is not None and upload.size > self.MAX_FILE_SIZE:
+            raise MediaUploadError(
+                f"Файл превышает допустимый размер {self.MAX_FILE_SIZE} байт",
+                status_code=413
+            )
+        
+        self.upload_dir.mkdir(parents=True, exist_ok=True)
+        temp_path = self.upload_dir / f".{uuid.uuid4()}.part"
+        
+        digest = hashlib.sha256()
+        size = 0
+        buffer = await asyncio.to_thread(open, temp_path, "wb")
+        try:
+            while True:
+                chunk = await upload.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                
+                size += len(chunk)
+                if size > self.MAX_FILE_SIZE:
+                    raise MediaUploadError(
+                        f"Файл превышает допустимый размер {self.MAX_FILE_SIZE} байт",
+                        status_code=413
+                    )
+                
+                digest.update(chunk)
+                await asyncio.to_thread(buffer.write, chunk)
+            
+            await asyncio.to_thread(buffer.flush)
+            await asyncio.to_thread(os.fsync, buffer.fileno())
+        except BaseException:
+            await asyncio.to_thread(buffer.close)
+            temp_path.unlink(missing_ok=True)
+            raise
+        
+        await asyncio.to_thread(buffer.close)
+        return {"temp_path": temp_path, "sha256": digest.hexdigest(), "size": size}
+    
+    def _commit(self, streamed: Dict[str, Any], original_filename: Optional[str],
+                content_type: Optional[str]) -> Tuple[Dict[str, Any], bool]:
+        """Фиксация загрузки: дубликат ссылается на существующий blob.
+        Поиск дубликата и запись идут под блокировкой media.json, общей для
+        воркеров: удаление между ними не оставит blob без записи"""
+        from database import Database, collection_lock, MEDIA_FILE
+        
+        sha256 = streamed["sha256"]
+        with self._commit_lock, collection_lock(MEDIA_FILE):
+            existing = Database.get_media_by_sha256(sha256)
+            if existing and (self.upload_dir / existing["filename"]).exists():
+                referenced = Database.add_media_reference(existing["id"])
+                if referenced is not None:
+                    streamed["temp_path"].unlink(missing_ok=True)
+                    return referenced, True
+            
+            file_extension = Path(original_filename or "").suffix.lower()
+            blob_filename = f"{sha256}{file_extension}"
+            file_path = self.upload_dir / blob_filename
+            
+            # Атомарная фиксация: файл появляется под итоговым именем только целиком
+            os.replace(streamed["temp_path"], file_path)
+            
+            file_info = {
+                "id": str(uuid.uuid4()),
+                "original_filename": original_filename,
+                "filename": blob_filename,
+                "file_path": str(file_path),
+                "url": f"/uploads/{blob_filename}",
+                "content_type": content_type,
+                "size": streamed["size"],
+                "sha256": sha256,
+                "ref_count": 1,
+                "uploaded_at": datetime.now().isoformat()
+            }
+            Database.add_media_file(file_info)
+            return file_info, False
+    
+    async def save_upload(self, upload) -> Tuple[Dict[str, Any], bool]:
+        """Сохранение загруженного файла; возвращает (запись media.json, дубликат ли)"""
+        streamed = await self._stream_to_temp(upload)
+        try:
+            return await asyncio.to_thread(self._commit, streamed, upload.filename, upload.content_type)
+        finally:
+            streamed["temp_path"].unlink(missing_ok=True)
+    
+    def _remove_derivatives(self, sha256: str):
+        from services.image_service import DERIVATIVES_DIR
+        
+        if DERIVATIVES_DIR.exists():
+            for derivative in DERIVATIVES_DIR.glob(f"{sha256}-w*"):
+                derivative.unlink(missing_ok=True)
+    
+    @staticmethod
+    def _content_references() -> Set[str]:
+        """Имена blob'ов, на которые ссылаются товары, страницы и настройки
+        (image_url, HTML страниц, логотипы) по адресу /uploads/..."""
+        from database import Database
+        
+        collections = [
+            Database.get_products(),
+            Database.get_pages(),
+            Database.get_settings(),
+            Database.get_site_settings(),
+            Database.get_seo_settings()
+        ]
+        referenced = set()
+        for data in collections:
+            text = json.dumps(data, ensure_ascii=False)
+            referenced.update(UPLOAD_REFERENCE.findall(text))
+        return referenced
+    
+    def release(self, media_id: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """Снятие ссылки на медиафайл (см. Database.release_media_file) под той
+        же блокировкой, что и фиксация загрузок"""
+        from database import Database
+        
+        with self._commit_lock:
+            return Database.release_media_file(media_id)
+    
+    def collect_garbage(self) -> Dict[str, int]:
+        """Удаление blob'ов без ссылок и брошенных временных файлов. Ссылкой
+        считается запись media.json или упоминание в товарах, страницах и
+        настройках; свежие blob'ы не трогаем в течение ORPHAN_GRACE_PERIOD.
+        Файлы со старыми (uuid) именами не трогаем - на них могут ссылаться товары"""
+        from database import Database
+        
+        if not self.upload_dir.exists():
+            return {"blobs_removed": 0, "temp_removed": 0, "bytes_freed": 0}
+        
+        result = {"blobs_removed": 0, "temp_removed": 0, "bytes_freed": 0}
+        with self._commit_lock:
+            referenced = {f.get("filename") for f in Database.get_media_files()}
+            referenced |= self._content_references()
+            now = time.time()
+            
+            for path in self.upload_dir.iterdir():
+                if not path.is_file():
+                    continue
+                try:
+                    stat = path.stat()
+                    if path.name.endswith(".part"):
+                        if now - stat.st_mtime > self.STALE_TEMP_AGE:
+                            path.unlink()
+                            result["temp_removed"] += 1
+                            result["bytes_freed"] += stat.st_size
+                    elif (
+                        is_content_addressed(path.name)
+                        and path.name not in referenced
+                        and now - stat.st_mtime > self.ORPHAN_GRACE_PERIOD
+                    ):
+                        path.unlink()
+                        result["blobs_removed"] += 1
+                        result["bytes_freed"] += stat.st_size
+                        self._remove_derivatives(path.name[:64])
+                except FileNotFoundError:
+                    continue
+        
+        if result["blobs_removed"] or result["temp_removed"]:
+            logger.info(f"Media GC: {result}")
+        return result
+
+class UploadSizeLimitMiddleware:
+    """ASGI middleware: ограничение тела запросов загрузки до разбора
+    multipart. Starlette сохраняет файл формы целиком еще до вызова
+    маршрута, поэтому лишнее отсекается здесь - по Content-Length сразу,
+    а при chunked-передаче как только прочитано больше лимита"""
+    
+    # Запас на заголовки частей и границы multipart
+    MULTIPART_OVERHEAD = 64 * 1024
+    
+    def __init__(self, app, paths=("/api/admin/media/upload",)):
+        self.app = app
+        self.paths = frozenset(paths)
+    
+    @staticmethod
+    def _error():
+        from fastapi import HTTPException
+        return HTTPException(
+            status_code=413,
+            detail=f"Файл превышает допустимый размер {MediaService.MAX_FILE_SIZE} байт"
+        )
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        
+        limit = MediaService.MAX_FILE_SIZE + self.MULTIPART_OVERHEAD
+        for name, value in scope.get("headers", ()):
+            if name == b"content-length":
+                try:
+                    declared = int(value)
+                except ValueError:
+                    declared = 0
+                if declared > limit:
+                    from fastapi.responses import JSONResponse
+                    error = self._error()
+                    response = JSONResponse({"detail": error.detail}, status_code=error.status_code,
+                                            headers={"Connection": "close"})
+                    await response(scope, receive, send)
+                    return
+                break
+        
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # Исключение прерывает разбор формы и превращается в 413
+                    raise self._error()
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+# Глобальный экземпляр сервиса
+media_service = MediaService()
+
+def get_media_service() -> MediaService:
+    """Получение экземпляра медиа сервиса"""
+    return media_service
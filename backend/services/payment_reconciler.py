@@ -0,0 +1,146 @@
+"""
+Payment Reconciler
+Сверка статусов платежей с YooKassa для случаев потерянного webhook:
+выбор давно незавершенных платежей по индексу, опрос API с ограничением
+параллельности и бюджетом запросов на цикл, экспоненциальная задержка
+для каждого платежа, применение результата через очередь webhook
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Any, Optional, Tuple
+from datetime import datetime, timedelta
+
+from services.webhook_queue import STATUS_EVENTS
+
+logger = logging.getLogger(__name__)
+
+class PaymentReconciler:
+    INTERVAL = float(os.environ.get("PAYMENT_RECONCILE_INTERVAL", "60"))
+    # Платеж считается "зависшим", если webhook не пришел за это время
+    STALE_AFTER = timedelta(minutes=int(os.environ.get("PAYMENT_RECONCILE_STALE_MINUTES", "10")))
+    REQUEST_BUDGET = int(os.environ.get("PAYMENT_RECONCILE_BUDGET", "20"))
+    CONCURRENCY = 4
+    BASE_BACKOFF = 60.0
+    MAX_BACKOFF = 6 * 3600.0
+    
+    def __init__(self):
+        # payment_id -> (число опросов, время следующей проверки)
+        self._backoff: Dict[str, Tuple[int, float]] = {}
+        self.metrics: Dict[str, Any] = {
+            "ticks": 0,
+            "polled": 0,
+            "transitions": 0,
+            "errors": 0,
+            "open_payments": 0,
+            "stale_payments": 0,
+            "deferred_by_budget": 0,
+            "oldest_open_age_seconds": 0,
+            "last_tick_at": None,
+            "last_tick_duration_ms": 0
+        }
+    
+    def _select(self) -> Tuple[list, int, int, float, int]:
+        """Выбор платежей для опроса в пределах бюджета"""
+        from database import Database
+        
+        index = Database.get_payment_index()
+        now = datetime.now()
+        cutoff = (now - self.STALE_AFTER).isoformat()
+        stale = index.open_before(cutoff)
+        
+        oldest_age = 0.0
+        if index.open_by_created:
+            try:
+                oldest_age = (now - datetime.fromisoformat(index.open_by_created[0][0])).total_seconds()
+            except ValueError:
+                pass
+        
+        clock = time.time()
+        due = [p for p in stale if self._backoff.get(p["payment_id"], (0, 0.0))[1] <= clock]
+        # Сначала платежи, которые опрашивали реже всего
+        due.sort(key=lambda p: self._backoff.get(p["payment_id"], (0, 0.0))[0])
+        return due[:self.REQUEST_BUDGET], len(index.open_by_created), len(stale), oldest_age, max(0, len(due) - self.REQUEST_BUDGET)
+    
+    def _defer(self, payment_id: str):
+        attempts, _ = self._backoff.get(payment_id, (0, 0.0))
+        delay = min(self.BASE_BACKOFF * 2 ** attempts, self.MAX_BACKOFF)
+        self._backoff[payment_id] = (attempts + 1, time.time() + delay)
+    
+    async def _poll(self, yoomoney, payment: Dict[str, Any], semaphore: asyncio.Semaphore) -> bool:
+        from services.webhook_queue import get_webhook_queue
+        
+        payment_id = payment["payment_id"]
+        async with semaphore:
+            try:
+                remote = await yoomoney.get_payment_status(payment_id)
+            except Exception as e:
+                self.metrics["errors"] += 1
+                self._defer(payment_id)
+                logger.warning(f"Reconcile poll failed for {payment_id}: {str(e)}")
+                return False
+        self.metrics["polled"] += 1
+        
+        event = STATUS_EVENTS.get(remote.status)
+        if remote.status == payment.get("status") or event is None:
+            self._defer(payment_id)
+            return False
+        
+        # Тот же путь, что и у webhook: дедупликация, повторы, dead-letter
+        await get_webhook_queue().enqueue({
+            "event": event,
+            "object": {
+                "id": payment_id,
+                "status": remote.status,
+                "amount": remote.amount,
+                "metadata": {"order_id": payment.get("order_id")}
+            },
+            "source": "reconciler"
+        })
+        self._backoff.pop(payment_id, None)
+        self.metrics["transitions"] += 1
+        return True
+    
+    async def tick(self) -> Dict[str, Any]:
+        """Один цикл сверки"""
+        from services import yoomoney_service
+        
+        started = time.perf_counter()
+        due, open_count, stale_count, oldest_age, deferred = await asyncio.to_thread(self._select)
+        self.metrics.update({
+            "open_payments": open_count,
+            "stale_payments": stale_count,
+            "oldest_open_age_seconds": round(oldest_age),
+            "deferred_by_budget": deferred
+        })
+        
+        yoomoney = yoomoney_service.yoomoney_service
+        if due and yoomoney is not None:
+            semaphore = asyncio.Semaphore(self.CONCURRENCY)
+            await asyncio.gather(*(self._poll(yoomoney, p, semaphore) for p in due))
+        
+        self.metrics["ticks"] += 1
+        self.metrics["last_tick_at"] = datetime.now().isoformat()
+        self.metrics["last_tick_duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return self.metrics
+    
+    async def run(self):
+        """Фоновая задача периодической сверки"""
+        while True:
+            await asyncio.sleep(self.INTERVAL)
+            try:
+                await self.tick()
+            except Exception as e:
+                logger.error(f"Payment reconcile error: {str(e)}")
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        return {**self.metrics, "backoff_tracked": len(self._backoff)}
+
+# Глобальный экземпляр сервиса
+payment_reconciler = PaymentReconciler()
+
+def get_payment_reconciler() -> PaymentReconciler:
+    """Получение экземпляра сверки платежей"""
+    return payment_reconciler
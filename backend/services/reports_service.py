@@ -0,0 +1,266 @@
+"""
+Reports Service
+Колоночное хранилище строк заказов на NumPy для отчетов по продажам:
+дозапись при каждом новом заказе и векторизованные группировки по
+дню/неделе/месяцу, бренду, категории и товару
+"""
+
+import logging
+import threading
+from typing import Dict, Any, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EXCLUDED_STATUSES = {"cancelled", "canceled"}
+
+INTERVALS = ("day", "week", "month")
+GROUPS = ("none", "brand", "category", "product")
+
+class _Dictionary:
+    """Словарное кодирование строк (бренды, категории, товары) в int32"""
+    
+    def __init__(self):
+        self.values: List[str] = []
+        self.codes: Dict[str, int] = {}
+    
+    def encode(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+class SalesReportEngine:
+    INITIAL_CAPACITY = 1024
+    
+    def __init__(self):
+        from database import ChangeTracker
+        
+        self._lock = threading.RLock()
+        # Версия orders.json, которой соответствуют строки
+        self.tracker = ChangeTracker()
+        self._reset()
+    
+    def _reset(self):
+        self.size = 0
+        capacity = self.INITIAL_CAPACITY
+        self.timestamp = np.zeros(capacity, dtype="datetime64[s]")
+        self.product = np.zeros(capacity, dtype=np.int32)
+        self.brand = np.zeros(capacity, dtype=np.int32)
+        self.category = np.zeros(capacity, dtype=np.int32)
+        self.quantity = np.zeros(capacity, dtype=np.int32)
+        self.amount = np.zeros(capacity, dtype=np.float64)
+        self.active = np.zeros(capacity, dtype=bool)
+        
+        self.products = _Dictionary()
+        self.brands = _Dictionary()
+        self.categories = _Dictionary()
+        # order_id -> (первая строка, число строк), для отмены заказа
+        self.order_rows: Dict[str, tuple] = {}
+    
+    def _grow(self, required: int):
+        capacity = len(self.timestamp)
+        if required <= capacity:
+            return
+        while capacity < required:
+            capacity *= 2
+        for name in ("timestamp", "product", "brand", "category", "quantity", "amount", "active"):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+    
+    def _append_order(self, order: Dict[str, Any], product_index):
+        items = order.get("items") or []
+        if not items or order.get("id") in self.order_rows:
+            return
+        
+        try:
+            timestamp = np.datetime64((order.get("created_at") or "")[:19], "s")
+        except ValueError:
+            return
+        
+        start = self.size
+        self._grow(start + len(items))
+        active = order.get("status") not in EXCLUDED_STATUSES
+        for offset, item in enumerate(items):
+            product = product_index.by_id.get(item.get("product_id")) or {}
+            quantity = int(item.get("quantity") or 0)
+            price = float(item.get("product_price") or product.get("price") or 0)
+            
+            row = start + offset
+            self.timestamp[row] = timestamp
+            self.product[row] = self.products.encode(item.get("product_id") or "")
+            self.brand[row] = self.brands.encode(product.get("brand") or "Unknown")
+            self.category[row] = self.categories.encode(product.get("category") or "Unknown")
+            self.quantity[row] = quantity
+            self.amount[row] = price * quantity
+            self.active[row] = active
+        
+        self.size = start + len(items)
+        self.order_rows[order["id"]] = (start, len(items))
+    
+    def rebuild(self):
+        """Полная загрузка строк из orders.json"""
+        from database import Database, ORDERS_FILE, collection_snapshot
+        
+        with self._lock:
+            orders, version = collection_snapshot(ORDERS_FILE, Database.get_orders)
+            product_index = Database.get_product_index()
+            self._reset()
+            for order in orders:
+                self._append_order(order, product_index)
+            self.tracker.rebuilt(version)
+        logger.info(f"Sales report engine loaded {self.size} order lines")
+    
+    def handle_change(self, file_path: str, action: str, item: Dict[str, Any], previous: Optional[Dict[str, Any]]):
+        """Подписчик на изменения заказов: дозапись и отметка отмененных"""
+        from database import Database, ORDERS_FILE, collection_version
+        
+        if file_path != ORDERS_FILE:
+            return
+        
+        with self._lock:
+            version = collection_version(ORDERS_FILE)
+            decision = self.tracker.classify(version)
+            if decision == self.tracker.SKIP:
+                # Изменение уже вошло в снимок последней загрузки
+                return
+            if decision == self.tracker.REBUILD:
+                self.rebuild()
+                return
+            
+            if action == "add":
+                self._append_order(item, Database.get_product_index())
+            elif item.get("id") in self.order_rows:
+                start, count = self.order_rows[item["id"]]
+                self.active[start:start + count] = (
+                    action != "delete" and item.get("status") not in EXCLUDED_STATUSES
+                )
+            self.tracker.applied(version)
+    
+    def _ensure_fresh(self):
+        from database import load_json, ORDERS_FILE, collection_version
+        
+        load_json(ORDERS_FILE)
+        if self.tracker.version != collection_version(ORDERS_FILE):
+            self.rebuild()
+    
+    @staticmethod
+    def _buckets(timestamps: np.ndarray, interval: str) -> np.ndarray:
+        days = timestamps.astype("datetime64[D]")
+        if interval == "month":
+            return days.astype("datetime64[M]").astype("datetime64[D]")
+        if interval == "week":
+            # Понедельник недели: 1970-01-01 - четверг
+            day_numbers = days.astype(np.int64)
+            return (day_numbers - (day_numbers + 3) % 7).astype("datetime64[D]")
+        return days
+    
+    def query(
+        self,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+        interval: str = "day",
+        group_by: str = "none"
+    ) -> Dict[str, Any]:
+        """Выручка и количество по периодам с группировкой"""
+        if interval not in INTERVALS:
+            raise ValueError(f"interval must be one of {INTERVALS}")
+        if group_by not in GROUPS:
+            raise ValueError(f"group_by must be one of {GROUPS}")
+        
+        self._ensure_fresh()
+        with self._lock:
+            size = self.size
+            timestamps = self.timestamp[:size]
+            mask = self.active[:size].copy()
+            if start:
+                mask &= timestamps >= np.datetime64(start, "s")
+            if end:
+                # Конец периода включительно: дата без времени означает весь день
+                if "T" in end:
+                    mask &= timestamps <= np.datetime64(end, "s")
+                else:
+                    mask &= timestamps < (np.datetime64(end, "D") + 1).astype("datetime64[s]")
+            
+            timestamps = timestamps[mask]
+            quantity = self.quantity[:size][mask]
+            amount = self.amount[:size][mask]
+            labels = {
+                "brand": (self.brand, self.brands),
+                "category": (self.category, self.categories),
+                "product": (self.product, self.products),
+            }
+            if group_by != "none":
+                column, dictionary = labels[group_by]
+                groups = column[:size][mask].astype(np.int64)
+                group_values = list(dictionary.values)
+            else:
+                groups = np.zeros(len(timestamps), dtype=np.int64)
+                group_values = [None]
+        
+        buckets = self._buckets(timestamps, interval).astype(np.int64)
+        rows = []
+        if len(buckets):
+            # Составной ключ (период, группа) в одном int64
+            group_count = max(len(group_values), 1)
+            first_bucket = int(buckets.min())
+            keys = (buckets - first_bucket) * group_count + groups
+            
+            dense_size = int(keys.max()) + 1
+            if dense_size <= 4 * len(keys):
+                # Плотный диапазон ключей: линейный bincount без сортировки
+                revenue = np.bincount(keys, weights=amount, minlength=dense_size)
+                units = np.bincount(keys, weights=quantity, minlength=dense_size)
+                lines = np.bincount(keys, minlength=dense_size)
+                unique_keys = np.flatnonzero(lines)
+                revenue, units, lines = revenue[unique_keys], units[unique_keys], lines[unique_keys]
+            else:
+                unique_keys, inverse = np.unique(keys, return_inverse=True)
+                revenue = np.bincount(inverse, weights=amount)
+                units = np.bincount(inverse, weights=quantity)
+                lines = np.bincount(inverse)
+            
+            periods = (unique_keys // group_count + first_bucket).astype("datetime64[D]").astype(str)
+            for i, (period, group) in enumerate(zip(periods.tolist(), (unique_keys % group_count).tolist())):
+                row = {
+                    "period": period,
+                    "revenue": round(float(revenue[i]), 2),
+                    "quantity": int(units[i]),
+                    "lines": int(lines[i])
+                }
+                if group_by != "none":
+                    row[group_by] = group_values[group]
+                rows.append(row)
+        
+        return {
+            "interval": interval,
+            "group_by": group_by,
+            "start": start,
+            "end": end,
+            "rows": rows,
+            "totals": {
+                "revenue": round(float(amount.sum()), 2),
+                "quantity": int(quantity.sum()),
+                "lines": int(len(amount))
+            }
+        }
+
+# Глобальный экземпляр сервиса
+sales_report_engine = SalesReportEngine()
+
+def get_sales_report_engine() -> SalesReportEngine:
+    """Получение экземпляра движка отчетов"""
+    return sales_report_engine
+
+def init_reports():
+    """Подписка на изменения заказов и первичная загрузка"""
+    from database import on_change
+    
+    on_change(sales_report_engine.handle_change)
+    sales_report_engine.rebuild()
+    return sales_report_engine
@@ -0,0 +1,208 @@
+"""
+Response Cache
+Кэш готовых (уже закодированных) ответов горячих read-only маршрутов.
+Ключ - путь и нормализованная строка запроса. Каждая запись помечена
+тегами коллекций, из которых она собрана: запись товара/страницы/настроек
+сбрасывает записи с соответствующим тегом. Дополнительно при чтении
+сверяется состояние файлов коллекций, что ловит записи других воркеров.
+Объем ограничен в байтах, вытесняются давно не использованные записи.
+Сжатые варианты (gzip/br) хранятся рядом с телом и создаются один раз
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Iterable, Optional, Set, Tuple
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+from services import compression
+from services.serialization import dumps
+
+def _tag_files() -> Dict[str, str]:
+    from database import PRODUCTS_FILE, PAGES_FILE, SETTINGS_FILE, SITE_SETTINGS_FILE, SEO_SETTINGS_FILE
+    return {
+        "products": PRODUCTS_FILE,
+        "pages": PAGES_FILE,
+        "settings": SETTINGS_FILE,
+        "site_settings": SITE_SETTINGS_FILE,
+        "seo_settings": SEO_SETTINGS_FILE
+    }
+
+class CachedResponse:
+    __slots__ = ("body", "media_type", "tags", "state", "size", "variants")
+
+    def __init__(self, body: bytes, media_type: str, tags: Tuple[str, ...], state: Tuple[str, ...]):
+        self.body = body
+        self.media_type = media_type
+        self.tags = tags
+        self.state = state
+        # Тело плюс примерные накладные расходы на ключ и запись
+        self.size = len(body) + 256
+        # Кодировка -> сжатое тело
+        self.variants: Dict[str, bytes] = {}
+
+class ResponseCache:
+    MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+    def __init__(self, max_bytes: int = MAX_BYTES):
+        self.max_bytes = max_bytes
+        # Крупные ответы не должны вытеснять весь кэш разом
+        self.max_entry_bytes = max_bytes // 8
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[tuple, CachedResponse]" = OrderedDict()
+        self._by_tag: Dict[str, Set[tuple]] = {}
+        self._bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0, "stale": 0}
+
+    @staticmethod
+    def make_key(request: Request) -> tuple:
+        """Путь + параметры запроса без пустых значений в порядке сортировки"""
+        query = tuple(sorted((k, v) for k, v in request.query_params.multi_items() if v != ""))
+        return request.url.path, query
+
+    @staticmethod
+    def _state(tags: Iterable[str]) -> Tuple[str, ...]:
+        from database import collection_etag
+
+        files = _tag_files()
+        return tuple(collection_etag(files[tag]) for tag in tags)
+
+    def _drop(self, key: tuple):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry.size
+        for tag in entry.tags:
+            keys = self._by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+
+    def get(self, key: tuple) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        if entry.state != self._state(entry.tags):
+            # Коллекцию изменил другой воркер или правка файла
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    self._drop(key)
+            self.stats["stale"] += 1
+            self.stats["misses"] += 1
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry
+
+    def put(self, key: tuple, body: bytes, tags: Tuple[str, ...], state: Tuple[str, ...], media_type: str = "application/json") -> Optional[CachedResponse]:
+        entry = CachedResponse(body, media_type, tags, state)
+        if entry.size > self.max_entry_bytes:
+            return None
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            for tag in tags:
+                self._by_tag.setdefault(tag, set()).add(key)
+            while self._bytes > self.max_bytes and self._entries:
+                self._drop(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+        return entry
+
+    def variant(self, key: tuple, entry: CachedResponse, encoding: str) -> bytes:
+        """Сжатое тело записи; сжимается при первом запросе кодировки"""
+        compressed = entry.variants.get(encoding)
+        if compressed is not None:
+            return compressed
+
+        compressed = compression.compress(entry.body, encoding)
+        compression.count(entry.body, compressed, "cached_variants")
+        with self._lock:
+            # Запись могли вытеснить или заменить во время сжатия
+            if self._entries.get(key) is entry and encoding not in entry.variants:
+                entry.variants[encoding] = compressed
+                entry.size += len(compressed)
+                self._bytes += len(compressed)
+                while self._bytes > self.max_bytes and len(self._entries) > 1:
+                    self._drop(next(iter(self._entries)))
+                    self.stats["evictions"] += 1
+        return compressed
+
+    def invalidate(self, *tags: str):
+        """Сброс всех записей с указанными тегами"""
+        with self._lock:
+            for tag in tags:
+                for key in list(self._by_tag.pop(tag, ())):
+                    self._drop(key)
+                    self.stats["invalidations"] += 1
+
+    def handle_change(self, file_path: str, action: str, item: Dict[str, Any], previous: Optional[Dict[str, Any]]):
+        for tag, tag_file in _tag_files().items():
+            if tag_file == file_path:
+                self.invalidate(tag)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self.stats,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes
+            }
+
+    def respond(
+        self,
+        request: Request,
+        response: Optional[Response],
+        tags: Tuple[str, ...],
+        build: Callable[[], Any]
+    ) -> Response:
+        """Ответ из кэша или построение, кодирование и сохранение нового
+        (build может вернуть уже закодированные bytes). Заголовки, выставленные маршрутом (ETag, Cache-Control), переносятся.
+        Если клиент принимает сжатие, отдается сохраненный сжатый вариант.
+        Исключения build (например, 404) не кэшируются"""
+        headers = None
+        if response is not None:
+            headers = {k: v for k, v in response.headers.items() if k != "content-length"}
+        key = self.make_key(request)
+        entry = self.get(key)
+        if entry is None:
+            # Состояние снимается до чтения данных: запись, пришедшая во
+            # время построения, сделает кэш устаревшим, а не наоборот
+            state = self._state(tags)
+            content = build()
+            body = content if isinstance(content, bytes) else dumps(content)
+            entry = self.put(key, body, tags, state)
+            if entry is None:
+                # Слишком крупный для кэша ответ сожмет middleware
+                return Response(body, media_type="application/json", headers=headers)
+
+        encoding = None
+        if len(entry.body) >= compression.MIN_SIZE:
+            encoding = compression.negotiate(request.headers.get("accept-encoding"))
+        if encoding is None:
+            return Response(entry.body, media_type=entry.media_type, headers=headers)
+
+        headers = headers or {}
+        headers["Content-Encoding"] = encoding
+        headers["Vary"] = compression.add_vary(headers.pop("vary", None))
+        return Response(self.variant(key, entry, encoding), media_type=entry.media_type, headers=headers)
+
+# Глобальный экземпляр сервиса
+response_cache = ResponseCache()
+
+def get_response_cache() -> ResponseCache:
+    """Получение кэша ответов"""
+    return response_cache
+
+def init_response_cache():
+    """Подписка на изменения коллекций для сброса кэша по тегам"""
+    from database import on_change
+
+    on_change(response_cache.handle_change)
+    return response_cache
@@ -0,0 +1,127 @@
+"""
+Serialization
+Быстрое кодирование JSON: orjson, если установлен (иначе стандартный json
+с тем же результатом), и кэш уже закодированных товаров. Списки товаров
+собираются склейкой готовых фрагментов - неизмененные товары повторно не
+кодируются. Фрагмент сбрасывается по событию изменения товара, при
+изменении каталога извне кэш очищается целиком. Фрагменты хранятся для
+MAX_FIELD_SETS последних наборов полей проекции
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+    from fastapi.responses import ORJSONResponse as DefaultResponse
+except ImportError:  # orjson не установлен: стандартный json
+    orjson = None
+    DefaultResponse = JSONResponse
+
+def dumps(content: Any) -> bytes:
+    """JSON в UTF-8 без пробелов, как JSONResponse"""
+    if orjson is not None:
+        return orjson.dumps(
+            content,
+            default=jsonable_encoder,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        )
+    return json.dumps(
+        jsonable_encoder(content),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":")
+    ).encode("utf-8")
+
+class ProductFragmentCache:
+    MAX_FIELD_SETS = 32
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # набор полей проекции (None - все) -> id товара -> JSON; LRU по наборам
+        self._fragments: "OrderedDict[Optional[tuple], Dict[str, bytes]]" = OrderedDict()
+        self.version = None
+        self.stats = {"hits": 0, "encoded": 0}
+
+    def handle_change(self, file_path: str, action: str, item: Dict[str, Any], previous: Optional[Dict[str, Any]]):
+        """Подписчик на изменения товаров"""
+        from database import PRODUCTS_FILE, collection_version
+
+        if file_path != PRODUCTS_FILE:
+            return
+
+        with self._lock:
+            version = collection_version(PRODUCTS_FILE)
+            if self.version not in (version - 1, version):
+                self._fragments.clear()
+            else:
+                for record in (item, previous):
+                    if record:
+                        for fragments in self._fragments.values():
+                            fragments.pop(record.get("id"), None)
+            self.version = version
+
+    def _ensure_fresh(self, fields: Optional[tuple]):
+        """Сброс кэша после изменения каталога извне и отметка набора полей
+        как недавно использованного"""
+        from database import PRODUCTS_FILE, collection_version
+
+        version = collection_version(PRODUCTS_FILE)
+        with self._lock:
+            if self.version != version:
+                self._fragments.clear()
+                self.version = version
+            if fields in self._fragments:
+                self._fragments.move_to_end(fields)
+        return version
+
+    def encode(self, product: Dict[str, Any], version=None, fields: Optional[tuple] = None) -> bytes:
+        """JSON товара (уже спроецированного на fields)"""
+        product_id = product.get("id")
+        fragment = self._fragments.get(fields, {}).get(product_id)
+        if fragment is not None:
+            self.stats["hits"] += 1
+            return fragment
+
+        fragment = dumps(product)
+        self.stats["encoded"] += 1
+        if product_id is not None:
+            with self._lock:
+                # Товар могли изменить во время кодирования - такой
+                # фрагмент в кэш не кладем
+                if self.version == version:
+                    fragments = self._fragments.get(fields)
+                    if fragments is None:
+                        fragments = self._fragments[fields] = {}
+                        while len(self._fragments) > self.MAX_FIELD_SETS:
+                            self._fragments.popitem(last=False)
+                    fragments[product_id] = fragment
+        return fragment
+
+    def encode_one(self, product: Dict[str, Any], fields: Optional[tuple] = None) -> bytes:
+        return self.encode(product, self._ensure_fresh(fields), fields)
+
+    def encode_list(self, products: Iterable[Dict[str, Any]], fields: Optional[tuple] = None) -> bytes:
+        """JSON-массив товаров из готовых фрагментов"""
+        version = self._ensure_fresh(fields)
+        return b"[" + b",".join(self.encode(product, version, fields) for product in products) + b"]"
+
+# Глобальный экземпляр сервиса
+product_fragments = ProductFragmentCache()
+
+def get_product_fragments() -> ProductFragmentCache:
+    """Получение кэша закодированных товаров"""
+    return product_fragments
+
+def init_serialization():
+    """Подписка на изменения товаров"""
+    from database import on_change
+
+    on_change(product_fragments.handle_change)
+    return product_fragments
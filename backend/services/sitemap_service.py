@@ -0,0 +1,173 @@
+"""
+Sitemap Service
+Генерация sitemap: индекс и файлы до 50 000 URL. XML формируется потоком
+и сразу сжимается gzip, в памяти хранятся только готовые сжатые файлы.
+Пересборка происходит только после изменения товаров, страниц или SEO
+настроек; ответы поддерживают ETag/Last-Modified и 304
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+import threading
+import zlib
+from datetime import datetime
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+logger = logging.getLogger(__name__)
+
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+SITEMAP_NS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+
+def _modified(record: Dict[str, Any]) -> Optional[datetime]:
+    """Время изменения записи. В XML попадает только дата, а Last-Modified
+    нужна полная точность: правки в течение дня иначе дают ложный 304"""
+    value = record.get("updated_at") or record.get("created_at")
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value)).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+class SitemapFile:
+    """Готовый сжатый файл sitemap"""
+
+    def __init__(self, name: str, body: bytes, modified: Optional[datetime]):
+        self.name = name
+        self.body = body
+        self.modified = modified
+        # Дата для <lastmod> (W3C, YYYY-MM-DD)
+        self.lastmod = modified.date().isoformat() if modified else None
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        # Last-Modified передается с точностью до секунды
+        self.last_modified = modified.replace(microsecond=0) if modified else None
+
+class SitemapService:
+    SHARD_SIZE = 50000
+    BASE_URL = os.environ.get("SITE_URL", "https://nexx.ru").rstrip("/")
+    # Пересжатие после накопления фрагментов, чтобы не держать XML целиком
+    FLUSH_BYTES = 64 * 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._files: Dict[str, SitemapFile] = {}
+        self.stats = {"builds": 0, "last_build_ms": 0, "urls": 0}
+
+    @staticmethod
+    def _current_version() -> tuple:
+        from database import collection_version, PRODUCTS_FILE, PAGES_FILE, SEO_SETTINGS_FILE
+        return (
+            collection_version(PRODUCTS_FILE),
+            collection_version(PAGES_FILE),
+            collection_version(SEO_SETTINGS_FILE)
+        )
+
+    def _iter_urls(self) -> Iterator[Tuple[str, Optional[datetime]]]:
+        from database import Database
+
+        yield f"{self.BASE_URL}/", None
+        yield f"{self.BASE_URL}/catalog", None
+
+        for page in Database.get_pages():
+            if page.get("active", True) and page.get("slug"):
+                yield f"{self.BASE_URL}/{page['slug']}", _modified(page)
+
+        for product in Database.get_products():
+            yield f"{self.BASE_URL}/product/{product['id']}", _modified(product)
+
+    def _compress(self, fragments: Iterator[str]) -> bytes:
+        """Потоковое gzip-сжатие фрагментов XML"""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        chunks: List[bytes] = []
+        pending: List[str] = []
+        pending_size = 0
+        for fragment in fragments:
+            pending.append(fragment)
+            pending_size += len(fragment)
+            if pending_size >= self.FLUSH_BYTES:
+                chunks.append(compressor.compress("".join(pending).encode("utf-8")))
+                pending, pending_size = [], 0
+        chunks.append(compressor.compress("".join(pending).encode("utf-8")))
+        chunks.append(compressor.flush())
+        return b"".join(chunks)
+
+    @staticmethod
+    def _urlset(urls: List[Tuple[str, Optional[datetime]]]) -> Iterator[str]:
+        yield XML_HEADER
+        yield f'<urlset xmlns="{SITEMAP_NS}">\n'
+        for loc, modified in urls:
+            if modified:
+                yield f"  <url><loc>{escape(loc)}</loc><lastmod>{modified.date().isoformat()}</lastmod></url>\n"
+            else:
+                yield f"  <url><loc>{escape(loc)}</loc></url>\n"
+        yield "</urlset>\n"
+
+    def _index(self, shards: List[SitemapFile]) -> Iterator[str]:
+        yield XML_HEADER
+        yield f'<sitemapindex xmlns="{SITEMAP_NS}">\n'
+        for shard in shards:
+            loc = escape(f"{self.BASE_URL}/api/{shard.name}")
+            if shard.lastmod:
+                yield f"  <sitemap><loc>{loc}</loc><lastmod>{shard.lastmod}</lastmod></sitemap>\n"
+            else:
+                yield f"  <sitemap><loc>{loc}</loc></sitemap>\n"
+        yield "</sitemapindex>\n"
+
+    def _build(self) -> Dict[str, SitemapFile]:
+        started = datetime.now()
+        files: Dict[str, SitemapFile] = {}
+        shards: List[SitemapFile] = []
+        total = 0
+
+        def flush(batch):
+            modified = max((m for _, m in batch if m), default=None)
+            shard = SitemapFile(f"sitemap-{len(shards) + 1}.xml", self._compress(self._urlset(batch)), modified)
+            shards.append(shard)
+            files[shard.name] = shard
+
+        batch: List[Tuple[str, Optional[datetime]]] = []
+        for url in self._iter_urls():
+            batch.append(url)
+            total += 1
+            if len(batch) >= self.SHARD_SIZE:
+                flush(batch)
+                batch = []
+        if batch or not shards:
+            flush(batch)
+
+        modified = max((s.modified for s in shards if s.modified), default=None)
+        files["sitemap.xml"] = SitemapFile("sitemap.xml", self._compress(self._index(shards)), modified)
+
+        self.stats.update({
+            "builds": self.stats["builds"] + 1,
+            "last_build_ms": round((datetime.now() - started).total_seconds() * 1000, 1),
+            "urls": total,
+            "shards": len(shards)
+        })
+        return files
+
+    def get_file(self, name: str) -> Optional[SitemapFile]:
+        """Сжатый файл sitemap; пересобирается, если данные изменились"""
+        version = self._current_version()
+        if self._version != version:
+            with self._lock:
+                if self._version != version:
+                    self._files = self._build()
+                    self._version = version
+        return self._files.get(name)
+
+    @staticmethod
+    def decompress(sitemap_file: SitemapFile) -> bytes:
+        """Несжатое содержимое для клиентов без поддержки gzip"""
+        return gzip.decompress(sitemap_file.body)
+
+# Глобальный экземпляр сервиса
+sitemap_service = SitemapService()
+
+def get_sitemap_service() -> SitemapService:
+    """Получение сервиса sitemap"""
+    return sitemap_service
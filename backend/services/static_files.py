@@ -0,0 +1,179 @@
+"""
+Static Files
+Отдача файлов с диска: сильные ETag, условные запросы (If-None-Match,
+If-Modified-Since, If-Range), HTTP Range и zero-copy отправка, если ASGI
+сервер поддерживает расширения pathsend/zerocopy
+"""
+
+import os
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+from mimetypes import guess_type
+from pathlib import Path
+from typing import Optional, Tuple, Mapping
+
+import anyio
+from starlette.responses import Response
+from starlette.types import Scope, Receive, Send
+
+from services.media_service import is_content_addressed
+
+CHUNK_SIZE = 256 * 1024
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+DEFAULT_CACHE_CONTROL = "public, max-age=86400"
+
+def make_etag(path: Path, stat_result: os.stat_result) -> str:
+    """Сильный ETag: хеш содержимого для адресуемых по содержимому файлов,
+    иначе mtime (нс) + размер"""
+    if is_content_addressed(path.name):
+        return f'"{path.name[:64]}"'
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Разбор заголовка Range для одного диапазона.
+    Возвращает (start, end) включительно; None - заголовок игнорируется;
+    ValueError - диапазон невыполним (416)"""
+    if not header.startswith("bytes=") or "," in header:
+        return None
+    
+    start_text, separator, end_text = header[len("bytes="):].strip().partition("-")
+    if not separator:
+        return None
+    
+    if start_text == "":
+        # Суффиксный диапазон: последние N байт
+        if not end_text.isdigit():
+            return None
+        length = int(end_text)
+        if length == 0 or size == 0:
+            raise ValueError("Unsatisfiable range")
+        return max(0, size - length), size - 1
+    
+    if not start_text.isdigit() or (end_text and not end_text.isdigit()):
+        return None
+    start = int(start_text)
+    end = int(end_text) if end_text else size - 1
+    if end_text and end < start:
+        return None
+    if start >= size:
+        raise ValueError("Unsatisfiable range")
+    return start, min(end, size - 1)
+
+class RangeFileResponse(Response):
+    """Ответ-файл с поддержкой условных запросов и Range"""
+    
+    def __init__(
+        self,
+        path: Path,
+        request_headers: Mapping[str, str],
+        media_type: Optional[str] = None,
+        cache_control: Optional[str] = None,
+        headers: Optional[Mapping[str, str]] = None,
+    ) -> None:
+        self.path = Path(path)
+        self.request_headers = request_headers
+        self.media_type = media_type or guess_type(self.path.name)[0] or "application/octet-stream"
+        self.cache_control = cache_control
+        self.background = None
+        self.status_code = 200
+        self.init_headers(headers)
+        self.range: Optional[Tuple[int, int]] = None
+    
+    def _not_modified(self, etag: str, stat_result: os.stat_result) -> bool:
+        if_none_match = self.request_headers.get("if-none-match")
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return "*" in tags or etag in tags
+        
+        if_modified_since = self.request_headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(stat_result.st_mtime) <= since
+        return False
+    
+    def _prepare(self, stat_result: os.stat_result):
+        size = stat_result.st_size
+        etag = make_etag(self.path, stat_result)
+        
+        self.headers["etag"] = etag
+        self.headers["last-modified"] = formatdate(stat_result.st_mtime, usegmt=True)
+        self.headers["accept-ranges"] = "bytes"
+        self.headers["cache-control"] = self.cache_control or (
+            IMMUTABLE_CACHE_CONTROL if is_content_addressed(self.path.name) else DEFAULT_CACHE_CONTROL
+        )
+        
+        if self._not_modified(etag, stat_result):
+            self.status_code = 304
+            return
+        
+        range_header = self.request_headers.get("range")
+        if_range = self.request_headers.get("if-range")
+        if range_header and (if_range is None or if_range == etag):
+            try:
+                self.range = parse_range(range_header, size)
+            except ValueError:
+                self.status_code = 416
+                self.headers["content-range"] = f"bytes */{size}"
+                self.headers["content-length"] = "0"
+                return
+        
+        self.headers["content-type"] = self.media_type
+        if self.range is not None:
+            start, end = self.range
+            self.status_code = 206
+            self.headers["content-range"] = f"bytes {start}-{end}/{size}"
+            self.headers["content-length"] = str(end - start + 1)
+        else:
+            self.headers["content-length"] = str(size)
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+        except FileNotFoundError:
+            stat_result = None
+        if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
+            await Response(status_code=404)(scope, receive, send)
+            return
+        
+        self._prepare(stat_result)
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        
+        if scope["method"].upper() == "HEAD" or self.status_code in (304, 416):
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        
+        start, end = self.range or (0, stat_result.st_size - 1)
+        count = end - start + 1
+        extensions = scope.get("extensions") or {}
+        
+        if "http.response.pathsend" in extensions and self.range is None:
+            # Сервер сам отправит файл (sendfile), Python не читает содержимое
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+            return
+        
+        if "http.response.zerocopy" in extensions:
+            with open(self.path, "rb") as file:
+                await send({
+                    "type": "http.response.zerocopy",
+                    "file": file.fileno(),
+                    "offset": start,
+                    "count": count,
+                    "more_body": False,
+                })
+            return
+        
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            await file.seek(start)
+            remaining = count
+            while remaining > 0:
+                chunk = await file.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
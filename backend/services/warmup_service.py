@@ -0,0 +1,188 @@
+"""
+Warm-up Service
+Прогрев воркера перед приемом трафика: загрузка коллекций, построение
+индексов, открытие соединений с внешними API и предзагрузка предложений
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from typing import Dict, Any, Optional
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+class WarmupService:
+    # Сколько самых популярных товаров прогревать в кэше предложений ABCP
+    PREFETCH_TOP_N = int(os.environ.get("WARMUP_PREFETCH_TOP_N", "20"))
+    # Ограничение на время прогрева внешних API (секунды)
+    EXTERNAL_TIMEOUT = float(os.environ.get("WARMUP_EXTERNAL_TIMEOUT", "15"))
+    # Пауза перед повтором неудачного прогрева (удваивается до MAX)
+    RETRY_DELAY = float(os.environ.get("WARMUP_RETRY_DELAY", "5"))
+    RETRY_DELAY_MAX = float(os.environ.get("WARMUP_RETRY_DELAY_MAX", "60"))
+    
+    def __init__(self):
+        self.ready = False
+        self.started_at: Optional[str] = None
+        self.finished_at: Optional[str] = None
+        self.stages: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+        self.attempts = 0
+        self._task: Optional[asyncio.Task] = None
+    
+    def _stage(self, name: str, started: float, result: Any = None):
+        self.stages[name] = {
+            "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+            "result": result
+        }
+    
+    def _load_collections(self) -> Dict[str, Any]:
+        from database import Database
+        return Database.warm_up()
+    
+    def _build_aggregates(self):
+        from services.analytics_service import init_analytics
+        from services.reports_service import init_reports
+        from services.inventory_service import init_inventory
+        from services.feed_service import init_feeds
+        from services.response_cache import init_response_cache
+        from services.serialization import init_serialization
+        init_analytics()
+        init_reports()
+        init_inventory()
+        init_feeds()
+        init_response_cache()
+        init_serialization()
+    
+    def _top_products(self, limit: int):
+        """Самые заказываемые товары; при пустой истории - первые в каталоге"""
+        from database import Database
+        
+        counter = Counter()
+        for order in Database.get_orders():
+            for item in order.get("items", []):
+                counter[item.get("product_id")] += item.get("quantity", 1)
+        
+        index = Database.get_product_index()
+        products = [index.by_id[pid] for pid, _ in counter.most_common() if pid in index.by_id]
+        if len(products) < limit:
+            seen = {p["id"] for p in products}
+            products.extend(p for p in index.products if p.get("id") not in seen)
+        return products[:limit]
+    
+    def _init_outbound_services(self):
+        """Восстановление клиентов внешних API из сохраненных настроек"""
+        from database import Database
+        from services import abcp_service, yoomoney_service
+        
+        abcp = abcp_service.get_abcp_service()
+        settings = Database.get_abcp_settings()
+        if abcp is None and settings.get("active", True) and settings.get("username"):
+            abcp = abcp_service.init_abcp_service(
+                settings["username"], settings["password"], settings.get("host", "api.abcp.ru")
+            )
+        
+        yoomoney = yoomoney_service.yoomoney_service
+        if yoomoney is None:
+            for payment_settings in Database.get_payment_settings():
+                if payment_settings.get("provider") == "yoomoney" and payment_settings.get("active", True):
+                    yoomoney = yoomoney_service.init_yoomoney_service(
+                        payment_settings["merchant_id"], payment_settings["secret_key"]
+                    )
+                    break
+        
+        return abcp, yoomoney
+    
+    async def _prepare(self):
+        """Обязательные этапы: без коллекций и подписчиков изменений
+        воркер не готов"""
+        started = time.perf_counter()
+        counts = await asyncio.to_thread(self._load_collections)
+        self._stage("collections", started, counts)
+        
+        started = time.perf_counter()
+        await asyncio.to_thread(self._build_aggregates)
+        self._stage("aggregates", started)
+    
+    async def _warm_external(self):
+        """Необязательный этап: внешние API не должны держать воркер вне
+        балансировки, их ошибки только логируются"""
+        started = time.perf_counter()
+        abcp, yoomoney = self._init_outbound_services()
+        self._stage("services", started, {
+            "abcp": abcp is not None,
+            "yoomoney": yoomoney is not None
+        })
+        
+        started = time.perf_counter()
+        external = []
+        if yoomoney is not None:
+            external.append(yoomoney.warm_up())
+        if abcp is not None and self.PREFETCH_TOP_N > 0:
+            products = await asyncio.to_thread(self._top_products, self.PREFETCH_TOP_N)
+            external.append(abcp.prefetch_offers(products))
+        
+        if external:
+            try:
+                results = await asyncio.wait_for(
+                    asyncio.gather(*external, return_exceptions=True),
+                    timeout=self.EXTERNAL_TIMEOUT
+                )
+                self._stage("external", started, [
+                    r if not isinstance(r, Exception) else str(r) for r in results
+                ])
+            except asyncio.TimeoutError:
+                logger.warning("Warm-up of external services timed out")
+                self._stage("external", started, "timeout")
+    
+    async def run(self):
+        """Полный цикл прогрева. Пока обязательные этапы не прошли, readiness
+        отвечает 503, а прогрев повторяется с нарастающей паузой"""
+        self.started_at = datetime.now().isoformat()
+        delay = self.RETRY_DELAY
+        while True:
+            self.attempts += 1
+            try:
+                await self._prepare()
+                break
+            except Exception as e:
+                self.error = str(e)
+                logger.error(f"Warm-up error (attempt {self.attempts}), retrying in {delay:.0f}s: {str(e)}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.RETRY_DELAY_MAX)
+        
+        self.error = None
+        try:
+            await self._warm_external()
+        except Exception as e:
+            logger.error(f"Warm-up of external services failed: {str(e)}")
+            self.stages["external"] = {"error": str(e)}
+        
+        self.finished_at = datetime.now().isoformat()
+        self.ready = True
+        logger.info(f"Warm-up finished: {self.stages}")
+    
+    def start(self) -> asyncio.Task:
+        """Запуск прогрева в фоне, чтобы liveness отвечал сразу"""
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+        return self._task
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "stages": self.stages,
+            "attempts": self.attempts,
+            "error": self.error
+        }
+
+# Глобальный экземпляр сервиса
+warmup_service = WarmupService()
+
+def get_warmup_service() -> WarmupService:
+    """Получение экземпляра сервиса прогрева"""
+    return warmup_service
@@ -0,0 +1,313 @@
+"""
+Webhook Queue
+Прием уведомлений YooMoney: быстрое подтверждение, постановка в
+персистентную локальную очередь (файл на событие), обработка фоновыми
+воркерами с дедупликацией по событию и id платежа, повторами с
+экспоненциальной задержкой и dead-letter хранилищем.
+Состояние дедупликации общее для воркеров: ключ события занимается в
+webhook_processed.json под файловой блокировкой еще при постановке в
+очередь, файл события во время обработки заблокирован. Неподтвержденные
+уведомления (без подписи) проверяются запросом статуса платежа в API
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # не POSIX: блокировка файлов событий недоступна
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Событие уведомления, соответствующее итоговому статусу платежа
+STATUS_EVENTS = {
+    "succeeded": "payment.succeeded",
+    "canceled": "payment.canceled",
+    "waiting_for_capture": "payment.waiting_for_capture",
+}
+
+class WebhookQueue:
+    MAX_ATTEMPTS = int(os.environ.get("WEBHOOK_MAX_ATTEMPTS", "8"))
+    BASE_RETRY_DELAY = 2.0
+    MAX_RETRY_DELAY = 600.0
+    WORKERS = 2
+    # Сколько хранить ключи обработанных событий для дедупликации
+    PROCESSED_TTL = 7 * 24 * 3600
+    
+    def __init__(self):
+        from database import WEBHOOKS_DIR
+        
+        self.pending_dir = Path(WEBHOOKS_DIR) / "pending"
+        self.dead_dir = Path(WEBHOOKS_DIR) / "dead"
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self.stats = {"received": 0, "duplicates": 0, "processed": 0, "retries": 0, "dead": 0}
+    
+    @staticmethod
+    def dedupe_key(webhook_data: Dict[str, Any]) -> str:
+        payment_object = webhook_data.get("object") or {}
+        return f"{webhook_data.get('event')}:{payment_object.get('id')}"
+    
+    @staticmethod
+    def _claimed_at(value) -> float:
+        # Старый формат файла: ключ -> время обработки
+        return value if isinstance(value, (int, float)) else (value or {}).get("at", 0)
+    
+    def _update_keys(self, update) -> Any:
+        """Изменение ключей событий: файл перечитывается и сохраняется под
+        блокировкой, общей для воркеров, чужие ключи не теряются"""
+        from database import load_json, save_json, collection_lock, WEBHOOK_PROCESSED_FILE
+        
+        with collection_lock(WEBHOOK_PROCESSED_FILE):
+            keys = load_json(WEBHOOK_PROCESSED_FILE, {})
+            now = time.time()
+            for stale in [k for k, v in keys.items() if now - self._claimed_at(v) > self.PROCESSED_TTL]:
+                del keys[stale]
+            result = update(keys, now)
+            save_json(WEBHOOK_PROCESSED_FILE, keys)
+        return result
+    
+    def _key_state(self, key: str) -> Optional[str]:
+        from database import load_json, WEBHOOK_PROCESSED_FILE
+        
+        value = load_json(WEBHOOK_PROCESSED_FILE, {}).get(key)
+        if value is None:
+            return None
+        return "processed" if isinstance(value, (int, float)) else value.get("state")
+    
+    def _mark_processed(self, key: str, claimed_key: Optional[str] = None):
+        def update(keys, now):
+            if claimed_key and claimed_key != key:
+                keys.pop(claimed_key, None)
+            keys[key] = {"state": "processed", "at": now}
+        self._update_keys(update)
+    
+    def _release_claim(self, key: str):
+        """Снять занятый ключ, не отмечая событие обработанным"""
+        def update(keys, now):
+            value = keys.get(key)
+            if isinstance(value, dict) and value.get("state") == "queued":
+                del keys[key]
+        self._update_keys(update)
+    
+    def _write_entry(self, path: Path, entry: Dict[str, Any]):
+        temp_path = path.with_suffix(".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    
+    def _persist(self, webhook_data: Dict[str, Any]) -> Optional[Path]:
+        """Запись события в очередь; None - дубликат (ключ уже занят
+        этим или другим воркером)"""
+        key = self.dedupe_key(webhook_data)
+        
+        def claim(keys, now):
+            if key in keys:
+                return None
+            self.pending_dir.mkdir(parents=True, exist_ok=True)
+            path = self.pending_dir / f"{time.time_ns()}-{uuid.uuid4().hex[:8]}.json"
+            # Сначала файл события, потом ключ: сбой между ними даст повторную
+            # обработку (она безопасна), но не потерю события
+            self._write_entry(path, {"key": key, "data": webhook_data, "attempts": 0, "errors": []})
+            keys[key] = {"state": "queued", "at": now}
+            return path
+        
+        return self._update_keys(claim)
+    
+    async def enqueue(self, webhook_data: Dict[str, Any]) -> bool:
+        """Постановка уведомления в очередь; False - дубликат"""
+        self.stats["received"] += 1
+        path = await asyncio.to_thread(self._persist, webhook_data)
+        if path is None:
+            self.stats["duplicates"] += 1
+            return False
+        if self._queue is not None:
+            self._queue.put_nowait(path)
+        return True
+    
+    @contextmanager
+    def _entry_lock(self, path: Path):
+        """Неблокирующий захват файла события; False - его обрабатывает
+        другой воркер (например, оба подняли очередь после перезапуска)"""
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            yield False
+            return
+        try:
+            if fcntl:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    yield False
+                    return
+            yield True
+        finally:
+            os.close(fd)
+    
+    async def _verified(self, webhook_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Уведомление без подписи: статус платежа берется из API, содержимое
+        уведомления не используется. None - платеж еще не в итоговом статусе"""
+        from services import yoomoney_service
+        
+        yoomoney = yoomoney_service.yoomoney_service
+        if yoomoney is None:
+            raise RuntimeError("YooMoney service is not configured")
+        
+        remote = await yoomoney.get_payment_status(webhook_data["object"]["id"])
+        event = STATUS_EVENTS.get(remote.status)
+        if event is None:
+            return None
+        return {
+            "event": event,
+            "object": {"id": remote.id, "status": remote.status, "amount": remote.amount},
+            "source": "api"
+        }
+    
+    def _fail(self, path: Path, entry: Dict[str, Any], error: Exception) -> Optional[float]:
+        """Неудачная попытка: повтор с задержкой или dead-letter"""
+        key = entry["key"]
+        entry["attempts"] += 1
+        entry["errors"] = (entry.get("errors") or [])[-4:] + [str(error)]
+        logger.warning(f"Webhook {key} failed (attempt {entry['attempts']}): {str(error)}")
+        
+        if entry["attempts"] >= self.MAX_ATTEMPTS:
+            self.dead_dir.mkdir(parents=True, exist_ok=True)
+            self._write_entry(self.dead_dir / path.name, entry)
+            path.unlink(missing_ok=True)
+            self.stats["dead"] += 1
+            logger.error(f"Webhook {key} moved to dead-letter store")
+            return None
+        
+        self._write_entry(path, entry)
+        self.stats["retries"] += 1
+        return min(self.BASE_RETRY_DELAY * 2 ** (entry["attempts"] - 1), self.MAX_RETRY_DELAY)
+    
+    def _apply(self, path: Path, entry: Dict[str, Any], webhook_data: Optional[Dict[str, Any]]) -> Optional[float]:
+        """Применение события. Возвращает задержку до повтора или None"""
+        from services.yoomoney_service import apply_payment_notification
+        
+        key = entry["key"]
+        if webhook_data is None:
+            # Платеж еще не завершен: событие не применяем, но и не отмечаем
+            # обработанным - настоящее уведомление не должно стать дубликатом
+            self._release_claim(key)
+            path.unlink(missing_ok=True)
+            return None
+        
+        try:
+            apply_payment_notification(webhook_data.get("event"), webhook_data.get("object") or {})
+        except Exception as e:
+            return self._fail(path, entry, e)
+        
+        self._mark_processed(self.dedupe_key(webhook_data), claimed_key=key)
+        path.unlink(missing_ok=True)
+        self.stats["processed"] += 1
+        return None
+    
+    async def _process(self, path: Path) -> Optional[float]:
+        """Обработка одного события. Возвращает задержку до повтора или None"""
+        with self._entry_lock(path) as acquired:
+            if not acquired:
+                return None
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+            except FileNotFoundError:
+                return None
+            
+            if await asyncio.to_thread(self._key_state, entry["key"]) == "processed":
+                path.unlink(missing_ok=True)
+                return None
+            
+            webhook_data = entry["data"]
+            if webhook_data.get("unverified"):
+                try:
+                    webhook_data = await self._verified(webhook_data)
+                except Exception as e:
+                    return await asyncio.to_thread(self._fail, path, entry, e)
+            return await asyncio.to_thread(self._apply, path, entry, webhook_data)
+    
+    async def _retry_later(self, path: Path, delay: float):
+        await asyncio.sleep(delay)
+        self._queue.put_nowait(path)
+    
+    async def _worker(self):
+        while True:
+            path = await self._queue.get()
+            try:
+                delay = await self._process(path)
+                if delay is not None:
+                    asyncio.create_task(self._retry_later(path, delay))
+            except Exception as e:
+                logger.error(f"Webhook worker error: {str(e)}")
+            finally:
+                self._queue.task_done()
+    
+    def _recover(self) -> List[Path]:
+        """Незавершенные события после перезапуска"""
+        if not self.pending_dir.exists():
+            return []
+        return sorted(self.pending_dir.glob("*.json"))
+    
+    async def start(self):
+        """Запуск воркеров и восстановление очереди"""
+        self._queue = asyncio.Queue()
+        for path in await asyncio.to_thread(self._recover):
+            self._queue.put_nowait(path)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.WORKERS)]
+        return self._workers
+    
+    def get_dead_letters(self) -> List[Dict[str, Any]]:
+        if not self.dead_dir.exists():
+            return []
+        letters = []
+        for path in sorted(self.dead_dir.glob("*.json")):
+            with open(path, "r", encoding="utf-8") as f:
+                letters.append({"id": path.stem, **json.load(f)})
+        return letters
+    
+    async def retry_dead_letter(self, letter_id: str) -> bool:
+        """Возврат события из dead-letter в очередь"""
+        source = self.dead_dir / f"{letter_id}.json"
+        if source.parent != self.dead_dir or not source.exists():
+            return False
+        
+        def move():
+            with open(source, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            entry["attempts"] = 0
+            self.pending_dir.mkdir(parents=True, exist_ok=True)
+            target = self.pending_dir / source.name
+            self._write_entry(target, entry)
+            source.unlink(missing_ok=True)
+            return target
+        
+        target = await asyncio.to_thread(move)
+        if self._queue is not None:
+            self._queue.put_nowait(target)
+        return True
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "pending": len(self._recover())
+        }
+
+# Глобальный экземпляр сервиса
+webhook_queue = WebhookQueue()
+
+def get_webhook_queue() -> WebhookQueue:
+    """Получение экземпляра очереди webhook"""
+    return webhook_queue
@@ -3,6 +3,7 @@ YooMoney (YooKassa) Payment Service
 Интеграция с российской платежной системой YooMoney для обработки платежей
 """
 
+import asyncio
 import httpx
 import json
 import uuid
@@ -53,7 +54,8 @@ class YooMoneyService:
         description: str = "Оплата заказа",
         return_url: str = None,
         capture: bool = True,
-        metadata: Optional[Dict] = None
+        metadata: Optional[Dict] = None,
+        idempotency_key: Optional[str] = None
     ) -> YooMoneyPayment:
         """Создание платежа в YooMoney"""
         try:
@@ -73,7 +75,8 @@ class YooMoneyService:
             if metadata:
                 payment_data["metadata"] = metadata
             
-            idempotency_key = self.generate_idempotency_key()
+            # Ключ клиента передаем в YooKassa, чтобы повтор не создал второй платеж
+            idempotency_key = idempotency_key or self.generate_idempotency_key()
             
             response = await self.client.post(
                 f"{self.base_url}/v3/payments",
@@ -137,6 +140,27 @@ class YooMoneyService:
             logger.error(f"Error capturing payment: {str(e)}")
             raise
     
+    async def cancel_payment(self, payment_id: str) -> YooMoneyPayment:
+        """Отмена платежа"""
+        try:
+            response = await self.client.post(
+                f"{self.base_url}/v3/payments/{payment_id}/cancel",
+                json={},
+                # Ключ от платежа: повторная отмена не считается новым запросом
+                headers={"Idempotence-Key": f"cancel-{payment_id}"}
+            )
+            
+            if response.status_code == 200:
+                result = response.json()
+                return YooMoneyPayment(**result)
+            else:
+                logger.error(f"Payment cancel failed: {response.status_code} - {response.text}")
+                raise Exception(f"Payment cancel failed: {response.text}")
+                
+        except Exception as e:
+            logger.error(f"Error canceling payment: {str(e)}")
+            raise
+    
     def verify_webhook(self, request_body: bytes, signature: str) -> bool:
         """Проверка подписи webhook уведомления"""
         try:
@@ -154,57 +178,75 @@ class YooMoneyService:
     async def process_webhook(self, webhook_data: Dict[str, Any]) -> bool:
         """Обработка webhook уведомления"""
         try:
-            event_type = webhook_data.get("event")
-            payment_object = webhook_data.get("object", {})
-            
-            payment_id = payment_object.get("id")
-            payment_status = payment_object.get("status")
-            
-            logger.info(f"Processing webhook: {event_type} for payment {payment_id} with status {payment_status}")
-            
-            # Здесь должна быть логика обновления заказа в базе данных
-            # В зависимости от статуса платежа
-            
-            if event_type == "payment.succeeded":
-                # Платеж успешно завершен
-                await self._handle_successful_payment(payment_object)
-            elif event_type == "payment.canceled":
-                # Платеж отменен
-                await self._handle_canceled_payment(payment_object)
-            
+            await asyncio.to_thread(
+                apply_payment_notification,
+                webhook_data.get("event"),
+                webhook_data.get("object", {})
+            )
             return True
             
         except Exception as e:
             logger.error(f"Error processing webhook: {str(e)}")
             return False
     
-    async def _handle_successful_payment(self, payment_object: Dict[str, Any]):
-        """Обработка успешного платежа"""
-        payment_id = payment_object.get("id")
-        amount = payment_object.get("amount", {}).get("value")
-        
-        logger.info(f"Payment {payment_id} succeeded with amount {amount}")
-        
-        # Здесь нужно:
-        # 1. Обновить статус заказа в базе данных
-        # 2. Отправить уведомление покупателю
-        # 3. Запустить процесс выполнения заказа
-        
-    async def _handle_canceled_payment(self, payment_object: Dict[str, Any]):
-        """Обработка отмененного платежа"""
-        payment_id = payment_object.get("id")
-        
-        logger.info(f"Payment {payment_id} was canceled")
-        
-        # Здесь нужно:
-        # 1. Обновить статус заказа в базе данных
-        # 2. Освободить товары в корзине
-        # 3. Отправить уведомление покупателю
+    async def warm_up(self) -> bool:
+        """Открытие соединения с API (TLS handshake) до первого платежа"""
+        try:
+            response = await self.client.get(f"{self.base_url}/v3/me", timeout=5.0)
+            return response.status_code == 200
+        except Exception as e:
+            logger.warning(f"YooMoney warm-up failed: {str(e)}")
+            return False
     
     async def close(self):
         """Закрытие HTTP клиента"""
         await self.client.aclose()
 
+# Статус платежа, в который переводит событие уведомления
+EVENT_STATUSES = {
+    "payment.succeeded": "succeeded",
+    "payment.canceled": "canceled",
+    "payment.waiting_for_capture": "waiting_for_capture",
+}
+
+def apply_payment_notification(event_type: Optional[str], payment_object: Dict[str, Any]) -> Dict[str, Any]:
+    """Применение смены статуса платежа: запись платежа и связанный заказ.
+    Общий путь для webhook и сверки статусов; повторный вызов безопасен.
+    Ошибки пробрасываются, чтобы вызывающий мог повторить попытку"""
+    from database import Database
+    from services.inventory_service import get_reservation_engine
+    
+    payment_id = payment_object.get("id")
+    status = payment_object.get("status") or EVENT_STATUSES.get(event_type)
+    logger.info(f"Processing payment event: {event_type} for payment {payment_id} with status {status}")
+    
+    payment = Database.get_payment(payment_id) if payment_id else None
+    if payment is None:
+        # Действуем только по платежам, которые создавал магазин. Уведомление
+        # может обогнать запись платежа при оформлении - ошибка даст повтор
+        raise LookupError(f"Unknown payment {payment_id}")
+    if status and payment.get("status") != status:
+        payment = Database.update_payment_status(payment_id, status)
+    
+    # Заказ берем из сохраненной записи платежа, а не из metadata уведомления
+    order_id = payment.get("order_id")
+    order = None
+    if order_id and status == "succeeded":
+        # Резерв товара становится окончательным списанием, заказ - оплаченным
+        logger.info(f"Payment {payment_id} succeeded with amount {payment_object.get('amount', {}).get('value')}")
+        order = get_reservation_engine().commit(order_id)
+    elif order_id and status == "canceled":
+        # Возвращаем зарезервированный товар в остаток и отменяем заказ
+        logger.info(f"Payment {payment_id} was canceled")
+        order = get_reservation_engine().release(order_id)
+    
+    return {
+        "payment_id": payment_id,
+        "status": status,
+        "order_id": order_id,
+        "order_status": (order or {}).get("status")
+    }
+
 # Глобальный экземпляр сервиса
 yoomoney_service = None
 
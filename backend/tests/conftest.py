@@ -0,0 +1,43 @@
+"""
+Общие фикстуры тестов backend: изолированный каталог данных, заполненный
+начальными JSON из backend/data перед каждым тестом
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+TEST_ROOT = Path(tempfile.mkdtemp(prefix="nexx-tests-"))
+
+# Модули читают пути при импорте, поэтому окружение задается до них
+os.environ.setdefault("DATA_DIR", str(TEST_ROOT / "data"))
+os.environ.setdefault("UPLOAD_DIR", str(TEST_ROOT / "uploads"))
+os.environ.setdefault("MEDIA_CACHE_DIR", str(TEST_ROOT / "media_cache"))
+os.environ.setdefault("FEEDS_DIR", str(TEST_ROOT / "feeds"))
+sys.path.insert(0, str(BACKEND_DIR))
+
+@pytest.fixture(autouse=True)
+def data_dir():
+    """Чистая копия данных и пустой кэш коллекций для каждого теста"""
+    import database
+
+    shutil.rmtree(database.DATA_DIR, ignore_errors=True)
+    shutil.copytree(BACKEND_DIR / "data", database.DATA_DIR)
+    os.remove(os.path.join(database.DATA_DIR, "cart.json"))
+    with database._cache_lock:
+        database._collection_cache.clear()
+        database._index_cache.clear()
+    yield Path(database.DATA_DIR)
+
+@pytest.fixture
+def client():
+    """HTTP-клиент приложения без lifespan (прогрев и фоновые задачи не нужны)"""
+    from fastapi.testclient import TestClient
+    import server
+
+    return TestClient(server.app)
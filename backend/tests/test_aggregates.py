@@ -0,0 +1,114 @@
+import uuid
+from datetime import datetime
+
+from database import ORDERS_FILE, Database, save_json
+from services.analytics_service import DashboardAggregates
+
+def _order(amount: float):
+    return {
+        "id": str(uuid.uuid4()),
+        "status": "pending",
+        "total_amount": amount,
+        "created_at": datetime.now().isoformat(),
+        "items": []
+    }
+
+def _write(order):
+    orders = list(Database.get_orders())
+    orders.append(order)
+    save_json(ORDERS_FILE, orders)
+
+def _aggregates():
+    aggregates = DashboardAggregates()
+    aggregates.rebuild()
+    return aggregates
+
+def test_interleaved_writes_are_not_counted_twice():
+    aggregates = _aggregates()
+    first, second = _order(100), _order(250)
+
+    # Обе записи успели попасть на диск до оповещений
+    _write(first)
+    _write(second)
+    aggregates.handle_change(ORDERS_FILE, "add", first, None)
+    aggregates.handle_change(ORDERS_FILE, "add", second, None)
+
+    dashboard = aggregates.get_dashboard()
+    assert dashboard["orders"]["total"] == len(Database.get_orders()) == 2
+    assert dashboard["revenue"]["total"] == 350
+
+def test_sequential_and_batched_events_are_applied():
+    aggregates = _aggregates()
+
+    single = _order(10)
+    _write(single)
+    aggregates.handle_change(ORDERS_FILE, "add", single, None)
+
+    # Одна запись файла с несколькими событиями (массовый импорт)
+    batch = [_order(20), _order(30)]
+    save_json(ORDERS_FILE, list(Database.get_orders()) + batch)
+    for order in batch:
+        aggregates.handle_change(ORDERS_FILE, "add", order, None)
+
+    dashboard = aggregates.get_dashboard()
+    assert dashboard["orders"]["total"] == 3
+    assert dashboard["revenue"]["total"] == 60
+
+def test_stale_event_after_rebuild_is_skipped():
+    aggregates = _aggregates()
+    order = _order(40)
+    _write(order)
+
+    updated = {**order, "status": "cancelled"}
+    orders = [updated if o["id"] == order["id"] else o for o in Database.get_orders()]
+    save_json(ORDERS_FILE, orders)
+
+    # Пересчет видит уже отмененный заказ; запоздалые события не меняют итог
+    aggregates.handle_change(ORDERS_FILE, "add", order, None)
+    aggregates.handle_change(ORDERS_FILE, "update", updated, order)
+
+    dashboard = aggregates.get_dashboard()
+    assert dashboard["orders"]["total"] == 1
+    assert dashboard["revenue"]["total"] == 0
+
+def test_sales_report_ignores_stale_status_after_rebuild():
+    from services.reports_service import SalesReportEngine
+
+    engine = SalesReportEngine()
+    engine.rebuild()
+
+    product = Database.get_products()[0]
+    order = {**_order(0), "items": [{"product_id": product["id"], "quantity": 2, "product_price": 50}]}
+    _write(order)
+    engine.handle_change(ORDERS_FILE, "add", order, None)
+
+    processing = {**order, "status": "processing"}
+    cancelled = {**order, "status": "cancelled"}
+    for state in (processing, cancelled):
+        save_json(ORDERS_FILE, [state if o["id"] == order["id"] else o for o in Database.get_orders()])
+
+    # Оповещения из разных потоков пришли в обратном порядке
+    engine.handle_change(ORDERS_FILE, "update", cancelled, processing)
+    engine.handle_change(ORDERS_FILE, "update", processing, order)
+
+    assert engine.query()["totals"]["revenue"] == 0
+
+def test_stock_index_ignores_stale_quantity_after_rebuild():
+    from database import PRODUCTS_FILE
+    from services.inventory_service import StockIndex
+
+    index = StockIndex()
+    index.rebuild()
+    out_of_stock = index.counts()["out_of_stock"]
+
+    product = Database.get_products()[0]
+    restocked = {**product, "stock_quantity": 50}
+    sold_out = {**product, "stock_quantity": 0}
+    for state in (restocked, sold_out):
+        save_json(PRODUCTS_FILE, [state if p["id"] == product["id"] else p for p in Database.get_products()])
+
+    index.handle_change(PRODUCTS_FILE, "update", sold_out, restocked)
+    index.handle_change(PRODUCTS_FILE, "update", restocked, product)
+
+    assert index.entries[product["id"]][0] == 0
+    assert index.counts()["out_of_stock"] == out_of_stock + (1 if product.get("stock_quantity", 0) > 0 else 0)
@@ -0,0 +1,48 @@
+import json
+import os
+import time
+
+from database import Database, cart_path
+from services.cart_service import CartViewEngine
+
+def _write_as_other_worker(user_id, items):
+    """Запись корзины в обход кэша процесса, как это делает другой воркер"""
+    path = cart_path(user_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"user_id": user_id, "items": items}, f)
+    # Гарантированно другой mtime даже на грубых файловых системах
+    future = time.time_ns() + 10**9
+    os.utime(path, ns=(future, future))
+
+def _line(product, quantity):
+    return {"id": f"line-{product['id']}", "product_id": product["id"], "product_name": product["name"],
+            "product_price": product["price"], "quantity": quantity}
+
+def test_view_sees_cart_changed_by_other_worker():
+    engine = CartViewEngine()
+    product = Database.get_products()[0]
+    Database.add_to_cart("u1", product["id"], 1)
+    assert engine.view("u1")["items"][0]["quantity"] == 1
+
+    _write_as_other_worker("u1", [_line(product, 3)])
+
+    assert engine.view("u1")["items"][0]["quantity"] == 3
+
+def test_view_sees_cart_created_by_other_worker():
+    engine = CartViewEngine()
+    product = Database.get_products()[0]
+    assert engine.view("u2")["items"] == []
+
+    _write_as_other_worker("u2", [_line(product, 2)])
+
+    assert engine.view("u2")["items"][0]["quantity"] == 2
+
+def test_unchanged_cart_view_is_memoized():
+    engine = CartViewEngine()
+    Database.add_to_cart("u1", Database.get_products()[0]["id"], 1)
+
+    first = engine.view("u1")
+
+    assert engine.view("u1") is first
+    assert engine.stats == {"hits": 1, "misses": 1}
@@ -0,0 +1,57 @@
+import json
+import os
+import threading
+import time
+
+import database
+from database import Database, CART_FILE, cart_path
+
+def test_legacy_migration_waits_for_other_worker(data_dir):
+    product = Database.get_products()[0]
+    with open(CART_FILE, "w", encoding="utf-8") as f:
+        json.dump({"legacy": [{"id": "l1", "product_id": product["id"], "quantity": 2}]}, f)
+
+    errors = []
+
+    def migrate():
+        try:
+            database._migrate_legacy_carts()
+        except Exception as e:
+            errors.append(e)
+
+    # Блокировку держит другой воркер, который уже переносит корзины
+    with database._process_lock(f"{CART_FILE}.lock"):
+        worker = threading.Thread(target=migrate)
+        worker.start()
+        worker.join(0.2)
+        assert worker.is_alive()
+        os.replace(CART_FILE, f"{CART_FILE}.migrated")
+    worker.join()
+
+    assert errors == []
+    assert not os.path.exists(cart_path("legacy"))
+
+def test_legacy_migration_moves_carts(data_dir):
+    product = Database.get_products()[0]
+    with open(CART_FILE, "w", encoding="utf-8") as f:
+        json.dump({"legacy": [{"id": "l1", "product_id": product["id"], "quantity": 2}]}, f)
+
+    database._migrate_legacy_carts()
+
+    assert Database.get_cart("legacy")[0]["quantity"] == 2
+    assert os.path.exists(f"{CART_FILE}.migrated")
+
+def test_sweep_drops_idle_carts_from_cache():
+    product_id = Database.get_products()[0]["id"]
+    Database.add_to_cart("idle", product_id, 1)
+    Database.add_to_cart("active", product_id, 1)
+    hour_ago = time.time() - 2 * 3600
+    os.utime(cart_path("idle"), (hour_ago, hour_ago))
+
+    stats = Database.evict_idle_carts(30 * 86400)
+
+    assert stats["uncached"] == 1
+    assert cart_path("idle") not in database._collection_cache
+    assert cart_path("active") in database._collection_cache
+    # Корзина осталась на диске и читается заново
+    assert Database.get_cart("idle")[0]["quantity"] == 1
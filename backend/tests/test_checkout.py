@@ -0,0 +1,128 @@
+import asyncio
+
+import pytest
+
+from database import Database
+from services import yoomoney_service
+from services.checkout_service import CheckoutPipeline
+from services.inventory_service import ReservationEngine
+
+ORDER_DATA = {"user_name": "a", "user_email": "a@a", "user_phone": "1", "delivery_address": "x"}
+
+class FakePayment:
+    id = "pay-1"
+    status = "pending"
+    confirmation = {"confirmation_url": "https://pay"}
+
+class FakeYooMoney:
+    def __init__(self, cancel_fails=False):
+        self.cancel_fails = cancel_fails
+        self.canceled = []
+
+    async def create_payment(self, **kwargs):
+        return FakePayment()
+
+    async def cancel_payment(self, payment_id):
+        if self.cancel_fails:
+            raise RuntimeError("cannot cancel")
+        self.canceled.append(payment_id)
+
+@pytest.fixture
+def product_id():
+    product_id = Database.get_products()[0]["id"]
+    Database.update_product(product_id, {"stock_quantity": 5})
+    return product_id
+
+def _checkout_with_failed_commit(monkeypatch, yoomoney):
+    monkeypatch.setattr(yoomoney_service, "yoomoney_service", yoomoney)
+
+    def fail(*args, **kwargs):
+        raise IOError("disk full")
+
+    monkeypatch.setattr(Database, "commit_checkout", fail)
+    with pytest.raises(IOError):
+        asyncio.run(CheckoutPipeline().run("u1", ORDER_DATA, {"return_url": "https://shop"}))
+
+def test_failed_checkout_cancels_created_payment(monkeypatch, product_id):
+    yoomoney = FakeYooMoney()
+    Database.add_to_cart("u1", product_id, 2)
+
+    _checkout_with_failed_commit(monkeypatch, yoomoney)
+
+    assert yoomoney.canceled == ["pay-1"]
+    assert Database.get_product(product_id)["stock_quantity"] == 5
+    assert Database.get_payment("pay-1") is None
+    order = Database.get_orders()[-1]
+    assert order["status"] == "cancelled"
+    assert order["reservation"]["status"] == "released"
+
+def test_payment_that_cannot_be_canceled_is_recorded_for_refund(monkeypatch, product_id):
+    Database.add_to_cart("u1", product_id, 1)
+
+    _checkout_with_failed_commit(monkeypatch, FakeYooMoney(cancel_fails=True))
+
+    payment = Database.get_payment("pay-1")
+    assert payment["refund_required"] is True
+    assert payment["order_id"] is None
+
+def test_commit_keeps_lines_added_during_checkout(product_id):
+    other_id = Database.get_products()[1]["id"]
+    Database.add_to_cart("u1", product_id, 1)
+    order = Database.build_order({"user_id": "u1", "items": [dict(item) for item in Database.get_cart("u1")]})
+
+    # Пока шло оформление, покупатель изменил корзину
+    Database.add_to_cart("u1", product_id, 2)
+    Database.add_to_cart("u1", other_id, 1)
+    Database.commit_checkout("u1", order)
+
+    remaining = {item["product_id"]: item["quantity"] for item in Database.get_cart("u1")}
+    assert remaining == {product_id: 2, other_id: 1}
+    assert Database.get_order(order["id"]) is not None
+
+class CrashingYooMoney(FakeYooMoney):
+    """Процесс падает, пока ждет ответа платежной системы"""
+
+    def __init__(self):
+        super().__init__()
+        self.seen = None
+
+    async def create_payment(self, **kwargs):
+        order = Database.get_order(kwargs["metadata"]["order_id"])
+        self.seen = (order["status"], order["reservation"]["status"])
+        raise asyncio.CancelledError()
+
+def test_reservation_is_owned_by_saved_order_during_payment(monkeypatch, product_id):
+    yoomoney = CrashingYooMoney()
+    monkeypatch.setattr(yoomoney_service, "yoomoney_service", yoomoney)
+    # Компенсации не выполняются: процесс упал
+    monkeypatch.setattr("services.checkout_service.CheckoutContext.compensate", lambda self: asyncio.sleep(0))
+    Database.add_to_cart("u1", product_id, 2)
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(CheckoutPipeline().run("u1", ORDER_DATA, {"return_url": "https://shop"}))
+
+    assert yoomoney.seen == ("pending", "reserved")
+    assert Database.get_product(product_id)["stock_quantity"] == 3
+
+    # После перезапуска резерв находится по заказу и снимается по истечении
+    order = Database.get_orders()[-1]
+    Database.update_order(order["id"], {"reservation": {**order["reservation"], "expires_at": "2000-01-01T00:00:00"}})
+    engine = ReservationEngine()
+    engine.load_pending()
+
+    assert engine.expire_stale() == 1
+    assert Database.get_product(product_id)["stock_quantity"] == 5
+    assert Database.get_order(order["id"])["status"] == "cancelled"
+
+def test_completed_checkout_saves_order_once(monkeypatch, product_id):
+    monkeypatch.setattr(yoomoney_service, "yoomoney_service", FakeYooMoney())
+    Database.add_to_cart("u1", product_id, 2)
+
+    result = asyncio.run(CheckoutPipeline().run("u1", ORDER_DATA, {"return_url": "https://shop"}))
+
+    order_id = result["order"]["id"]
+    assert [o["id"] for o in Database.get_orders()].count(order_id) == 1
+    assert Database.get_payment("pay-1")["order_id"] == order_id
+    assert Database.get_order(order_id)["reservation"]["status"] == "reserved"
+    assert Database.get_cart("u1") == []
+    assert Database.get_product(product_id)["stock_quantity"] == 3
@@ -0,0 +1,42 @@
+import asyncio
+import gzip
+
+from services.compression import CompressionMiddleware
+
+def _run(app, accept_encoding="gzip"):
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/", "headers": [(b"accept-encoding", accept_encoding.encode())]}
+    asyncio.run(CompressionMiddleware(app, minimum_size=10)(scope, receive, send))
+    return sent
+
+def _start(content_type=b"application/json"):
+    return {"type": "http.response.start", "status": 200, "headers": [(b"content-type", content_type)]}
+
+def test_start_is_sent_before_pathsend():
+    async def app(scope, receive, send):
+        await send(_start(b"text/plain"))
+        await send({"type": "http.response.pathsend", "path": "/tmp/file.txt"})
+
+    sent = _run(app)
+
+    assert [message["type"] for message in sent] == ["http.response.start", "http.response.pathsend"]
+    assert all(name != b"content-encoding" for name, _ in sent[0]["headers"])
+
+def test_single_body_is_compressed():
+    body = b'{"data": "' + b"x" * 100 + b'"}'
+
+    async def app(scope, receive, send):
+        await send(_start())
+        await send({"type": "http.response.body", "body": body})
+
+    start, message = _run(app)
+
+    assert dict(start["headers"])[b"content-encoding"] == b"gzip"
+    assert gzip.decompress(message["body"]) == body
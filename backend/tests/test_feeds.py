@@ -0,0 +1,60 @@
+import csv
+import os
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from database import Database
+from services import feed_service
+from services.feed_service import FeedExporter, FEEDS
+
+NAME = 'Фильтр <A&B> "Pro"'
+
+@pytest.fixture
+def feeds_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(feed_service, "FEEDS_DIR", tmp_path)
+    product_id = Database.get_products()[0]["id"]
+    Database.update_product(product_id, {"name": NAME, "description": "a < b & c"})
+    return tmp_path
+
+def test_feeds_escape_product_text(feeds_dir):
+    FeedExporter().rebuild(force=True)
+
+    shop = ET.parse(feeds_dir / FEEDS["yml"].filename).getroot().find("shop")
+    assert NAME in [offer.findtext("name") for offer in shop.iter("offer")]
+    channel = ET.parse(feeds_dir / FEEDS["google"].filename).getroot().find("channel")
+    assert NAME in [item.findtext("title") for item in channel.iter("item")]
+    with open(feeds_dir / FEEDS["csv"].filename, encoding="utf-8", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert {"title": NAME, "description": "a < b & c"}.items() <= next(
+        row for row in rows if row["title"] == NAME
+    ).items()
+
+def test_rebuild_replaces_published_feed_atomically(feeds_dir):
+    exporter = FeedExporter()
+    exporter.rebuild(force=True)
+    target = feeds_dir / FEEDS["yml"].filename
+    published = target.read_bytes()
+
+    with open(target, "rb") as reader:
+        exporter.rebuild(force=True)
+        # Читатель старого фида дочитывает его целиком: файл заменен, а не переписан
+        assert reader.read() == published
+        assert os.stat(target).st_ino != os.fstat(reader.fileno()).st_ino
+    assert [path.name for path in feeds_dir.iterdir() if path.name.endswith(".tmp")] == []
+
+def test_failed_rebuild_keeps_published_feed(feeds_dir, monkeypatch):
+    exporter = FeedExporter()
+    exporter.rebuild(force=True)
+    target = feeds_dir / FEEDS["yml"].filename
+    published = target.read_bytes()
+
+    def fail(product, shop):
+        raise RuntimeError("render failed")
+
+    monkeypatch.setattr(FEEDS["yml"], "offer", fail)
+    with pytest.raises(RuntimeError):
+        exporter.rebuild(force=True)
+
+    assert target.read_bytes() == published
+    assert [path.name for path in feeds_dir.iterdir() if path.name.endswith(".tmp")] == []
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+from database import Database, DATA_DIR
+from services.guest_cart_service import GuestCartService, GuestCartError
+
+SECRET_FILE = os.path.join(DATA_DIR, "guest_cart_secret.key")
+
+@pytest.fixture(autouse=True)
+def fresh_secret():
+    if os.path.exists(SECRET_FILE):
+        os.unlink(SECRET_FILE)
+
+def test_repeated_merge_does_not_double_quantities():
+    service = GuestCartService()
+    product_id = Database.get_products()[0]["id"]
+    token = service.encode([(product_id, 2)])
+
+    service.merge("u1", token)
+    # Повтор запроса входа с тем же токеном
+    service.merge("u1", token)
+
+    assert [item["quantity"] for item in Database.get_cart("u1")] == [2]
+
+def test_merge_keeps_larger_quantity_already_in_cart():
+    service = GuestCartService()
+    product_id = Database.get_products()[0]["id"]
+    Database.add_to_cart("u1", product_id, 3)
+
+    service.merge("u1", service.encode([(product_id, 1)]))
+
+    assert [item["quantity"] for item in Database.get_cart("u1")] == [3]
+
+@pytest.mark.parametrize("quantity", [0, -2, 1.5, "3", True, 10 ** 6])
+def test_decode_rejects_invalid_quantities(quantity):
+    service = GuestCartService()
+    token = service.encode([("p1", quantity)])
+
+    with pytest.raises(GuestCartError):
+        service.decode(token)
+
+def test_secret_is_shared_between_instances():
+    first, second = GuestCartService(), GuestCartService()
+
+    assert first._get_secret() == second._get_secret()
+    assert len(first._get_secret()) == 64
+    assert [name for name in os.listdir(DATA_DIR) if name.endswith(".tmp")] == []
+
+def test_empty_secret_file_is_not_cached():
+    service = GuestCartService()
+    open(SECRET_FILE, "w").close()
+
+    with pytest.raises(GuestCartError):
+        service._get_secret()
+
+    with open(SECRET_FILE, "w") as f:
+        f.write("k" * 64)
+    assert service._get_secret() == b"k" * 64
@@ -0,0 +1,47 @@
+import multiprocessing
+import os
+
+import database
+from database import Database, save_json, PRODUCTS_FILE
+from services.http_cache import make_etag
+
+def _worker_etag(results):
+    # Новый воркер: своих версий коллекций у него еще нет
+    database._collection_versions.clear()
+    database._collection_cache.clear()
+    Database.get_products()
+    results.put(make_etag("products", PRODUCTS_FILE))
+
+def test_etag_is_the_same_in_every_worker():
+    products = Database.get_products()
+    save_json(PRODUCTS_FILE, products)
+    save_json(PRODUCTS_FILE, products)
+
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    worker = context.Process(target=_worker_etag, args=(results,))
+    worker.start()
+    worker_etag = results.get(timeout=30)
+    worker.join(timeout=30)
+
+    assert worker_etag == make_etag("products", PRODUCTS_FILE)
+
+def test_not_modified_after_worker_restart(client):
+    etag = client.get("/api/products").headers["etag"]
+    database._collection_versions.clear()
+
+    response = client.get("/api/products", headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+
+def test_rewrite_within_mtime_resolution_changes_etag():
+    products = Database.get_products()
+    before = os.stat(PRODUCTS_FILE)
+    etag = make_etag("products", PRODUCTS_FILE)
+
+    # Та же длина и то же время изменения: различает только новый файл
+    save_json(PRODUCTS_FILE, products)
+    os.utime(PRODUCTS_FILE, ns=(before.st_atime_ns, before.st_mtime_ns))
+
+    assert os.stat(PRODUCTS_FILE).st_size == before.st_size
+    assert make_etag("products", PRODUCTS_FILE) != etag
@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from database import load_json, save_json, IDEMPOTENCY_FILE
+from services.idempotency_service import (
+    IdempotencyService, IdempotencyConflictError, IdempotencyInProgressError
+)
+
+def _run(service, scope, key, fingerprint, handler):
+    return asyncio.run(service.execute(scope, key, fingerprint, handler))
+
+def _counting_handler(calls, body=None):
+    async def handler():
+        calls.append(1)
+        return body or {"success": True, "n": len(calls)}
+    return handler
+
+def test_replay_returns_stored_response():
+    service, calls = IdempotencyService(), []
+    first = _run(service, "orders:u1", "k1", "fp", _counting_handler(calls))
+    second = _run(service, "orders:u1", "k1", "fp", _counting_handler(calls))
+
+    assert first == (200, {"success": True, "n": 1}, False)
+    assert second == (200, {"success": True, "n": 1}, True)
+    assert len(calls) == 1
+
+def test_replay_with_other_parameters_is_rejected():
+    service = IdempotencyService()
+    _run(service, "orders:u1", "k1", "fp", _counting_handler([]))
+
+    with pytest.raises(IdempotencyConflictError):
+        _run(service, "orders:u1", "k1", "other", _counting_handler([]))
+
+def test_same_key_in_other_scope_does_not_collide():
+    service, calls = IdempotencyService(), []
+    _run(service, "payments:u1", "k1", "fp", _counting_handler(calls))
+    status_code, _, replayed = _run(service, "payments:u2", "k1", "fp", _counting_handler(calls))
+
+    assert (status_code, replayed) == (200, False)
+    assert len(calls) == 2
+    assert IdempotencyService.provider_key("payments:u1", "k1") != IdempotencyService.provider_key("payments:u2", "k1")
+
+def test_records_are_shared_between_workers():
+    first_worker, second_worker, calls = IdempotencyService(), IdempotencyService(), []
+    _run(first_worker, "orders:u1", "k1", "fp", _counting_handler(calls))
+    # Запись другого воркера не затирается при сохранении своей
+    _run(second_worker, "orders:u1", "k2", "fp", _counting_handler(calls))
+
+    _, _, replayed = _run(second_worker, "orders:u1", "k1", "fp", _counting_handler(calls))
+    assert replayed is True
+    assert len(calls) == 2
+    assert {"orders:u1:k1", "orders:u1:k2"} <= set(load_json(IDEMPOTENCY_FILE, {}))
+
+def test_request_in_progress_in_other_worker_is_not_executed_twice():
+    now = time.time()
+    save_json(IDEMPOTENCY_FILE, {"orders:u1:k1": {
+        "fingerprint": "fp", "status": "in_progress", "created_at": now, "expires_at": now + 60
+    }})
+    service, calls = IdempotencyService(), []
+    service.IN_PROGRESS_WAIT = 0.2
+
+    with pytest.raises(IdempotencyInProgressError):
+        _run(service, "orders:u1", "k1", "fp", _counting_handler(calls))
+    assert calls == []
+
+def test_server_error_releases_key():
+    service, calls = IdempotencyService(), []
+
+    async def failing():
+        raise HTTPException(status_code=502, detail="provider down")
+
+    with pytest.raises(HTTPException):
+        _run(service, "orders:u1", "k1", "fp", failing)
+    assert "orders:u1:k1" not in load_json(IDEMPOTENCY_FILE, {})
+
+    _, _, replayed = _run(service, "orders:u1", "k1", "fp", _counting_handler(calls))
+    assert replayed is False
@@ -0,0 +1,72 @@
+import hashlib
+import multiprocessing
+
+from database import Database, load_json, MEDIA_FILE
+from services.media_service import MediaService
+
+def _blob(upload_dir, content: bytes) -> str:
+    name = hashlib.sha256(content).hexdigest() + ".jpg"
+    (upload_dir / name).write_bytes(content)
+    return name
+
+def test_gc_keeps_blobs_referenced_by_products_and_pages(tmp_path):
+    service = MediaService(upload_dir=tmp_path)
+    service.ORPHAN_GRACE_PERIOD = 0
+
+    product_blob = _blob(tmp_path, b"product image")
+    page_blob = _blob(tmp_path, b"page image")
+    orphan = _blob(tmp_path, b"orphan")
+
+    product = Database.get_products()[0]
+    Database.update_product(product["id"], {"image_url": f"/uploads/{product_blob}"})
+    Database.add_page({"slug": "about", "title": "О нас", "content": f'<img src="/uploads/{page_blob}">'})
+
+    result = service.collect_garbage()
+
+    assert result["blobs_removed"] == 1
+    assert (tmp_path / product_blob).exists()
+    assert (tmp_path / page_blob).exists()
+    assert not (tmp_path / orphan).exists()
+
+def test_gc_keeps_fresh_orphans_during_grace_period(tmp_path):
+    service = MediaService(upload_dir=tmp_path)
+    orphan = _blob(tmp_path, b"just uploaded")
+
+    assert service.collect_garbage()["blobs_removed"] == 0
+    assert (tmp_path / orphan).exists()
+
+def _streamed(tmp_path, content: bytes):
+    temp_path = tmp_path / "upload.part"
+    temp_path.write_bytes(content)
+    return {"sha256": hashlib.sha256(content).hexdigest(), "temp_path": temp_path, "size": len(content)}
+
+def test_duplicate_of_concurrently_deleted_record_gets_new_record(tmp_path, monkeypatch):
+    service = MediaService(upload_dir=tmp_path)
+    content = b"image"
+    blob = _blob(tmp_path, content)
+    # Запись нашлась, но другой запрос удалил ее до увеличения счетчика
+    stale = {"id": "deleted", "filename": blob, "sha256": hashlib.sha256(content).hexdigest()}
+    monkeypatch.setattr(Database, "get_media_by_sha256", staticmethod(lambda sha256: stale))
+
+    file_info, duplicate = service._commit(_streamed(tmp_path, content), "photo.jpg", "image/jpeg")
+
+    assert duplicate is False
+    assert file_info["filename"] == blob
+    assert file_info["id"] in {f["id"] for f in load_json(MEDIA_FILE, [])}
+
+def _add_references(media_id, count):
+    for _ in range(count):
+        Database.add_media_reference(media_id)
+
+def test_reference_counts_survive_concurrent_workers():
+    Database.add_media_file({"id": "m1", "filename": "x.jpg", "ref_count": 1})
+
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_add_references, args=("m1", 20)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=30)
+
+    _, remaining = Database.release_media_file("m1")
+    assert remaining["ref_count"] == 80
@@ -0,0 +1,30 @@
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+
+def _upload(client, name, body, content_type):
+    response = client.post("/api/admin/media/upload", files={"file": (name, body, content_type)})
+    assert response.status_code == 200
+    return response.json()["data"]["url"]
+
+def test_html_upload_is_served_as_attachment(client):
+    url = _upload(client, "x.html", b"<script>alert(document.cookie)</script>", "text/html")
+
+    response = client.get(url)
+    assert response.headers["content-type"] == "application/octet-stream"
+    assert response.headers["content-disposition"].startswith("attachment")
+    assert response.headers["x-content-type-options"] == "nosniff"
+
+def test_svg_with_image_type_is_not_served_inline(client):
+    svg = b'<svg xmlns="http://www.w3.org/2000/svg"><script>alert(1)</script></svg>'
+    url = _upload(client, "logo.svg", svg, "image/svg+xml")
+
+    response = client.get(url)
+    assert response.headers["content-type"] == "application/octet-stream"
+    assert "attachment" in response.headers["content-disposition"]
+
+def test_image_type_comes_from_content_not_declared_type(client):
+    url = _upload(client, "photo.png", PNG, "text/html")
+
+    response = client.get(url)
+    assert response.headers["content-type"] == "image/png"
+    assert "content-disposition" not in response.headers
+    assert response.headers["x-content-type-options"] == "nosniff"
@@ -0,0 +1,49 @@
+import asyncio
+
+from services.media_service import MediaService, UploadSizeLimitMiddleware
+
+def test_upload_rejected_by_content_length(client, monkeypatch):
+    monkeypatch.setattr(MediaService, "MAX_FILE_SIZE", 1024)
+    body = b"x" * (1024 + UploadSizeLimitMiddleware.MULTIPART_OVERHEAD + 1)
+
+    response = client.post("/api/admin/media/upload", files={"file": ("big.bin", body)})
+    assert response.status_code == 413
+
+def test_chunked_upload_stops_reading_past_limit(monkeypatch):
+    import server
+
+    monkeypatch.setattr(MediaService, "MAX_FILE_SIZE", 1024)
+    chunk = b"x" * UploadSizeLimitMiddleware.MULTIPART_OVERHEAD
+    messages = [b"--b\r\nContent-Disposition: form-data; name=\"file\"; filename=\"a.bin\"\r\n\r\n"]
+    messages += [chunk] * 100 + [b"\r\n--b--\r\n"]
+    consumed = []
+    sent = []
+
+    async def receive():
+        body = messages[len(consumed)]
+        consumed.append(body)
+        return {"type": "http.request", "body": body, "more_body": len(consumed) < len(messages)}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/api/admin/media/upload", "raw_path": b"/api/admin/media/upload",
+        "root_path": "", "query_string": b"", "server": ("test", 80), "client": ("test", 1),
+        "headers": [
+            (b"host", b"test"),
+            (b"content-type", b"multipart/form-data; boundary=b"),
+            (b"transfer-encoding", b"chunked")
+        ]
+    }
+    asyncio.run(server.app(scope, receive, send))
+
+    assert sent[0]["status"] == 413
+    # Тело дочитано не до конца: разбор прерван сразу после превышения лимита
+    assert len(consumed) < 5
+
+def test_small_upload_accepted(client):
+    response = client.post("/api/admin/media/upload", files={"file": ("note.txt", b"hello", "text/plain")})
+    assert response.status_code == 200
+    assert response.json()["data"]["size"] == 5
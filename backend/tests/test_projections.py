@@ -0,0 +1,53 @@
+import json
+
+from database import Database, ProductIndex, project_record
+from services.serialization import ProductFragmentCache
+
+def test_unknown_product_fields_are_rejected(client):
+    response = client.get("/api/products", params={"fields": "name,no_such_field"})
+
+    assert response.status_code == 422
+    assert response.json()["detail"]["fields"] == ["no_such_field"]
+
+def test_known_product_fields_are_projected(client):
+    response = client.get("/api/products", params={"fields": "name,price"})
+
+    assert response.status_code == 200
+    assert set(response.json()[0]) == {"id", "name", "price"}
+
+def test_batch_rejects_unknown_fields(client):
+    product_id = Database.get_products()[0]["id"]
+
+    response = client.post("/api/products/batch", json={"ids": [product_id], "fields": "name,x"})
+
+    assert response.status_code == 422
+
+def test_unknown_order_and_user_fields_are_rejected(client):
+    assert client.get("/api/orders", params={"fields": "status,x"}).status_code == 422
+    assert client.get("/api/admin/users", params={"fields": "name,x"}).status_code == 422
+
+def test_secret_fields_are_dropped_not_rejected(client):
+    response = client.get("/api/admin/users", params={"fields": "name,password_hash"})
+
+    assert response.status_code == 200
+    assert "password_hash" not in json.dumps(response.json())
+
+def test_projection_cache_is_bounded():
+    index = ProductIndex(Database.get_products())
+    index.MAX_PROJECTIONS = 2
+
+    for fields in (("id", "name"), ("id", "price"), ("id", "brand")):
+        index.project(index.products, fields)
+
+    assert list(index._projections) == [("id", "price"), ("id", "brand")]
+
+def test_fragment_cache_is_bounded():
+    cache = ProductFragmentCache()
+    cache.MAX_FIELD_SETS = 2
+    products = Database.get_products()
+
+    for fields in (("id", "name"), ("id", "price"), ("id", "brand")):
+        body = cache.encode_list([project_record(product, fields) for product in products], fields)
+        assert json.loads(body)[0] == project_record(products[0], fields)
+
+    assert list(cache._fragments) == [("id", "price"), ("id", "brand")]
@@ -0,0 +1,86 @@
+import multiprocessing
+from datetime import timedelta
+
+import pytest
+
+from database import Database
+from services.inventory_service import InsufficientStockError, ReservationEngine
+
+def _set_stock(product_id, quantity):
+    Database.update_product(product_id, {"stock_quantity": quantity})
+
+def _stock(product_id):
+    return Database.get_product(product_id)["stock_quantity"]
+
+def _reserved_order(engine, product_id, quantity):
+    reservation = engine.reserve([{"product_id": product_id, "quantity": quantity}])
+    order = Database.add_order({"user_id": "u1", "items": [], "reservation": reservation})
+    engine.track(order)
+    return order
+
+@pytest.fixture
+def engine():
+    engine = ReservationEngine()
+    engine.RESERVATION_TTL = timedelta(0)
+    return engine
+
+def test_payment_after_expiry_reserves_stock_again(engine):
+    product_id = Database.get_products()[0]["id"]
+    _set_stock(product_id, 5)
+    order = _reserved_order(engine, product_id, 2)
+
+    assert engine.expire_stale() == 1
+    assert _stock(product_id) == 5
+
+    paid = engine.commit(order["id"])
+    assert paid["status"] == "paid"
+    assert paid["reservation"]["status"] == "committed"
+    assert not paid.get("refund_required")
+    assert _stock(product_id) == 3
+
+def test_payment_after_expiry_without_stock_flags_refund(engine):
+    product_id = Database.get_products()[0]["id"]
+    _set_stock(product_id, 2)
+    order = _reserved_order(engine, product_id, 2)
+    engine.expire_stale()
+
+    # Пока заказ висел неоплаченным, товар купили другие
+    engine.reserve([{"product_id": product_id, "quantity": 2}])
+
+    paid = engine.commit(order["id"])
+    assert paid["status"] == "paid"
+    assert paid["refund_required"] is True
+    assert paid["reservation"]["shortages"][0]["available"] == 0
+    assert _stock(product_id) == 0
+
+def test_commit_is_idempotent(engine):
+    product_id = Database.get_products()[0]["id"]
+    _set_stock(product_id, 3)
+    order = _reserved_order(engine, product_id, 1)
+
+    engine.commit(order["id"])
+    engine.commit(order["id"])
+    assert _stock(product_id) == 2
+
+def _reserve_one(product_id, results):
+    try:
+        ReservationEngine().reserve([{"product_id": product_id, "quantity": 1}])
+        results.put(True)
+    except InsufficientStockError:
+        results.put(False)
+
+def test_workers_do_not_oversell():
+    product_id = Database.get_products()[0]["id"]
+    _set_stock(product_id, 5)
+
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    workers = [context.Process(target=_reserve_one, args=(product_id, results)) for _ in range(12)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=30)
+
+    outcomes = [results.get(timeout=5) for _ in workers]
+    assert outcomes.count(True) == 5
+    assert _stock(product_id) == 0
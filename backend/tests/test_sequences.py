@@ -0,0 +1,54 @@
+import multiprocessing
+
+from database import Database, SequenceAllocator
+
+def test_numbers_increase_across_block_refills():
+    allocator = SequenceAllocator("test", block_size=3)
+
+    assert [allocator.next() for _ in range(7)] == [1, 2, 3, 4, 5, 6, 7]
+
+def test_instances_sharing_the_file_get_disjoint_blocks():
+    first, second = SequenceAllocator("test", block_size=3), SequenceAllocator("test", block_size=3)
+
+    issued = [first.next(), second.next(), first.next(), first.next(), first.next(), second.next()]
+
+    assert issued == [1, 4, 2, 3, 7, 5]
+    assert len(set(issued)) == len(issued)
+
+def test_numbers_increase_in_call_order_without_blocks():
+    first, second = SequenceAllocator("test"), SequenceAllocator("test")
+
+    issued = [allocator.next() for allocator in (first, second, second, first, second)]
+
+    assert issued == sorted(issued)
+    assert len(set(issued)) == len(issued)
+
+def test_sequence_continues_after_existing_orders():
+    allocator = SequenceAllocator("test", seed=lambda: 41)
+
+    assert allocator.next() == 42
+
+def _allocate(results, count):
+    allocator = SequenceAllocator("test", block_size=4)
+    results.put([allocator.next() for _ in range(count)])
+
+def test_numbers_are_unique_across_processes():
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    workers = [context.Process(target=_allocate, args=(results, 10)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    issued = [results.get(timeout=30) for _ in workers]
+    for worker in workers:
+        worker.join(timeout=30)
+
+    for numbers in issued:
+        assert numbers == sorted(numbers)
+    flat = [number for numbers in issued for number in numbers]
+    assert len(set(flat)) == len(flat) == 40
+
+def test_order_numbers_are_unique():
+    numbers = [Database.add_order({"user_id": "u1", "items": []})["order_number"] for _ in range(5)]
+
+    assert len(set(numbers)) == 5
+    assert numbers == sorted(numbers)
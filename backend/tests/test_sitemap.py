@@ -0,0 +1,26 @@
+from database import Database, save_json, PRODUCTS_FILE
+
+def _set_updated_at(value, only_first=False):
+    products = [dict(product) for product in Database.get_products()]
+    for product in products[:1] if only_first else products:
+        product["updated_at"] = value
+    save_json(PRODUCTS_FILE, products)
+
+def test_last_modified_has_second_precision(client):
+    _set_updated_at("2030-05-01T09:00:00.250000")
+
+    response = client.get("/api/sitemap-1.xml")
+
+    assert response.headers["last-modified"] == "Wed, 01 May 2030 09:00:00 GMT"
+    assert "<lastmod>2030-05-01</lastmod>" in response.text
+
+def test_same_day_edit_is_not_reported_unchanged(client):
+    _set_updated_at("2030-05-01T09:00:00")
+    last_modified = client.get("/api/sitemap-1.xml").headers["last-modified"]
+    assert client.get("/api/sitemap-1.xml", headers={"If-Modified-Since": last_modified}).status_code == 304
+
+    _set_updated_at("2030-05-01T15:30:00", only_first=True)
+    response = client.get("/api/sitemap-1.xml", headers={"If-Modified-Since": last_modified})
+
+    assert response.status_code == 200
+    assert response.headers["last-modified"] == "Wed, 01 May 2030 15:30:00 GMT"
@@ -0,0 +1,52 @@
+import asyncio
+
+from services.warmup_service import WarmupService
+
+def test_ready_only_after_successful_warmup(monkeypatch):
+    service = WarmupService()
+    service.RETRY_DELAY = 0
+    monkeypatch.setattr(service, "_warm_external", lambda: asyncio.sleep(0))
+
+    calls = []
+
+    def load_collections():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            raise OSError("disk not ready")
+        return {}
+
+    readiness = []
+    original_sleep = asyncio.sleep
+
+    async def record_sleep(delay):
+        readiness.append((service.ready, service.error))
+        await original_sleep(0)
+
+    monkeypatch.setattr(service, "_load_collections", load_collections)
+    monkeypatch.setattr(service, "_build_aggregates", lambda: None)
+    monkeypatch.setattr(asyncio, "sleep", record_sleep)
+
+    asyncio.run(service.run())
+
+    # После неудачной попытки воркер не готов, после повтора - готов
+    assert readiness[0] == (False, "disk not ready")
+    assert service.ready and service.error is None
+    assert service.attempts == 2
+
+def test_failed_warmup_keeps_readiness_503(monkeypatch):
+    service = WarmupService()
+
+    def fail():
+        raise OSError("disk not ready")
+
+    monkeypatch.setattr(service, "_load_collections", fail)
+
+    async def scenario():
+        task = asyncio.create_task(service.run())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        return service.get_status()
+
+    status = asyncio.run(scenario())
+    assert not status["ready"]
+    assert status["error"] == "disk not ready"
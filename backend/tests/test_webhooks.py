@@ -0,0 +1,173 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import multiprocessing
+
+import pytest
+
+from database import Database
+from services import yoomoney_service
+from services.inventory_service import get_reservation_engine
+from services.webhook_queue import WebhookQueue, get_webhook_queue
+from services.yoomoney_service import YooMoneyPayment, YooMoneyService, apply_payment_notification
+
+SECRET = "test-secret"
+
+class FakeYooMoney(YooMoneyService):
+    """Сервис без сетевых запросов: статус платежа задается тестом"""
+
+    def __init__(self, statuses=None):
+        super().__init__("shop", SECRET)
+        self.statuses = statuses or {}
+
+    async def get_payment_status(self, payment_id):
+        return YooMoneyPayment(
+            id=payment_id, status=self.statuses.get(payment_id, "pending"),
+            amount={"value": "100.00", "currency": "RUB"}, description="", created_at=""
+        )
+
+@pytest.fixture
+def yoomoney(monkeypatch):
+    fake = FakeYooMoney()
+    monkeypatch.setattr(yoomoney_service, "yoomoney_service", fake)
+    return fake
+
+def _order_with_payment(payment_id):
+    product_id = Database.get_products()[0]["id"]
+    Database.update_product(product_id, {"stock_quantity": 5})
+    reservation = get_reservation_engine().reserve([{"product_id": product_id, "quantity": 1}])
+    order = Database.add_order({"user_id": "u1", "items": [], "reservation": reservation})
+    Database.add_payment({"payment_id": payment_id, "order_id": order["id"], "status": "pending"})
+    return order
+
+def _notification(payment_id, order_id, status="succeeded"):
+    return {
+        "event": f"payment.{status}",
+        "object": {"id": payment_id, "status": status, "metadata": {"order_id": order_id}}
+    }
+
+def _pending_entries():
+    pending_dir = get_webhook_queue().pending_dir
+    if not pending_dir.exists():
+        return []
+    return [json.loads(path.read_text(encoding="utf-8"))["data"] for path in sorted(pending_dir.glob("*.json"))]
+
+def _process_pending(queue=None):
+    queue = queue or get_webhook_queue()
+    for path in sorted(queue.pending_dir.glob("*.json")):
+        asyncio.run(queue._process(path))
+
+def test_unsigned_notification_is_rejected(client, yoomoney):
+    order = _order_with_payment("pay-1")
+
+    response = client.post("/api/webhooks/yoomoney", json=_notification("pay-1", order["id"]))
+
+    assert response.status_code == 401
+    assert _pending_entries() == []
+    assert Database.get_order(order["id"])["status"] != "paid"
+
+def test_invalid_signature_is_rejected(client, yoomoney):
+    body = json.dumps(_notification("pay-1", "any")).encode()
+
+    response = client.post("/api/webhooks/yoomoney", content=body, headers={"X-Webhook-Signature": "forged"})
+
+    assert response.status_code == 401
+
+def test_signed_notification_is_queued(client, yoomoney):
+    body = json.dumps(_notification("pay-1", "any")).encode()
+    signature = hmac.new(SECRET.encode(), body, hashlib.sha256).hexdigest()
+
+    response = client.post("/api/webhooks/yoomoney", content=body, headers={"X-Webhook-Signature": signature})
+
+    assert response.json() == {"status": "ok"}
+    assert _pending_entries()[0]["object"]["id"] == "pay-1"
+
+def test_unsigned_notification_is_queued_unverified(client, yoomoney, monkeypatch):
+    monkeypatch.setenv("YOOMONEY_WEBHOOK_REQUIRE_SIGNATURE", "0")
+
+    response = client.post("/api/webhooks/yoomoney", json=_notification("pay-1", "any"))
+
+    assert response.json() == {"status": "ok"}
+    # Ответ без обращения к API: в очереди только id платежа
+    assert _pending_entries() == [{"event": "payment.succeeded", "object": {"id": "pay-1"}, "unverified": True}]
+
+def test_unverified_notification_uses_status_from_api(client, yoomoney, monkeypatch):
+    monkeypatch.setenv("YOOMONEY_WEBHOOK_REQUIRE_SIGNATURE", "0")
+    order = _order_with_payment("pay-1")
+    yoomoney.statuses["pay-1"] = "canceled"
+
+    # Уведомление утверждает, что платеж прошел, а API говорит обратное
+    client.post("/api/webhooks/yoomoney", json=_notification("pay-1", "any"))
+    _process_pending()
+
+    assert Database.get_payment("pay-1")["status"] == "canceled"
+    assert Database.get_order(order["id"])["status"] == "cancelled"
+    assert _pending_entries() == []
+
+def test_unverified_notification_for_unfinished_payment_is_not_deduplicated(client, yoomoney, monkeypatch):
+    monkeypatch.setenv("YOOMONEY_WEBHOOK_REQUIRE_SIGNATURE", "0")
+    order = _order_with_payment("pay-1")
+
+    client.post("/api/webhooks/yoomoney", json=_notification("pay-1", "any"))
+    _process_pending()
+    assert Database.get_order(order["id"])["status"] == "pending"
+
+    # Настоящее уведомление после оплаты не считается дубликатом поддельного
+    yoomoney.statuses["pay-1"] = "succeeded"
+    assert client.post("/api/webhooks/yoomoney", json=_notification("pay-1", "any")).json() == {"status": "ok"}
+    _process_pending()
+    assert Database.get_order(order["id"])["status"] == "paid"
+
+def test_unsigned_notification_with_unknown_event_is_ignored(client, yoomoney, monkeypatch):
+    monkeypatch.setenv("YOOMONEY_WEBHOOK_REQUIRE_SIGNATURE", "0")
+
+    response = client.post("/api/webhooks/yoomoney", json={"event": "anything", "object": {"id": "pay-1"}})
+
+    assert response.json() == {"status": "ignored"}
+    assert _pending_entries() == []
+
+def test_duplicates_are_detected_across_workers():
+    first_worker, second_worker = WebhookQueue(), WebhookQueue()
+    notification = _notification("pay-1", "any")
+
+    assert asyncio.run(first_worker.enqueue(notification)) is True
+    assert asyncio.run(second_worker.enqueue(notification)) is False
+
+    # Ключи другого воркера не затираются при отметке своих
+    asyncio.run(second_worker.enqueue(_notification("pay-2", "any", "canceled")))
+    first_worker._mark_processed("payment.succeeded:pay-1", "payment.succeeded:pay-1")
+    assert second_worker._key_state("payment.canceled:pay-2") == "queued"
+    assert first_worker._key_state("payment.succeeded:pay-1") == "processed"
+
+def _add_payments(prefix, count):
+    for i in range(count):
+        Database.add_payment({"payment_id": f"{prefix}-{i}", "status": "pending"})
+
+def test_payment_writes_are_not_lost_across_workers():
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_add_payments, args=(f"w{n}", 10)) for n in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=30)
+
+    payment_ids = {payment["payment_id"] for payment in Database.get_payments()}
+    assert {f"w{n}-{i}" for n in range(4) for i in range(10)} <= payment_ids
+
+def test_notification_for_unknown_payment_is_not_applied():
+    order = _order_with_payment("pay-1")
+
+    with pytest.raises(LookupError):
+        apply_payment_notification("payment.succeeded", _notification("pay-forged", order["id"])["object"])
+    assert Database.get_order(order["id"])["status"] != "paid"
+
+def test_order_is_taken_from_stored_payment():
+    paid_order = _order_with_payment("pay-1")
+    other_order = _order_with_payment("pay-2")
+
+    result = apply_payment_notification("payment.succeeded", _notification("pay-1", other_order["id"])["object"])
+
+    assert result["order_id"] == paid_order["id"]
+    assert Database.get_order(paid_order["id"])["status"] == "paid"
+    assert Database.get_order(other_order["id"])["status"] != "paid"